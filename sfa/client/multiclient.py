@@ -1,63 +1,247 @@
+from __future__ import with_statement
+
 import threading
 import traceback
 import time
+from collections import deque
 from Queue import Queue
 from sfa.util.sfalogging import logger
 
-def ThreadedMethod(callable, results, errors):
+class Task:
+    """
+    One call issued through a MultiClient; key is what the per-key
+    concurrency limit applies to (typically the aggregate's hrn), or None
     """
-    A function decorator that returns a running thread. The thread
-    runs the specified callable and stores the result in the specified
-    results queue
+    def __init__(self, client, key, callable, args, kwds):
+        self.client = client
+        self.key = key
+        self.callable = callable
+        self.args = args
+        self.kwds = kwds
+        self.submitted = time.time()
+        self.finished = False
+        self.cancelled = False
+
+    def run(self):
+        if self.cancelled:
+            return
+        try:
+            result = self.callable(*self.args, **self.kwds)
+            self.client._task_done(self, result=result)
+        except Exception, e:
+            logger.log_exc('MultiClient: Error in task: ')
+            self.client._task_done(self, error=traceback.format_exc())
+
+class _executor_impl:
     """
-    def wrapper(args, kwds):
-        class ThreadInstance(threading.Thread): 
-            def run(self):
-                try:
-                    results.put(callable(*args, **kwds))
-                except Exception, e:
-                    logger.log_exc('MultiClient: Error in thread: ')
-                    errors.put(traceback.format_exc())
-                    
-        thread = ThreadInstance()
-        thread.start()
-        return thread
-    return wrapper
-
- 
+    The process-wide pool of worker threads that MultiClient calls run in.
+    At most max_workers threads are ever created, they are spawned on demand
+    and then stay around waiting for more work.
+    At most max_per_key tasks with the same key are running (or ready to run)
+    at any time, the other ones wait for a slot; this way a hung aggregate
+    cannot end up holding all the workers.
+    """
+
+    _instance = None
+    max_workers = 50
+    max_per_key = 4
+
+    def __init__(self, max_workers=None, max_per_key=None):
+        self._lock = threading.Condition()
+        # tasks that any worker can pick
+        self._ready = deque()
+        # key -> tasks waiting for the key to have a free slot
+        self._waiting = {}
+        # key -> number of tasks ready or running
+        self._active = {}
+        self._workers = 0
+        self._idle = 0
+        self.submitted = 0
+        self.completed = 0
+        self.cancelled = 0
+        self.configure(max_workers, max_per_key)
+
+    def configure(self, max_workers=None, max_per_key=None):
+        with self._lock:
+            if max_workers is not None:
+                self.max_workers = max(1, int(max_workers))
+            if max_per_key is not None:
+                self.max_per_key = int(max_per_key)
+
+    def submit(self, task):
+        with self._lock:
+            self.submitted += 1
+            key = task.key
+            if key is not None and self.max_per_key > 0 \
+                    and self._active.get(key, 0) >= self.max_per_key:
+                self._waiting.setdefault(key, deque()).append(task)
+            else:
+                self._dispatch(task)
+
+    # remove tasks that have not started yet
+    def cancel(self, tasks):
+        with self._lock:
+            for task in tasks:
+                task.cancelled = True
+                self.cancelled += 1
+                waiting = self._waiting.get(task.key)
+                if waiting and task in waiting:
+                    waiting.remove(task)
+                    if not waiting:
+                        del self._waiting[task.key]
+
+    # the lock is held
+    def _dispatch(self, task):
+        if task.key is not None:
+            self._active[task.key] = self._active.get(task.key, 0) + 1
+        self._ready.append(task)
+        if len(self._ready) > self._idle and self._workers < self.max_workers:
+            self._workers += 1
+            worker = threading.Thread(target=self._work, name="MultiClient-%d" % self._workers)
+            worker.setDaemon(True)
+            worker.start()
+        else:
+            self._lock.notify()
+
+    # the lock is held
+    def _release(self, key):
+        self.completed += 1
+        if key is None:
+            return
+        self._active[key] -= 1
+        waiting = self._waiting.get(key)
+        while waiting and self._active[key] < self.max_per_key:
+            self._dispatch(waiting.popleft())
+        if not waiting:
+            self._waiting.pop(key, None)
+        if not self._active[key]:
+            del self._active[key]
+
+    def _work(self):
+        while True:
+            with self._lock:
+                self._idle += 1
+                while not self._ready:
+                    self._lock.wait()
+                self._idle -= 1
+                task = self._ready.popleft()
+            try:
+                task.run()
+            finally:
+                with self._lock:
+                    self._release(task.key)
+
+    def stats(self):
+        with self._lock:
+            return {'workers': self._workers, 'idle': self._idle,
+                    'max_workers': self.max_workers, 'max_per_key': self.max_per_key,
+                    'ready': len(self._ready),
+                    'waiting': sum([len(w) for w in self._waiting.values()]),
+                    'submitted': self.submitted, 'completed': self.completed,
+                    'cancelled': self.cancelled}
+
+def Executor ():
+    if not _executor_impl._instance:
+        _executor_impl._instance = _executor_impl()
+    return _executor_impl._instance
+
 
 class MultiClient:
     """
-    MultiClient allows to issue several SFA calls in parallel in different threads
-    and stores the results in a thread safe queue. 
+    MultiClient allows to issue several SFA calls in parallel and stores 
+    the results in a thread safe queue. The calls run in the shared Executor.
+    If a timeout is given, get_results returns whatever came back within
+    that many seconds (counted from the creation of the MultiClient), 
+    and the calls that did not make it are available from get_timeouts.
     """
 
-    def __init__(self):
+    def __init__(self, timeout=None, executor=None):
         self.results = Queue()
         self.errors = Queue()
-        self.threads = []
+        self.timeout = timeout
+        if executor is None:
+            executor = Executor()
+        self.executor = executor
+        self.tasks = []
+        self.timeouts = []
+        self.start_time = time.time()
+        self._done = threading.Condition()
 
     def run (self, method, *args, **kwds):
         """
-        Execute a callable in a separate thread.    
+        Execute a callable in the executor.
         """
-        method = ThreadedMethod(method, self.results, self.errors)
-        thread = method(args, kwds)
-        self.threads.append(thread)
+        self.run_for(None, method, *args, **kwds)
 
     start = run
 
+    def run_for (self, key, method, *args, **kwds):
+        """
+        Same as run, but the call counts in the concurrency limit of key,
+        e.g. the hrn of the aggregate the call is sent to.
+        """
+        task = Task(self, key, method, args, kwds)
+        self.tasks.append(task)
+        self.executor.submit(task)
+
+    def _task_done(self, task, result=None, error=None):
+        with self._done:
+            # too late, the caller is gone
+            if task.cancelled:
+                return
+            if error is None:
+                self.results.put(result)
+            else:
+                self.errors.put(error)
+            task.finished = True
+            self._done.notifyAll()
+
+    # wait for the next call to complete, the lock is held
+    # returns False when there is nothing left to wait for
+    def _wait(self):
+        late = [task for task in self.tasks if not task.finished and not task.cancelled]
+        if not late:
+            return False
+        if self.timeout is None:
+            self._done.wait()
+            return True
+        remaining = self.start_time + self.timeout - time.time()
+        if remaining <= 0:
+            now = time.time()
+            for task in late:
+                logger.warning("MultiClient: call to %s timed out after %.1fs" % (task.key, now - task.submitted))
+                self.timeouts.append( (task.key, now - task.submitted) )
+            self.executor.cancel(late)
+            return False
+        self._done.wait(remaining)
+        return True
+
     def join(self):
         """
-        Wait for all threads to complete  
+        Wait for all calls to complete, or for the deadline to expire;
+        calls that are not complete by then are dropped.
         """
-        for thread in self.threads:
-            thread.join()
+        with self._done:
+            while self._wait():
+                pass
+
+    def iter_results(self):
+        """
+        Yield the results as the calls complete, until they are all done
+        or the deadline expires. Errors remain available from get_errors
+        """
+        while True:
+            with self._done:
+                while self.results.empty() and self._wait():
+                    pass
+            if self.results.empty():
+                return
+            yield self.results.get()
 
     def get_results(self, lenient=True):
         """
         Return a list of all the results so far. Blocks until 
-        all threads are finished. 
+        all calls are finished, or the deadline has expired. 
         If lenient is set to false the error queue will be checked before 
         the response is returned. If there are errors in the queue an SFA Fault will 
         be raised.   
@@ -75,7 +259,7 @@ class MultiClient:
 
     def get_errors(self):
         """
-        Return a list of all errors. Blocks untill all threads are finished
+        Return a list of all errors. Blocks untill all calls are finished
         """
         self.join()
         errors = []
@@ -83,6 +267,14 @@ class MultiClient:
             errors.append(self.errors.get())
         return errors
 
+    def get_timeouts(self):
+        """
+        Return a list of (key, elapsed) for the calls that did not complete
+        before the deadline. Blocks like get_results
+        """
+        self.join()
+        return self.timeouts
+
     def get_return_value(self):
         """
         Get the value that should be returuned to the client. If there are errors then the
@@ -255,11 +255,13 @@ Users having a GID/PubKey correpondence NOT OK: %s and are: \n%s\n\n"%(len(NOKEY
         print cred
    
 
-    def import_registry(self):
+    @add_options('-r', '--resume', dest='resume', metavar='<resume>', action='store_true', default=False,
+                 help='Skip the import phases that a previous, failed, run has committed')
+    def import_registry(self, resume=False):
         """Run the importer"""
         from sfa.importer import Importer
         importer = Importer()
-        importer.run()
+        importer.run({'resume': resume})
 
     def sync_db(self):
         """Initialize or upgrade the db"""
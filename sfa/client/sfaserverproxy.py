@@ -4,6 +4,10 @@
 import ssl
 ssl_needs_unverified_context = hasattr(ssl, '_create_unverified_context')
 
+import time
+import socket
+import select
+import threading
 import xmlrpclib
 from httplib import HTTPS, HTTPSConnection
 
@@ -29,6 +33,136 @@ class ExceptionUnmarshaller(xmlrpclib.Unmarshaller):
         except xmlrpclib.Fault, e:
             raise ServerException(e.faultString)
 
+##
+# HTTPSConnectionPool
+#
+# Keeps the HTTPS connections to the peers open between calls, so that
+# each call does not need its own TCP connection and TLS handshake
+# connections are keyed on (host, key_file, cert_file) and are reused
+# only if the server has kept them alive; an idle connection is checked
+# before it gets reused, and closed when it has been idle for too long
+# the number of simultaneous calls to the same peer is capped
+
+class HTTPSConnectionPool:
+
+    # idle connections kept per peer
+    max_idle = 4
+    # simultaneous calls per peer
+    max_active = 8
+    # seconds before an idle connection gets closed
+    idle_timeout = 60
+    # seconds to wait for a call to the same peer to complete, when
+    # acquire is given no timeout
+    max_wait = 300
+
+    def __init__(self, max_idle=None, max_active=None, idle_timeout=None):
+        if max_idle is not None: self.max_idle = max_idle
+        if max_active is not None: self.max_active = max_active
+        if idle_timeout is not None: self.idle_timeout = idle_timeout
+        self._condition = threading.Condition()
+        # key -> list of (conn, last_used)
+        self._idle = {}
+        # key -> number of connections in use
+        self._active = {}
+        self.created = 0
+        self.reused = 0
+        self.discarded = 0
+        self.waits = 0
+
+    # an idle connection is healthy if the peer has neither closed it
+    # nor sent anything on it
+    @staticmethod
+    def is_healthy(conn):
+        sock = getattr(conn, 'sock', None)
+        if sock is None:
+            return False
+        try:
+            (readable, _, _) = select.select([sock], [], [], 0)
+        except (select.error, socket.error, ValueError):
+            return False
+        return not readable
+
+    def _evict(self, now):
+        for (key, idle) in self._idle.items():
+            kept = []
+            for (conn, last_used) in idle:
+                if now - last_used > self.idle_timeout:
+                    conn.close()
+                    self.discarded += 1
+                else:
+                    kept.append( (conn, last_used) )
+            if kept:
+                self._idle[key] = kept
+            else:
+                del self._idle[key]
+
+    ##
+    # Get a connection to a peer, either a kept-alive one or a new one
+    # from factory; blocks while max_active calls are already in progress
+    # to that peer, for at most timeout - or max_wait - seconds
+    # returns a (connection, reused) tuple
+    def acquire(self, key, factory, timeout=None):
+        deadline = time.time() + (timeout or self.max_wait)
+        with self._condition:
+            while self._active.get(key, 0) >= self.max_active:
+                self.waits += 1
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise socket.timeout("too many calls in progress to %s" % key[0])
+                self._condition.wait(remaining)
+            self._active[key] = self._active.get(key, 0) + 1
+            now = time.time()
+            self._evict(now)
+            idle = self._idle.get(key, [])
+            while idle:
+                (conn, last_used) = idle.pop()
+                if self.is_healthy(conn):
+                    self.reused += 1
+                    return (conn, True)
+                conn.close()
+                self.discarded += 1
+        try:
+            conn = factory()
+        except:
+            self.release(key, None, False)
+            raise
+        with self._condition:
+            self.created += 1
+        return (conn, False)
+
+    ##
+    # Give a connection back, it is kept for later only if reusable
+    def release(self, key, conn, reusable):
+        with self._condition:
+            self._active[key] -= 1
+            if not self._active[key]:
+                del self._active[key]
+            if conn is not None:
+                idle = self._idle.setdefault(key, [])
+                if reusable and len(idle) < self.max_idle:
+                    idle.append( (conn, time.time()) )
+                else:
+                    conn.close()
+                    self.discarded += 1
+            self._condition.notify_all()
+
+    def close(self):
+        with self._condition:
+            for idle in self._idle.values():
+                for (conn, last_used) in idle:
+                    conn.close()
+            self._idle = {}
+
+    def stats(self):
+        with self._condition:
+            return {'created': self.created, 'reused': self.reused, 
+                    'discarded': self.discarded, 'waits': self.waits,
+                    'idle': sum([len(idle) for idle in self._idle.values()]),
+                    'active': sum(self._active.values())}
+
+# the one shared by all the SfaServerProxy objects in this process
+connection_pool = HTTPSConnectionPool()
+
 ##
 # XMLRPCTransport
 #
@@ -38,11 +172,13 @@ class ExceptionUnmarshaller(xmlrpclib.Unmarshaller):
 
 class XMLRPCTransport(xmlrpclib.Transport):
     
-    def __init__(self, key_file = None, cert_file = None, timeout = None):
+    # pool is an HTTPSConnectionPool, or None to use one connection per call
+    def __init__(self, key_file = None, cert_file = None, timeout = None, pool = None):
         xmlrpclib.Transport.__init__(self)
         self.timeout=timeout
         self.key_file = key_file
         self.cert_file = cert_file
+        self.pool = pool
         
     def make_connection(self, host):
         # create a HTTPS connection object from a host descriptor
@@ -75,6 +211,43 @@ class XMLRPCTransport(xmlrpclib.Transport):
 
         return conn
 
+    # same as in xmlrpclib, but with a connection from the pool
+    # xmlrpclib.Transport.request retries once if the connection turns out
+    # to have been closed by the server 
+    def single_request(self, host, handler, request_body, verbose=0):
+        if self.pool is None:
+            return xmlrpclib.Transport.single_request(self, host, handler, request_body, verbose)
+
+        key = (self.get_host_info(host)[0], self.key_file, self.cert_file)
+        (h, reused) = self.pool.acquire(key, lambda: self.make_connection(host), self.timeout)
+        reusable = False
+        try:
+            # the connection may come from a proxy with another timeout
+            if reused and getattr(h, 'sock', None):
+                if self.timeout:
+                    h.sock.settimeout(float(self.timeout))
+                else:
+                    h.sock.settimeout(None)
+            if verbose:
+                h.set_debuglevel(1)
+            self.send_request(h, handler, request_body)
+            self.send_host(h, host)
+            self.send_user_agent(h)
+            self.send_content(h, request_body)
+
+            response = h.getresponse(buffering=True)
+            if response.status == 200:
+                self.verbose = verbose
+                result = self.parse_response(response)
+                reusable = not response.will_close
+                return result
+            if (response.getheader("content-length", 0)):
+                response.read()
+            raise xmlrpclib.ProtocolError(host + handler, response.status, 
+                                          response.reason, response.msg)
+        finally:
+            self.pool.release(key, h, reusable)
+
     def getparser(self):
         unmarshaller = ExceptionUnmarshaller()
         parser = xmlrpclib.ExpatParser(unmarshaller)
@@ -100,14 +273,17 @@ class XMLRPCServerProxy(xmlrpclib.ServerProxy):
 ########## the object on which we can send methods that get sent over xmlrpc
 class SfaServerProxy:
 
-    def __init__ (self, url, keyfile, certfile, verbose=False, timeout=None):
+    # pooled: whether to reuse the connections to this server, see HTTPSConnectionPool
+    def __init__ (self, url, keyfile, certfile, verbose=False, timeout=None, pooled=True):
         self.url = url
         self.keyfile = keyfile
         self.certfile = certfile
         self.verbose = verbose
         self.timeout = timeout
         # an instance of xmlrpclib.ServerProxy
-        transport = XMLRPCTransport(keyfile, certfile, timeout)
+        pool = None
+        if pooled: pool = connection_pool
+        transport = XMLRPCTransport(keyfile, certfile, timeout, pool)
         self.serverproxy = XMLRPCServerProxy(url, transport, allow_none=True, verbose=verbose)
 
     # this is python magic to return the code to run when 
@@ -143,9 +143,8 @@ def save_rspec_to_file(rspec, filename):
     f.close()
     return
 
-def save_records_to_file(filename, record_dicts, format="xml"):
+def save_records_to_file(filename, record_dicts, format="xml", index=0):
     if format == "xml":
-        index = 0
         for record_dict in record_dicts:
             if index > 0:
                 save_record_to_file(filename + "." + str(index), record_dict)
@@ -503,6 +502,8 @@ class Sfi:
                              help="list all child records", default=False)
            parser.add_option("-v", "--verbose", dest="verbose", action='store_true',
                              help="gives details, like user keys", default=False)
+           parser.add_option("-p", "--page", dest="page", type="int", metavar="N",
+                             help="fetch records N at a time, in hrn order", default=None)
         if canonical in ("delegate"):
            parser.add_option("-u", "--user",
                              action="store_true", dest="delegate_user", default=False,
@@ -956,6 +957,8 @@ use this if you mean an authority instead""")
         
         if options.show_credential:
             show_credentials(self.my_credential_string)
+        if options.page:
+            return self.list_pages(hrn, opts, options)
         try:
             list = self.registry().List(hrn, self.my_credential_string, options)
         except IndexError:
@@ -970,6 +973,38 @@ use this if you mean an authority instead""")
         # xxx should analyze result
         return 0
     
+    # sfi list --page: ask for the records options.page at a time, and
+    # render each page as it comes, so memory does not grow with the registry
+    def list_pages(self, hrn, opts, options):
+        opts['limit'] = options.page
+        index = 0
+        # xmllist and hrnlist only need hrn and type, written in one go at the end
+        names = []
+        while True:
+            page = self.registry().List(hrn, self.my_credential_string, opts)
+            if not page:
+                break
+            # a registry that ignores limit and marker would have us loop forever:
+            # it sends everything at once, or the same page again
+            marker = [ page[-1]['hrn'], page[-1]['type'] ]
+            if marker == opts.get('marker'):
+                break
+            opts['marker'] = marker
+            page_len = len(page)
+            page = filter_records(options.type, page)
+            terminal_render (page, options)
+            if options.file:
+                if options.fileformat == "xml":
+                    save_records_to_file(options.file, page, options.fileformat, index)
+                else:
+                    names += [ {'hrn': record['hrn'], 'type': record['type']} for record in page ]
+            index += len(page)
+            if page_len != options.page:
+                break
+        if options.file and options.fileformat != "xml":
+            save_records_to_file(options.file, names, options.fileformat)
+        return 0
+
     @declare_command("name","")
     def show(self, options, args):
         """
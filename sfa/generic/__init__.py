@@ -57,9 +57,21 @@ class Generic:
     def component_class (self) : pass
 
 
+    # build the process-lifetime part of the API objects
+    # a server does this once, and then calls context.make_api() for each request
+    def make_api_context (self, *args, **kwargs):
+        from sfa.server.sfaapi import SfaApiContext
+        # interface is a required arg
+        if not 'interface' in kwargs:
+            logger.critical("Generic.make_api_context: no interface found")
+        return SfaApiContext(self, *args, **kwargs)
+
     # build an API object
     # insert a manager instance 
     def make_api (self, *args, **kwargs):
+        # manager and driver come with the context
+        if 'context' in kwargs:
+            return self.api_class()(*args, **kwargs)
         # interface is a required arg
         if not 'interface' in kwargs:
             logger.critical("Generic.make_api: no interface found")
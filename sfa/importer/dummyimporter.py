@@ -21,7 +21,8 @@ from sfa.util.config import Config
 from sfa.util.xrn import Xrn, get_leaf, get_authority, hrn_to_urn
 
 from sfa.trust.gid import create_uuid    
-from sfa.trust.certificate import convert_public_key, Keypair
+from sfa.trust.certificate import convert_public_key
+from sfa.trust.gidfactory import GidFactory
 
 # using global alchemy.session() here is fine 
 # as importer is on standalone one-shot process
@@ -41,6 +42,8 @@ class DummyImporter:
     def __init__ (self, auth_hierarchy, logger):
         self.auth_hierarchy = auth_hierarchy
         self.logger=logger
+        # keypairs get created ahead of time in worker processes
+        self.gid_factory = GidFactory (auth_hierarchy)
 
     def add_options (self, parser):
         # we don't have any options for now
@@ -155,7 +158,7 @@ class DummyImporter:
                 try:
                     urn = hrn_to_urn(site_hrn, 'authority')
                     if not self.auth_hierarchy.auth_exists(urn):
-                        self.auth_hierarchy.create_auth(urn)
+                        self.auth_hierarchy.create_auth(urn, pkey=self.gid_factory.keypair())
                     auth_info = self.auth_hierarchy.get_auth_info(urn)
                     site_record = RegAuthority(hrn=site_hrn, gid=auth_info.get_gid_object(),
                                                pointer= -1,
@@ -185,7 +188,7 @@ class DummyImporter:
                 node_record = self.locate_by_type_hrn ( 'node', node_hrn )
                 if not node_record:
                     try:
-                        pkey = Keypair(create=True)
+                        pkey = self.gid_factory.keypair()
                         urn = hrn_to_urn(node_hrn, 'node')
                         node_gid = self.auth_hierarchy.create_gid(urn, create_uuid(), pkey)
                         node_record = RegNode (hrn=node_hrn, gid=node_gid, 
@@ -229,11 +232,11 @@ class DummyImporter:
                                 continue
                         if not pkey:
                             self.logger.warn('DummyImporter: unable to convert public key for %s' % user_hrn)
-                            pkey = Keypair(create=True)
+                            pkey = self.gid_factory.keypair()
                     else:
                         # the user has no keys. Creating a random keypair for the user's gid
                         self.logger.warn("DummyImporter: user %s does not have a NITOS public key"%user_hrn)
-                        pkey = Keypair(create=True)
+                        pkey = self.gid_factory.keypair()
                     return (pubkey, pkey)
 
                 # new user
@@ -291,7 +294,7 @@ class DummyImporter:
                 slice_record = self.locate_by_type_hrn ('slice', slice_hrn)
                 if not slice_record:
                     try:
-                        pkey = Keypair(create=True)
+                        pkey = self.gid_factory.keypair()
                         urn = hrn_to_urn(slice_hrn, 'slice')
                         slice_gid = self.auth_hierarchy.create_gid(urn, create_uuid(), pkey)
                         slice_record = RegSlice (hrn=slice_hrn, gid=slice_gid, 
@@ -5,7 +5,8 @@ from sfa.util.config import Config
 from sfa.util.xrn import Xrn, get_leaf, get_authority, hrn_to_urn
 
 from sfa.trust.gid import create_uuid    
-from sfa.trust.certificate import convert_public_key, Keypair
+from sfa.trust.certificate import convert_public_key
+from sfa.trust.gidfactory import GidFactory
 
 # using global alchemy.session() here is fine 
 # as importer is on standalone one-shot process
@@ -25,6 +26,8 @@ class NitosImporter:
     def __init__ (self, auth_hierarchy, logger):
         self.auth_hierarchy = auth_hierarchy
         self.logger=logger
+        # keypairs get created ahead of time in worker processes
+        self.gid_factory = GidFactory (auth_hierarchy)
 
     def add_options (self, parser):
         # we don't have any options for now
@@ -142,7 +145,7 @@ class NitosImporter:
                 try:
                     urn = hrn_to_urn(site_hrn, 'authority')
                     if not self.auth_hierarchy.auth_exists(urn):
-                        self.auth_hierarchy.create_auth(urn)
+                        self.auth_hierarchy.create_auth(urn, pkey=self.gid_factory.keypair())
                     auth_info = self.auth_hierarchy.get_auth_info(urn)
                     site_record = RegAuthority(hrn=site_hrn, gid=auth_info.get_gid_object(),
                                                pointer=0,
@@ -172,7 +175,7 @@ class NitosImporter:
                 node_record = self.locate_by_type_hrn ( 'node', node_hrn )
                 if not node_record:
                     try:
-                        pkey = Keypair(create=True)
+                        pkey = self.gid_factory.keypair()
                         urn = hrn_to_urn(node_hrn, 'node')
                         node_gid = self.auth_hierarchy.create_gid(urn, create_uuid(), pkey)
                         node_record = RegNode (hrn=node_hrn, gid=node_gid, 
@@ -216,11 +219,11 @@ class NitosImporter:
                                 continue
                         if not pkey:
                             self.logger.warn('NitosImporter: unable to convert public key for %s' % user_hrn)
-                            pkey = Keypair(create=True)
+                            pkey = self.gid_factory.keypair()
                     else:
                         # the user has no keys. Creating a random keypair for the user's gid
                         self.logger.warn("NitosImporter: user %s does not have a NITOS public key"%user_hrn)
-                        pkey = Keypair(create=True)
+                        pkey = self.gid_factory.keypair()
                     return (pubkey, pkey)
 
                 # new user
@@ -284,7 +287,7 @@ class NitosImporter:
                 slice_record = self.locate_by_type_hrn ('slice', slice_hrn)
                 if not slice_record:
                     try:
-                        pkey = Keypair(create=True)
+                        pkey = self.gid_factory.keypair()
                         urn = hrn_to_urn(slice_hrn, 'slice')
                         slice_gid = self.auth_hierarchy.create_gid(urn, create_uuid(), pkey)
                         slice_record = RegSlice (hrn=slice_hrn, gid=slice_gid, 
@@ -3,7 +3,8 @@ import os
 from sfa.util.config import Config
 from sfa.util.xrn import Xrn, get_leaf, get_authority, hrn_to_urn
 from sfa.trust.gid import create_uuid    
-from sfa.trust.certificate import convert_public_key, Keypair
+from sfa.trust.certificate import convert_public_key
+from sfa.trust.gidfactory import GidFactory
 # using global alchemy.session() here is fine 
 # as importer is on standalone one-shot process
 from sfa.storage.alchemy import global_dbsession
@@ -32,6 +33,8 @@ class OpenstackImporter:
     def __init__ (self, auth_hierarchy, logger):
         self.auth_hierarchy = auth_hierarchy
         self.logger=logger
+        # keypairs get created ahead of time in worker processes
+        self.gid_factory = GidFactory (auth_hierarchy)
         self.config = Config()
         self.interface_hrn = self.config.SFA_INTERFACE_HRN
         self.root_auth = self.config.SFA_REGISTRY_ROOT_AUTH
@@ -77,10 +80,10 @@ class OpenstackImporter:
                         pkey = convert_public_key(keys[0])
                     except:
                         self.logger.log_exc('unable to convert public key for %s' % hrn)
-                        pkey = Keypair(create=True)
+                        pkey = self.gid_factory.keypair()
                 else:
                     self.logger.warn("OpenstackImporter: person %s does not have a PL public key"%hrn)
-                    pkey = Keypair(create=True)
+                    pkey = self.gid_factory.keypair()
                 user_gid = self.auth_hierarchy.create_gid(urn, create_uuid(), pkey, email=user_email)
                 user_record = RegUser(type='user', 
                                       hrn=hrn, 
@@ -110,7 +113,7 @@ class OpenstackImporter:
                 # import group/site
                 urn = OSXrn(xrn=hrn, type='authority').get_urn()
                 if not self.auth_hierarchy.auth_exists(urn):
-                    self.auth_hierarchy.create_auth(urn)
+                    self.auth_hierarchy.create_auth(urn, pkey=self.gid_factory.keypair())
                 auth_info = self.auth_hierarchy.get_auth_info(urn)
                 gid = auth_info.get_gid_object()
                 auth_record = RegAuthority(type='authority',
@@ -123,7 +126,7 @@ class OpenstackImporter:
 
             else:
                 urn = OSXrn(xrn=hrn, type='slice').get_urn()
-                pkey = Keypair(create=True)
+                pkey = self.gid_factory.keypair()
                 gid = self.auth_hierarchy.create_gid(urn, create_uuid(), pkey)
                 slice_record = RegSlice(type='slice',
                                         hrn=hrn,
@@ -16,13 +16,19 @@
 # . slice+researchers           (from pl slices and attached users)
 # 
 
+from __future__ import with_statement
+
 import os
+import time
+
+from sqlalchemy.orm import subqueryload
 
 from sfa.util.config import Config
 from sfa.util.xrn import Xrn, get_leaf, get_authority, hrn_to_urn
 
 from sfa.trust.gid import create_uuid    
-from sfa.trust.certificate import convert_public_key, Keypair
+from sfa.trust.certificate import convert_public_key
+from sfa.trust.gidfactory import GidFactory
 
 # using global alchemy.session() here is fine 
 # as importer is on standalone one-shot process
@@ -45,9 +51,22 @@ def _get_site_hrn(interface_hrn, site):
 
 class PlImporter:
 
+    # the import runs in phases, each of which is committed as a whole
+    # a failed phase is rolled back, and the run stops there - in particular
+    # no stale record gets deleted; with options['resume'] the next run
+    # skips the phases that were committed already, and keeps all the
+    # records of the types they deal with - the next full run cleans these up
+    phases = [ 'sites', 'nodes', 'persons', 'slices', 'stale' ]
+    # the record types that each phase takes care of
+    phase_types = { 'sites' : 'authority', 'nodes' : 'node', 'persons' : 'user', 'slices' : 'slice' }
+    # within a phase, each record gets flushed in a savepoint of its own, so
+    # that a record that fails is rolled back alone and the phase goes on
+
     def __init__ (self, auth_hierarchy, logger):
         self.auth_hierarchy = auth_hierarchy
         self.logger=logger
+        # keypairs and gids get created in worker processes
+        self.gid_factory = GidFactory (auth_hierarchy)
 
     def add_options (self, parser):
         # we don't have any options for now
@@ -113,23 +132,80 @@ class PlImporter:
                 if not self.auth_hierarchy.auth_exists(urn):
                     self.auth_hierarchy.create_auth(urn)
                 auth_info = self.auth_hierarchy.get_auth_info(urn)
-                auth_record = RegAuthority(hrn=site_hrn, gid=auth_info.get_gid_object(),
-                                           pointer=site['site_id'],
-                                           authority=get_authority(site_hrn))
-                auth_record.just_created()
-                global_dbsession.add(auth_record)
-                global_dbsession.commit()
+                with global_dbsession.begin_nested():
+                    auth_record = RegAuthority(hrn=site_hrn, gid=auth_info.get_gid_object(),
+                                               pointer=site['site_id'],
+                                               authority=get_authority(site_hrn))
+                    auth_record.just_created()
+                    self.stage(auth_record, 'created')
                 self.logger.info("PlImporter: Imported authority (vini site) %s"%auth_record)
                 self.remember_record ( site_record )
 
+    # add a new or changed record to the current phase
+    # it gets flushed when the savepoint it was staged in is released
+    def stage (self, record, what):
+        global_dbsession.add (record)
+        self.counts[what] = self.counts.get(what, 0) + 1
+
+    ### the phases that were committed by a previous, failed, run
+    def checkpoint_file (self, config):
+        return os.path.join (config.SFA_DATA_DIR, 'plimporter.phases')
+
+    def load_checkpoint (self, filename):
+        try:
+            return [ line.strip() for line in file(filename) if line.strip() ]
+        except IOError:
+            return []
+
+    def save_checkpoint (self, filename, phase):
+        f = open (filename, 'a')
+        f.write ("%s\n"%phase)
+        f.close()
+
+    def clear_checkpoint (self, filename):
+        if os.path.isfile (filename):
+            os.unlink (filename)
+
+    # returns False if the phase was skipped
+    def run_phase (self, phase, method, *args):
+        if phase in self.done_phases:
+            self.logger.info("PlImporter: phase %s was committed by a previous run - skipped"%phase)
+            # keep the records that this phase would have handled
+            for record in self.all_records:
+                if record.type == self.phase_types.get(phase): record.stale=False
+            return False
+        self.counts = {}
+        begin = time.time()
+        try:
+            # records get flushed with their savepoint, not on each query
+            with global_dbsession.no_autoflush:
+                method (*args)
+            global_dbsession.commit()
+        except:
+            global_dbsession.rollback()
+            self.logger.log_exc("PlImporter: phase %s failed and was rolled back - run again with resume to start from there"%phase)
+            raise
+        counts = ", ".join ( [ "%d %s"%(count, what) for (what, count) in sorted(self.counts.items()) ] )
+        self.logger.info("PlImporter: phase %s committed in %.2fs (%s)"%(phase, time.time()-begin, counts or "no change"))
+        self.save_checkpoint (self.checkpoint, phase)
+        return True
+
     def run (self, options):
         config = Config ()
         interface_hrn = config.SFA_INTERFACE_HRN
         root_auth = config.SFA_REGISTRY_ROOT_AUTH
         shell = PlShell (config)
 
+        self.checkpoint = self.checkpoint_file (config)
+        if options and options.get('resume'):
+            self.done_phases = self.load_checkpoint (self.checkpoint)
+        else:
+            self.done_phases = []
+            self.clear_checkpoint (self.checkpoint)
+
         ######## retrieve all existing SFA objects
         all_records = global_dbsession.query(RegRecord).all()
+        self.all_records = all_records
 
         # create hash by (type,hrn) 
         # we essentially use this to know if a given record is already known to SFA 
@@ -189,14 +265,8 @@ class PlImporter:
         # create hash by slice_id
         slices_by_id = dict ( [ (slice['slice_id'], slice ) for slice in slices ] )
 
-        # isolate special vini case in separate method
-        self.create_special_vini_record (interface_hrn)
-
-        # Get top authority record
-        top_auth_record=self.locate_by_type_hrn ('authority', root_auth)
-        admins = []
-
-        # start importing 
+        # the sites that SFA itself has created in PLC are not imported
+        local_sites = []
         for site in sites:
             try:
                site_sfa_created = shell.GetSiteSfaCreated(site['site_id'])
@@ -204,7 +274,32 @@ class PlImporter:
                site_sfa_created = None
             if site['name'].startswith('sfa:') or site_sfa_created == 'True':
                 continue
+            local_sites.append (site)
+
+        # the importer is the only one to write in the db, so there is no need
+        # to reload all the records from the db after each phase
+        expire_on_commit = global_dbsession.expire_on_commit
+        global_dbsession.expire_on_commit = False
+        try:
+            if not self.run_phase ('sites', self.import_sites, interface_hrn, local_sites):
+                self.site_records = [ (site, self.locate_by_type_hrn ('authority', site['hrn']))
+                                      for site in local_sites ]
+                self.site_records = [ (site, site_record) for (site, site_record) in self.site_records if site_record ]
+            self.run_phase ('nodes', self.import_nodes, nodes_by_id)
+            self.run_phase ('persons', self.import_persons, root_auth,
+                            persons_by_id, disabled_person_ids, keys_by_person_id)
+            self.run_phase ('slices', self.import_slices, slices_by_id)
+            self.run_phase ('stale', self.remove_stale_records, interface_hrn, root_auth)
+        finally:
+            global_dbsession.expire_on_commit = expire_on_commit
+        self.clear_checkpoint (self.checkpoint)
+
+    def import_sites (self, interface_hrn, sites):
+        # isolate special vini case in separate method
+        self.create_special_vini_record (interface_hrn)
 
+        self.site_records = []
+        for site in sites:
             #site_hrn = _get_site_hrn(interface_hrn, site)
             site_hrn = site['hrn']
             # import if hrn is not in list of existing hrns or if the hrn exists
@@ -214,14 +309,14 @@ class PlImporter:
                 try:
                     urn = hrn_to_urn(site_hrn, 'authority')
                     if not self.auth_hierarchy.auth_exists(urn):
-                        self.auth_hierarchy.create_auth(urn)
+                        self.auth_hierarchy.create_auth(urn, pkey=self.gid_factory.keypair())
                     auth_info = self.auth_hierarchy.get_auth_info(urn)
-                    site_record = RegAuthority(hrn=site_hrn, gid=auth_info.get_gid_object(),
-                                               pointer=site['site_id'],
-                                               authority=get_authority(site_hrn))
-                    site_record.just_created()
-                    global_dbsession.add(site_record)
-                    global_dbsession.commit()
+                    with global_dbsession.begin_nested():
+                        site_record = RegAuthority(hrn=site_hrn, gid=auth_info.get_gid_object(),
+                                                   pointer=site['site_id'],
+                                                   authority=get_authority(site_hrn))
+                        site_record.just_created()
+                        self.stage(site_record, 'created')
                     self.logger.info("PlImporter: imported authority (site) : %s" % site_record) 
                     self.remember_record (site_record)
                 except:
@@ -233,7 +328,14 @@ class PlImporter:
                 # xxx update the record ...
                 pass
             site_record.stale=False
-             
+            self.site_records.append ( (site, site_record) )
+
+    def import_nodes (self, nodes_by_id):
+        # first go through the nodes and have the gids for the new ones made in parallel
+        new_nodes = []
+        new_node_gids = {}
+        for (site, site_record) in self.site_records:
+            site_hrn = site['hrn']
             # import node records
             for node_id in site['node_ids']:
                 try:
@@ -248,26 +350,43 @@ class PlImporter:
                 if len(node_hrn) > 64: node_hrn = node_hrn[:64]
                 node_record = self.locate_by_type_hrn ( 'node', node_hrn )
                 if not node_record:
-                    try:
-                        pkey = Keypair(create=True)
+                    if node_hrn not in new_node_gids:
                         urn = hrn_to_urn(node_hrn, 'node')
-                        node_gid = self.auth_hierarchy.create_gid(urn, create_uuid(), pkey)
-                        node_record = RegNode (hrn=node_hrn, gid=node_gid, 
-                                               pointer =node['node_id'],
-                                               authority=get_authority(node_hrn))
-                        node_record.just_created()
-                        global_dbsession.add(node_record)
-                        global_dbsession.commit()
-                        self.logger.info("PlImporter: imported node: %s" % node_record)  
-                        self.remember_record (node_record)
-                    except:
-                        self.logger.log_exc("PlImporter: failed to import node %s"%node_hrn) 
-                        continue
+                        new_node_gids[node_hrn] = self.gid_factory.create_gid_async(urn, create_uuid())
+                        new_nodes.append ( (node, node_hrn) )
                 else:
                     # xxx update the record ...
-                    pass
-                node_record.stale=False
+                    node_record.stale=False
+
+        # then create the new records, in the same order
+        for (node, node_hrn) in new_nodes:
+            try:
+                node_gid = new_node_gids[node_hrn].get()
+                with global_dbsession.begin_nested():
+                    node_record = RegNode (hrn=node_hrn, gid=node_gid, 
+                                           pointer =node['node_id'],
+                                           authority=get_authority(node_hrn))
+                    node_record.just_created()
+                    self.stage(node_record, 'created')
+                self.logger.info("PlImporter: imported node: %s" % node_record)  
+                self.remember_record (node_record)
+            except:
+                self.logger.log_exc("PlImporter: failed to import node %s"%node_hrn) 
+                continue
+            node_record.stale=False
 
+    def import_persons (self, root_auth, persons_by_id, disabled_person_ids, keys_by_person_id):
+        # load the keys of the known users, and the pis of the known authorities,
+        # in one go rather than one user or authority at a time
+        global_dbsession.query(RegUser).options(subqueryload(RegUser.reg_keys)).all()
+        global_dbsession.query(RegAuthority).options(subqueryload(RegAuthority.reg_pis)).all()
+
+        # Get top authority record
+        top_auth_record=self.locate_by_type_hrn ('authority', root_auth)
+        admins = []
+
+        for (site, site_record) in self.site_records:
+            site_hrn = site['hrn']
             site_pis=[]
             # import persons
             for person_id in site['person_ids']:
@@ -303,79 +422,81 @@ class PlImporter:
                             pkey = convert_public_key(pubkey['key'])
                         except:
                             self.logger.warn('PlImporter: unable to convert public key for %s' % person_hrn)
-                            pkey = Keypair(create=True)
+                            pkey = self.gid_factory.keypair()
                     else:
                         # the user has no keys. Creating a random keypair for the user's gid
                         self.logger.warn("PlImporter: person %s does not have a PL public key"%person_hrn)
-                        pkey = Keypair(create=True)
+                        pkey = self.gid_factory.keypair()
                     return (pubkey, pkey)
 
                 # new person
                 try:
-                    plc_keys = keys_by_person_id.get(person['person_id'],[])
-                    if not user_record:
-                        (pubkey,pkey) = init_person_key (person, plc_keys )
-                        person_gid = self.auth_hierarchy.create_gid(person_urn, create_uuid(), pkey, email=person['email'])
-                        user_record = RegUser (hrn=person_hrn, gid=person_gid, 
-                                               pointer=person['person_id'], 
-                                               authority=get_authority(person_hrn),
-                                               email=person['email'])
-                        if pubkey: 
-                            user_record.reg_keys=[RegKey (pubkey['key'], pubkey['key_id'])]
+                    created = not user_record
+                    with global_dbsession.begin_nested():
+                        plc_keys = keys_by_person_id.get(person['person_id'],[])
+                        if not user_record:
+                            (pubkey,pkey) = init_person_key (person, plc_keys )
+                            person_gid = self.auth_hierarchy.create_gid(person_urn, create_uuid(), pkey, email=person['email'])
+                            user_record = RegUser (hrn=person_hrn, gid=person_gid, 
+                                                   pointer=person['person_id'], 
+                                                   authority=get_authority(person_hrn),
+                                                   email=person['email'])
+                            if pubkey: 
+                                user_record.reg_keys=[RegKey (pubkey['key'], pubkey['key_id'])]
+                            else:
+                                self.logger.warning("No key found for user %s"%user_record)
+                            user_record.just_created()
+                            self.stage (user_record, 'created')
+                            self.logger.info("PlImporter: imported person: %s" % user_record)
                         else:
-                            self.logger.warning("No key found for user %s"%user_record)
-                        user_record.just_created()
-                        global_dbsession.add (user_record)
-                        global_dbsession.commit()
-                        self.logger.info("PlImporter: imported person: %s" % user_record)
+                            # update the record ?
+                            #
+                            # if a user key has changed then we need to update the
+                            # users gid by forcing an update here
+                            #
+                            # right now, SFA only has *one* key attached to a user, and this is
+                            # the key that the GID was made with
+                            # so the logic here is, we consider that things are OK (unchanged) if
+                            # all the SFA keys are present as PLC keys
+                            # otherwise we trigger the creation of a new gid from *some* plc key
+                            # and record this on the SFA side
+                            # it would make sense to add a feature in PLC so that one could pick a 'primary'
+                            # key but this is not available on the myplc side for now
+                            # = or = it would be much better to support several keys in SFA but that
+                            # does not seem doable without a major overhaul in the data model as
+                            # a GID is attached to a hrn, but it's also linked to a key, so...
+                            # NOTE: with this logic, the first key entered in PLC remains the one
+                            # current in SFA until it is removed from PLC
+                            sfa_keys = user_record.reg_keys
+                            def sfa_key_in_list (sfa_key,plc_keys):
+                                for plc_key in plc_keys:
+                                    if plc_key['key']==sfa_key.key:
+                                        return True
+                                return False
+                            # are all the SFA keys known to PLC ?
+                            new_keys=False
+                            if not sfa_keys and plc_keys:
+                                new_keys=True
+                            else: 
+                                for sfa_key in sfa_keys:
+                                     if not sfa_key_in_list (sfa_key,plc_keys):
+                                         new_keys = True
+                            if new_keys:
+                                (pubkey,pkey) = init_person_key (person, plc_keys)
+                                person_gid = self.auth_hierarchy.create_gid(person_urn, create_uuid(), pkey)
+                                person_gid.set_email(person['email'])
+                                if not pubkey:
+                                    user_record.reg_keys=[]
+                                else:
+                                    user_record.reg_keys=[ RegKey (pubkey['key'], pubkey['key_id'])]
+                                user_record.gid = person_gid
+                                user_record.just_updated()
+                                self.stage (user_record, 'updated')
+                                self.logger.info("PlImporter: updated person: %s" % user_record)
+                        user_record.email = person['email']
+                        user_record.stale=False
+                    if created:
                         self.remember_record ( user_record )
-                    else:
-                        # update the record ?
-                        #
-                        # if a user key has changed then we need to update the
-                        # users gid by forcing an update here
-                        #
-                        # right now, SFA only has *one* key attached to a user, and this is
-                        # the key that the GID was made with
-                        # so the logic here is, we consider that things are OK (unchanged) if
-                        # all the SFA keys are present as PLC keys
-                        # otherwise we trigger the creation of a new gid from *some* plc key
-                        # and record this on the SFA side
-                        # it would make sense to add a feature in PLC so that one could pick a 'primary'
-                        # key but this is not available on the myplc side for now
-                        # = or = it would be much better to support several keys in SFA but that
-                        # does not seem doable without a major overhaul in the data model as
-                        # a GID is attached to a hrn, but it's also linked to a key, so...
-                        # NOTE: with this logic, the first key entered in PLC remains the one
-                        # current in SFA until it is removed from PLC
-                        sfa_keys = user_record.reg_keys
-                        def sfa_key_in_list (sfa_key,plc_keys):
-                            for plc_key in plc_keys:
-                                if plc_key['key']==sfa_key.key:
-                                    return True
-                            return False
-                        # are all the SFA keys known to PLC ?
-                        new_keys=False
-                        if not sfa_keys and plc_keys:
-                            new_keys=True
-                        else: 
-                            for sfa_key in sfa_keys:
-                                 if not sfa_key_in_list (sfa_key,plc_keys):
-                                     new_keys = True
-                        if new_keys:
-                            (pubkey,pkey) = init_person_key (person, plc_keys)
-                            person_gid = self.auth_hierarchy.create_gid(person_urn, create_uuid(), pkey)
-                            person_gid.set_email(person['email'])
-                            if not pubkey:
-                                user_record.reg_keys=[]
-                            else:
-                                user_record.reg_keys=[ RegKey (pubkey['key'], pubkey['key_id'])]
-                            user_record.gid = person_gid
-                            user_record.just_updated()
-                            self.logger.info("PlImporter: updated person: %s" % user_record)
-                    user_record.email = person['email']
-                    global_dbsession.commit()
-                    user_record.stale=False
                     # accumulate PIs - PLCAPI has a limitation that when someone has PI role
                     # this is valid for all sites she is in..
                     # PI is coded with role_id==20
@@ -397,8 +518,20 @@ class PlImporter:
             # could be performed twice with the same person...
             # so hopefully we do not need to eliminate duplicates explicitly here anymore
             site_record.reg_pis = list(set(site_pis))
-            global_dbsession.commit()
 
+        # Set PL Admins as PI's of the top authority
+        if admins:
+            top_auth_record.reg_pis = list(set(admins))
+            self.logger.info('PlImporter: set PL admins %s as PIs of %s'%(admins,top_auth_record.hrn))
+
+    def import_slices (self, slices_by_id):
+        # load the researchers of the known slices in one go
+        global_dbsession.query(RegSlice).options(subqueryload(RegSlice.reg_researchers)).all()
+
+        # first go through the slices and have the gids for the new ones made in parallel
+        site_slices = []
+        new_slice_gids = {}
+        for (site, site_record) in self.site_records:
             # import slices
             for slice_id in site['slice_ids']:
                 try:
@@ -412,42 +545,43 @@ class PlImporter:
                     self.logger.warning("Slice %s has no hrn - skipped"%slice['name'])
                     continue
                 slice_record = self.locate_by_type_hrn ('slice', slice_hrn)
-                if not slice_record:
-                    try:
-                        pkey = Keypair(create=True)
-                        urn = hrn_to_urn(slice_hrn, 'slice')
-                        slice_gid = self.auth_hierarchy.create_gid(urn, create_uuid(), pkey)
+                if not slice_record and slice_hrn not in new_slice_gids:
+                    urn = hrn_to_urn(slice_hrn, 'slice')
+                    new_slice_gids[slice_hrn] = self.gid_factory.create_gid_async(urn, create_uuid())
+                site_slices.append ( (slice, slice_hrn) )
+
+        # then create the new records, in the same order
+        for (slice, slice_hrn) in site_slices:
+            slice_record = self.locate_by_type_hrn ('slice', slice_hrn)
+            if not slice_record:
+                try:
+                    slice_gid = new_slice_gids[slice_hrn].get()
+                    with global_dbsession.begin_nested():
                         slice_record = RegSlice (hrn=slice_hrn, gid=slice_gid, 
                                                  pointer=slice['slice_id'],
                                                  authority=get_authority(slice_hrn))
                         slice_record.just_created()
-                        global_dbsession.add(slice_record)
-                        global_dbsession.commit()
-                        self.logger.info("PlImporter: imported slice: %s" % slice_record)  
-                        self.remember_record ( slice_record )
-                    except:
-                        self.logger.log_exc("PlImporter: failed to import slice %s (%s)"%(slice_hrn,slice['name']))
-                else:
-                    # xxx update the record ...
-                    # given that we record the current set of users anyways, there does not seem to be much left to do here
-                    # self.logger.warning ("Slice update not yet implemented on slice %s (%s)"%(slice_hrn,slice['name']))
-                    pass
-                # record current users affiliated with the slice
-                slice_record.reg_researchers = \
-                    [ self.locate_by_type_pointer ('user',user_id) for user_id in slice['person_ids'] ]
-                global_dbsession.commit()
-                slice_record.stale=False
-
-        # Set PL Admins as PI's of the top authority
-        if admins:
-            top_auth_record.reg_pis = list(set(admins))
-            global_dbsession.commit()
-            self.logger.info('PlImporter: set PL admins %s as PIs of %s'%(admins,top_auth_record.hrn))
+                        self.stage (slice_record, 'created')
+                    self.logger.info("PlImporter: imported slice: %s" % slice_record)  
+                    self.remember_record ( slice_record )
+                except:
+                    self.logger.log_exc("PlImporter: failed to import slice %s (%s)"%(slice_hrn,slice['name']))
+                    continue
+            else:
+                # xxx update the record ...
+                # given that we record the current set of users anyways, there does not seem to be much left to do here
+                # self.logger.warning ("Slice update not yet implemented on slice %s (%s)"%(slice_hrn,slice['name']))
+                pass
+            # record current users affiliated with the slice
+            slice_record.reg_researchers = \
+                [ self.locate_by_type_pointer ('user',user_id) for user_id in slice['person_ids'] ]
+            slice_record.stale=False
 
+    def remove_stale_records (self, interface_hrn, root_auth):
         ### remove stale records
         # special records must be preserved
         system_hrns = [interface_hrn, root_auth, interface_hrn + '.slicemanager']
-        for record in all_records: 
+        for record in self.all_records: 
             if record.hrn in system_hrns: 
                 record.stale=False
             if record.peer_authority:
@@ -456,7 +590,7 @@ class PlImporter:
                 record.hrn.endswith("internet2"):
                 record.stale=False
 
-        for record in all_records:
+        for record in self.all_records:
             try:        stale=record.stale
             except:     
                 stale=True
@@ -464,4 +598,4 @@ class PlImporter:
             if stale:
                 self.logger.info("PlImporter: deleting stale record: %s" % record)
                 global_dbsession.delete(record)
-                global_dbsession.commit()
+                self.counts['deleted'] = self.counts.get('deleted', 0) + 1
@@ -1,16 +1,37 @@
+from __future__ import with_statement
 import socket
+import threading
+import time
 from sfa.rspecs.version_manager import VersionManager
 from sfa.util.version import version_core
 from sfa.util.xrn import Xrn
 from sfa.util.callids import Callids
 from sfa.util.sfalogging import logger
 from sfa.util.faults import SfaInvalidArgument, InvalidRSpecVersion
+from sfa.util.cache import DEFAULT_CACHE_TTL
 from sfa.server.api_versions import ApiVersions
 
 
 class AggregateManager:
 
-    def __init__ (self, config): pass
+    # the advertisements that the pre-warm thread keeps ready in the cache
+    prewarm_variants = [ ({'type': 'SFA', 'version': '1'}, {}),
+                         ({'type': 'GENI', 'version': '3'}, {}),
+                         ({'type': 'GENI', 'version': '3'}, {'list_leases': 'resources'}),
+                         ({'type': 'GENI', 'version': '3'}, {'list_leases': 'leases'}),
+                         ({'type': 'GENI', 'version': '3'}, {'list_leases': 'all'}),
+                         ]
+    # one pre-warm thread per process
+    prewarm_thread = None
+    prewarm_lock = threading.Lock()
+
+    def __init__ (self, config):
+        # how long an advertisement remains fresh in the cache, and for how
+        # long after that it still gets served while a new one is built
+        self.cache_ttl = getattr(config, 'SFA_AGGREGATE_CACHE_TTL', DEFAULT_CACHE_TTL)
+        self.cache_grace = getattr(config, 'SFA_AGGREGATE_CACHE_GRACE', 600)
+        # seconds between 2 pre-warm rounds, 0 to disable
+        self.prewarm_period = getattr(config, 'SFA_AGGREGATE_CACHE_PREWARM', 0)
     
     # essentially a union of the core version, the generic version (this code) and
     # whatever the driver needs to expose
@@ -81,19 +102,69 @@ class AggregateManager:
         rspec_version = version_manager.get_version(options.get('geni_rspec_version'))
         version_string = self.get_rspec_version_string(rspec_version, options)
 
+        if not api.driver.cache:
+            return api.driver.list_resources (rspec_version, options)
+
+        context = getattr(api, 'context', None)
+        if context is not None:
+            self.start_prewarm(context)
+
+        def build():
+            logger.debug("%s.ListResources builds advertisement" % (api.driver.__module__))
+            return api.driver.list_resources (rspec_version, options)
+
         # look in cache first
         cached_requested = options.get('cached', True)
-        if cached_requested and api.driver.cache:
-            rspec = api.driver.cache.get(version_string)
-            if rspec:
-                logger.debug("%s.ListResources returning cached advertisement" % (api.driver.__module__))
-                return rspec
-       
-        rspec = api.driver.list_resources (rspec_version, options) 
-        if api.driver.cache:
-            logger.debug("%s.ListResources stores advertisement in cache" % (api.driver.__module__))
-            api.driver.cache.add(version_string, rspec)    
-        return rspec
+        if not cached_requested:
+            return api.driver.cache.rebuild(version_string, build, self.cache_ttl, self.cache_grace)
+
+        # a stale advertisement gets rebuilt in the background, with a driver of its own
+        refresh = None
+        if context is not None:
+            refresh = self.refresher(context, rspec_version, options)
+        return api.driver.cache.get_or_build(version_string, build, self.cache_ttl, self.cache_grace, refresh)
+
+    # a callable that builds an advertisement from any thread
+    def refresher(self, context, rspec_version, options):
+        options = dict(options)
+        def refresh():
+            try:
+                driver = context.get_driver()
+                logger.debug("%s.ListResources refreshes advertisement" % (driver.__module__))
+                return driver.list_resources (rspec_version, options)
+            finally:
+                context.close_dbsession()
+        return refresh
+
+    def start_prewarm(self, context):
+        if not self.prewarm_period or AggregateManager.prewarm_thread is not None:
+            return
+        with AggregateManager.prewarm_lock:
+            if AggregateManager.prewarm_thread is not None:
+                return
+            thread = threading.Thread(target=self.prewarm_forever, args=(context,),
+                                      name="AggregatePrewarm")
+            thread.setDaemon(True)
+            thread.start()
+            AggregateManager.prewarm_thread = thread
+
+    # rebuild the common advertisements on a regular basis, so that
+    # the callers of ListResources never have to wait for them
+    def prewarm_forever(self, context):
+        version_manager = VersionManager()
+        while True:
+            for (version, options) in self.prewarm_variants:
+                try:
+                    cache = context.get_driver().cache
+                    if not cache:
+                        return
+                    rspec_version = version_manager.get_version(version)
+                    version_string = self.get_rspec_version_string(rspec_version, options)
+                    cache.rebuild(version_string, self.refresher(context, rspec_version, options),
+                                  self.cache_ttl, self.cache_grace)
+                except Exception:
+                    logger.log_exc("AggregateManager: could not pre-warm %r %r" % (version, options))
+            time.sleep(self.prewarm_period)
     
     def Describe(self, api, creds, urns, options):
         call_id = options.get('call_id')
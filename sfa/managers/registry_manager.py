@@ -20,9 +20,10 @@ from sfa.trust.certificate import Certificate, Keypair, convert_public_key
 from sfa.trust.gid import create_uuid
 
 from sfa.storage.model import make_record, RegRecord, RegAuthority, RegUser, RegSlice, RegKey, \
-    augment_with_sfa_builtins
+    augment_with_sfa_builtins, augment_records_with_sfa_builtins, iter_records_with_sfa_builtins
 ### the types that we need to exclude from sqlobjects before being able to dump
 # them on the xmlrpc wire
+from sqlalchemy import and_, or_
 from sqlalchemy.orm.collections import InstrumentedList
 
 ### historical note -- april 2014
@@ -135,7 +136,7 @@ class RegistryManager:
         new_cred = Credential(subject = object_gid.get_subject())
         new_cred.set_gid_caller(caller_gid)
         new_cred.set_gid_object(object_gid)
-        new_cred.set_issuer_keys(auth_info.get_privkey_filename(), auth_info.get_gid_filename())
+        new_cred.set_issuer_keys(auth_info.get_pkey_object(), auth_info.get_gid_object())
         #new_cred.set_pubkey(object_gid.get_pubkey())
         new_cred.set_privileges(rights)
         new_cred.get_privileges().delegate_all_privileges(True)
@@ -209,8 +210,7 @@ class RegistryManager:
             local_records = local_records.filter_by(type=type)
         local_records=local_records.all()
         
-        for local_record in local_records:
-            augment_with_sfa_builtins (local_record)
+        augment_records_with_sfa_builtins (local_records)
 
         logger.info("Resolve, (details=%s,type=%s) local_records=%s "%(details,type,local_records))
         local_dicts = [ record.__dict__ for record in local_records ]
@@ -259,7 +259,8 @@ class RegistryManager:
         # if the best match (longest matching hrn) is not the local registry,
         # forward the request
         record_dicts = []    
-        if registry_hrn != api.hrn:
+        forwarded = registry_hrn != api.hrn
+        if forwarded:
             credential = api.getCredential()
             interface = api.registries[registry_hrn]
             server_proxy = api.server_proxy(interface, credential)
@@ -268,9 +269,10 @@ class RegistryManager:
             # pass foreign records as-is
             record_dicts = record_list
         
-        # if we still have not found the record yet, try the local registry
+        # otherwise the records are local - an empty answer from the remote
+        # registry, e.g. past its last page, is an answer too
 #        logger.debug("before trying local records, %d foreign records"% len(record_dicts))
-        if not record_dicts:
+        if not forwarded:
             recursive = False
             if ('recursive' in options and options['recursive']):
                 recursive = True
@@ -281,14 +283,31 @@ class RegistryManager:
             if not api.auth.hierarchy.auth_exists(hrn):
                 raise MissingAuthority(hrn)
             if recursive:
-                records = dbsession.query(RegRecord).filter(RegRecord.hrn.startswith(hrn)).all()
-#                logger.debug("recursive mode, found %d local records"%(len(records)))
+                query = dbsession.query(RegRecord).filter(RegRecord.hrn.startswith(hrn))
             else:
-                records = dbsession.query(RegRecord).filter_by(authority=hrn).all()
-#                logger.debug("non recursive mode, found %d local records"%(len(records)))
+                query = dbsession.query(RegRecord).filter_by(authority=hrn)
+            # paginated mode: at most options['limit'] records, by (hrn, type),
+            # starting right after options['marker'] - i.e. the [hrn, type] of the
+            # last record of the previous page; a page shorter than limit is the last one
+            limit = options.get('limit')
+            if limit:
+                query = query.order_by(RegRecord.hrn, RegRecord.type)
+                marker = options.get('marker')
+                if marker:
+                    # an hrn alone stands for all the records with that hrn
+                    if isinstance(marker, (list, tuple)):
+                        (marker_hrn, marker_type) = marker
+                        query = query.filter(or_(RegRecord.hrn > marker_hrn,
+                                                 and_(RegRecord.hrn == marker_hrn,
+                                                      RegRecord.type > marker_type)))
+                    else:
+                        query = query.filter(RegRecord.hrn > marker)
+                query = query.limit(int(limit))
             # so that sfi list can show more than plain names...
-            for record in records: augment_with_sfa_builtins (record)
-            record_dicts=[ record.todict(exclude_types=[InstrumentedList]) for record in records ]
+            for records in iter_records_with_sfa_builtins (query):
+                record_dicts += [ record.todict(exclude_types=[InstrumentedList]) for record in records ]
+                # the records are not needed anymore, just their dicts
+                for record in records: dbsession.expunge(record)
     
         return record_dicts
     
@@ -368,12 +387,13 @@ class RegistryManager:
         # make sure record has a gid
         if not record.gid:
             uuid = create_uuid()
-            pkey = Keypair(create=True)
             pub_key=getattr(record,'reg-keys',None)
             if pub_key is not None:
                 # use only first key in record
                 if pub_key and isinstance(pub_key, types.ListType): pub_key = pub_key[0]
                 pkey = convert_public_key(pub_key)
+            else:
+                pkey = Keypair(create=True)
     
             email=getattr(record,'email',None)
             gid_object = api.auth.hierarchy.create_gid(urn, uuid, pkey, email = email)
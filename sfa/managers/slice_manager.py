@@ -9,12 +9,13 @@ from sfa.trust.sfaticket import SfaTicket
 from sfa.trust.credential import Credential
 
 from sfa.util.sfalogging import logger
+from sfa.util.faults import SfaAPIError
 from sfa.util.xrn import Xrn, urn_to_hrn
 from sfa.util.version import version_core
 from sfa.util.callids import Callids
 from sfa.util.cache import Cache
 
-from sfa.client.multiclient import MultiClient
+from sfa.client.multiclient import MultiClient, Executor
 
 from sfa.rspecs.rspec_converter import RSpecConverter
 from sfa.rspecs.version_manager import VersionManager
@@ -32,8 +33,15 @@ class SliceManager:
         self.cache=None
         if config.SFA_SM_CACHING:
             if SliceManager.cache is None:
-                SliceManager.cache = Cache()
+                SliceManager.cache = Cache(namespace='slicemgr', config=config)
             self.cache = SliceManager.cache
+        # how long we wait for the aggregates, in seconds
+        self.timeout = getattr(config, 'SFA_SM_TIMEOUT', 120) or None
+        Executor().configure(max_workers=getattr(config, 'SFA_SM_WORKERS', 50),
+                             max_per_key=getattr(config, 'SFA_SM_AGGREGATE_CALLS', 4))
+
+    def multiclient (self):
+        return MultiClient(timeout=self.timeout)
         
     def GetVersion(self, api, options):
         # peers explicitly in aggregates.xml
@@ -101,6 +109,24 @@ class SliceManager:
 
         except Exception, e:
             logger.warn("add_slicemgr_stat failed on  %s: %s" %(aggname, str(e)))
+
+    # the aggregates that did not answer before the deadline
+    def add_slicemgr_timeouts(self, rspec, callname, multiclient):
+        for (aggname, elapsed) in multiclient.get_timeouts():
+            self.add_slicemgr_stat(rspec, callname, aggname, elapsed, "timeout")
+
+    # same, as sliver entries for the calls that return geni_slivers
+    def timeout_slivers(self, multiclient):
+        return [ {'geni_sliver_urn': Xrn(aggname, type='authority').get_urn(),
+                  'geni_error': "aggregate %s timed out after %ds" % (aggname, elapsed)}
+                 for (aggname, elapsed) in multiclient.get_timeouts() ]
+
+    # same, for the calls that only return 1
+    def raise_timeouts(self, callname, multiclient):
+        timeouts = multiclient.get_timeouts()
+        if timeouts:
+            raise SfaAPIError("%s: %s" % (callname, ", ".join(["aggregate %s timed out after %ds" % (aggname, elapsed)
+                                                               for (aggname, elapsed) in timeouts])))
     
     def ListResources(self, api, creds, options):
         call_id = options.get('call_id') 
@@ -147,7 +173,7 @@ class SliceManager:
         cred = api.getDelegatedCredential(creds)
         if not cred:
             cred = api.getCredential()
-        multiclient = MultiClient()
+        multiclient = self.multiclient()
         for aggregate in api.aggregates:
             # prevent infinite loop. Dont send request back to caller
             # unless the caller is the aggregate's SM
@@ -157,17 +183,17 @@ class SliceManager:
             # get the rspec from the aggregate
             interface = api.aggregates[aggregate]
             server = api.server_proxy(interface, cred)
-            multiclient.run(_ListResources, aggregate, server, [cred], options)
+            multiclient.run_for(aggregate, _ListResources, aggregate, server, [cred], options)
     
     
-        results = multiclient.get_results()
         rspec_version = version_manager.get_version(options.get('geni_rspec_version'))
         if xrn:    
             result_version = version_manager._get_version(rspec_version.type, rspec_version.version, 'manifest')
         else: 
             result_version = version_manager._get_version(rspec_version.type, rspec_version.version, 'ad')
         rspec = RSpec(version=result_version)
-        for result in results:
+        # merge each aggregate's rspec as soon as it comes back
+        for result in multiclient.iter_results():
             self.add_slicemgr_stat(rspec, "ListResources", result["aggregate"], result["elapsed"], 
                                    result["status"], result.get("exc_info",None))
             if result["status"]=="success":
@@ -176,13 +202,15 @@ class SliceManager:
                     rspec.version.merge(ReturnValue.get_value(res))
                 except:
                     api.logger.log_exc("SM.ListResources: Failed to merge aggregate rspec")
+        self.add_slicemgr_timeouts(rspec, "ListResources", multiclient)
     
-        # cache the result
+        # cache the result - the very string returned, see ListResources
+        advertisement = rspec.toxml()
         if self.cache and not xrn:
             api.logger.debug("SliceManager.ListResources caches advertisement")
-            self.cache.add(version_string, rspec.toxml())
+            self.cache.add(version_string, advertisement)
     
-        return rspec.toxml()
+        return advertisement
 
 
     def Allocate(self, api, xrn, creds, rspec_str, expiration, options):
@@ -230,7 +258,7 @@ class SliceManager:
         hrn, type = urn_to_hrn(xrn)
         valid_cred = api.auth.checkCredentials(creds, 'createsliver', hrn)[0]
         caller_hrn = Credential(cred=valid_cred).get_gid_caller().get_hrn()
-        multiclient = MultiClient()
+        multiclient = self.multiclient()
         for aggregate in api.aggregates:
             # prevent infinite loop. Dont send request back to caller
             # unless the caller is the aggregate's SM 
@@ -239,7 +267,7 @@ class SliceManager:
             interface = api.aggregates[aggregate]
             server = api.server_proxy(interface, cred)
             # Just send entire RSpec to each aggregate
-            multiclient.run(_Allocate, aggregate, server, xrn, [cred], rspec.toxml(), options)
+            multiclient.run_for(aggregate, _Allocate, aggregate, server, xrn, [cred], rspec.toxml(), options)
                 
         results = multiclient.get_results()
         manifest_version = version_manager._get_version(rspec.version.type, rspec.version.version, 'manifest')
@@ -247,6 +275,7 @@ class SliceManager:
         geni_urn = None
         geni_slivers = []
 
+        self.add_slicemgr_timeouts(result_rspec, "Allocate", multiclient)
         for result in results:
             self.add_slicemgr_stat(result_rspec, "Allocate", result["aggregate"], result["elapsed"], 
                                    result["status"], result.get("exc_info",None))
@@ -290,7 +319,7 @@ class SliceManager:
         # get the callers hrn
         valid_cred = api.auth.checkCredentials(creds, 'createsliver', xrn)[0]
         caller_hrn = Credential(cred=valid_cred).get_gid_caller().get_hrn()
-        multiclient = MultiClient()
+        multiclient = self.multiclient()
         for aggregate in api.aggregates:
             # prevent infinite loop. Dont send request back to caller
             # unless the caller is the aggregate's SM
@@ -299,7 +328,7 @@ class SliceManager:
             interface = api.aggregates[aggregate]
             server = api.server_proxy(interface, cred)
             # Just send entire RSpec to each aggregate
-            multiclient.run(_Provision, aggregate, server, xrn, [cred], options)
+            multiclient.run_for(aggregate, _Provision, aggregate, server, xrn, [cred], options)
 
         results = multiclient.get_results()
         # Set the manifest of KOREN
@@ -308,6 +337,7 @@ class SliceManager:
         result_rspec = RSpec(version=manifest_version)
         geni_slivers = []
         geni_urn  = None  
+        self.add_slicemgr_timeouts(result_rspec, "Provision", multiclient)
         for result in results:
             self.add_slicemgr_stat(result_rspec, "Provision", result["aggregate"], result["elapsed"],
                                    result["status"], result.get("exc_info",None))
@@ -319,6 +349,7 @@ class SliceManager:
                     geni_slivers.extend(res['geni_slivers'])
                 except:
                     api.logger.log_exc("SM.Provision: Failed to merge aggregate rspec")
+        geni_slivers.extend(timeouts)
         return {
             'geni_urn': geni_urn,
             'geni_rspec': result_rspec.toxml(),
@@ -352,7 +383,7 @@ class SliceManager:
         cred = api.getDelegatedCredential(creds)
         if not cred:
             cred = api.getCredential(minimumExpiration=31*86400)
-        multiclient = MultiClient()
+        multiclient = self.multiclient()
         for aggregate in api.aggregates:
             # prevent infinite loop. Dont send request back to caller
             # unless the caller is the aggregate's SM
@@ -360,9 +391,12 @@ class SliceManager:
                 continue
             interface = api.aggregates[aggregate]
             server = api.server_proxy(interface, cred)
-            multiclient.run(_Renew, aggregate, server, xrn, [cred], expiration_time, options)
+            multiclient.run_for(aggregate, _Renew, aggregate, server, xrn, [cred], expiration_time, options)
 
         results = multiclient.get_results()
+        for (aggregate, elapsed) in multiclient.get_timeouts():
+            results.append({'aggregate': aggregate, 'code': {'geni_code': -1},
+                            'value': False, 'output': "timed out after %ds" % elapsed})
 
         geni_code = 0
         geni_output = ",".join([x.get('output',"") for x in results])
@@ -392,7 +426,7 @@ class SliceManager:
         cred = api.getDelegatedCredential(creds)
         if not cred:
             cred = api.getCredential()
-        multiclient = MultiClient()
+        multiclient = self.multiclient()
         for aggregate in api.aggregates:
             # prevent infinite loop. Dont send request back to caller
             # unless the caller is the aggregate's SM
@@ -400,11 +434,12 @@ class SliceManager:
                 continue
             interface = api.aggregates[aggregate]
             server = api.server_proxy(interface, cred)
-            multiclient.run(_Delete, server, xrn, [cred], options)
+            multiclient.run_for(aggregate, _Delete, server, xrn, [cred], options)
         
         results = []
         for result in multiclient.get_results():
             results += ReturnValue.get_value(result)
+        results += self.timeout_slivers(multiclient)
         return results
     
     
@@ -419,18 +454,21 @@ class SliceManager:
         cred = api.getDelegatedCredential(creds)
         if not cred:
             cred = api.getCredential()
-        multiclient = MultiClient()
+        multiclient = self.multiclient()
         for aggregate in api.aggregates:
             interface = api.aggregates[aggregate]
             server = api.server_proxy(interface, cred)
-            multiclient.run (_Status, server, slice_xrn, [cred], options)
+            multiclient.run_for(aggregate, _Status, server, slice_xrn, [cred], options)
         results = [ReturnValue.get_value(result) for result in multiclient.get_results()]
     
         # get rid of any void result - e.g. when call_id was hit, where by convention we return {}
         results = [ result for result in results if result and result['geni_slivers']]
+        timeouts = self.timeout_slivers(multiclient)
     
         # do not try to combine if there's no result
-        if not results : return {}
+        if not results :
+            if not timeouts: return {}
+            return {'geni_urn': slice_xrn, 'geni_slivers': timeouts}
     
         # otherwise let's merge stuff
         geni_slivers = []
@@ -441,6 +479,7 @@ class SliceManager:
                 geni_slivers.extend(result['geni_slivers'])
             except:
                 api.logger.log_exc("SM.Provision: Failed to merge aggregate rspec")
+        geni_slivers.extend(timeouts)
         return {
             'geni_urn': geni_urn,
             'geni_slivers': geni_slivers
@@ -457,18 +496,21 @@ class SliceManager:
         cred = api.getDelegatedCredential(creds)
         if not cred:
             cred = api.getCredential()
-        multiclient = MultiClient()
+        multiclient = self.multiclient()
         for aggregate in api.aggregates:
             interface = api.aggregates[aggregate]
             server = api.server_proxy(interface, cred)
-            multiclient.run (_Describe, server, xrns, [cred], options)
+            multiclient.run_for(aggregate, _Describe, server, xrns, [cred], options)
         results = [ReturnValue.get_value(result) for result in multiclient.get_results()]
 
         # get rid of any void result - e.g. when call_id was hit, where by convention we return {}
         results = [ result for result in results if result and result.get('geni_urn')]
+        timeouts = self.timeout_slivers(multiclient)
 
         # do not try to combine if there's no result
-        if not results : return {}
+        if not results :
+            if not timeouts: return {}
+            return {'geni_urn': xrns[0], 'geni_rspec': "", 'geni_slivers': timeouts}
 
         # otherwise let's merge stuff
         version_manager = VersionManager()
@@ -498,7 +540,7 @@ class SliceManager:
         cred = api.getDelegatedCredential(creds)
         if not cred:
             cred = api.getCredential()
-        multiclient = MultiClient()
+        multiclient = self.multiclient()
         for aggregate in api.aggregates:
             # prevent infinite loop. Dont send request back to caller
             # unless the caller is the aggregate's SM
@@ -506,8 +548,9 @@ class SliceManager:
                 continue
             interface = api.aggregates[aggregate]
             server = api.server_proxy(interface, cred)    
-            multiclient.run(server.PerformOperationalAction, xrn, [cred], action, options)
+            multiclient.run_for(aggregate, server.PerformOperationalAction, xrn, [cred], action, options)
         multiclient.get_results()    
+        self.raise_timeouts('PerformOperationalAction', multiclient)
         return 1
      
     def Shutdown(self, api, xrn, creds, options=None):
@@ -521,7 +564,7 @@ class SliceManager:
         cred = api.getDelegatedCredential(creds)
         if not cred:
             cred = api.getCredential()
-        multiclient = MultiClient()
+        multiclient = self.multiclient()
         for aggregate in api.aggregates:
             # prevent infinite loop. Dont send request back to caller
             # unless the caller is the aggregate's SM
@@ -529,7 +572,8 @@ class SliceManager:
                 continue
             interface = api.aggregates[aggregate]
             server = api.server_proxy(interface, cred)
-            multiclient.run(server.Shutdown, xrn.urn, cred)
+            multiclient.run_for(aggregate, server.Shutdown, xrn.urn, cred)
         multiclient.get_results()    
+        self.raise_timeouts('Shutdown', multiclient)
         return 1
     
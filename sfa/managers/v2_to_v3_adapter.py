@@ -28,7 +28,7 @@ class V2ToV3Adapter:
             if self.driver.cache:
                 self.cache = self.driver.cache
             else:
-                self.cache = Cache()
+                self.cache = Cache(namespace='aggregate', config=config)
 
 
     def __getattr__(self, name):
@@ -2,12 +2,16 @@ import zlib
 
 from sfa.util.xrn import urn_to_hrn
 from sfa.util.method import Method
-from sfa.util.sfatablesRuntime import run_sfatables
+from sfa.util.sfatablesRuntime import run_sfatables, sfatables_chain_empty, sfatables_chain_signature
+from sfa.util.cache import cache_derive
 from sfa.util.faults import SfaInvalidArgument
 from sfa.trust.credential import Credential
 
 from sfa.storage.parameter import Parameter, Mixed
 
+def compress_rspec(rspec):
+    return zlib.compress(rspec).encode('base64')
+
 class ListResources(Method):
     """
     Returns information about available resources
@@ -48,10 +52,22 @@ class ListResources(Method):
         elif self.api.interface in ['slicemgr']: 
             chain_name = 'FORWARD-OUTGOING'
         self.api.logger.debug("ListResources: sfatables on chain %s"%chain_name)
-        filtered_rspec = run_sfatables(chain_name, '', origin_hrn, rspec) 
+        # the advertisements come from the managers' caches, so we see the
+        # same ones over and over again; their filtered and compressed forms
+        # are kept in the cache along with them
+        filter_key = None
+        if sfatables_chain_empty(chain_name):
+            filtered_rspec = rspec
+        else:
+            # the outcome only depends on the rspec, the rules and the caller
+            filter_key = (chain_name, sfatables_chain_signature(chain_name), origin_hrn)
+            filtered_rspec = cache_derive(rspec, filter_key,
+                lambda: run_sfatables(chain_name, '', origin_hrn, rspec))
  
         if options.has_key('geni_compressed') and options['geni_compressed'] == True:
-            filtered_rspec = zlib.compress(filtered_rspec).encode('base64')
+            unzipped_rspec = filtered_rspec
+            filtered_rspec = cache_derive(rspec, ('geni_compressed', filter_key),
+                lambda: compress_rspec(unzipped_rspec))
 
         return filtered_rspec  
     
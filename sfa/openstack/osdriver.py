@@ -56,7 +56,7 @@ class OpenstackDriver(Driver):
         self.cache=None
         if config.SFA_AGGREGATE_CACHING:
             if OpenstackDriver.cache is None:
-                OpenstackDriver.cache = Cache()
+                OpenstackDriver.cache = Cache(namespace='aggregate', config=config)
             self.cache = OpenstackDriver.cache
 
     def sliver_to_slice_xrn(self, xrn):
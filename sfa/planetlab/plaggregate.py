@@ -1,5 +1,6 @@
 #!/usr/bin/python
-from collections import defaultdict
+from __future__ import with_statement
+from collections import defaultdict, OrderedDict
 from sfa.util.xrn import Xrn, hrn_to_urn, urn_to_hrn, get_authority, get_leaf
 from sfa.util.sfatime import utcparse, datetime_to_string
 from sfa.util.sfalogging import logger
@@ -21,10 +22,12 @@ from sfa.rspecs.version_manager import VersionManager
 from sfa.planetlab.plxrn import PlXrn, hostname_to_urn
 from sfa.planetlab.vlink import get_tc_rate
 from sfa.planetlab.topology import Topology
+from sfa.planetlab.plleases import LeaseIndex
 from sfa.storage.model import SliverAllocation
 
 
 import time
+import threading
 
 class PlAggregate:
 
@@ -44,7 +47,7 @@ class PlAggregate:
     def get_sites(self, filter=None):
         if filter is None: filter={}
         sites = {}
-        for site in self.driver.shell.GetSites(filter):
+        for site in self.driver.mirror.GetSites(filter):
             sites[site['site_id']] = site
         return sites
 
@@ -58,47 +61,80 @@ class PlAggregate:
             interfaces[interface['interface_id']] = interface
         return interfaces
 
-    def get_links(self, sites, nodes, interfaces):
-        
-        topology = Topology() 
-        links = []
+    # the links computed lately, by aggregate hrn and what they were computed
+    # from - listresources and the describes of the various slices ask for
+    # different sets of sites and nodes; the least recently used go first
+    _links = OrderedDict()
+    _links_lock = threading.Lock()
+    links_cache_size = 16
+
+    def get_links(self, sites, nodes, interfaces, topology=None):
+        if topology is None:
+            topology = Topology() 
+
+        # the site pairs that links can be made for
+        pairs = []
+        site_ids = set()
         for (site_id1, site_id2) in topology:
             site_id1 = int(site_id1)
             site_id2 = int(site_id2)
-            link = Link()
             if not site_id1 in sites or site_id2 not in sites:
                 continue
+            pairs.append( (site_id1, site_id2) )
+            site_ids.update( [site_id1, site_id2] )
+
+        # just get first interface of the nodes at these sites
+        node_ips = {}
+        for site_id in site_ids:
+            for node_id in sites[site_id]['node_ids']:
+                node = nodes.get(node_id)
+                if node is None or not node['interface_ids']:
+                    continue
+                interface = interfaces.get(node['interface_ids'][0])
+                if interface is not None:
+                    node_ips[node_id] = interface['ip']
+
+        # links only depend on this, so they are computed again only when it changes
+        signature = (frozenset(pairs), 
+                     frozenset([ (site_id, sites[site_id]['login_base'], tuple(sites[site_id]['node_ids']))
+                                 for site_id in site_ids ]),
+                     frozenset(node_ips.items()))
+        key = (self.driver.hrn, signature)
+        with PlAggregate._links_lock:
+            links = PlAggregate._links.pop(key, None)
+            if links is not None:
+                PlAggregate._links[key] = links
+                return links
+
+        # one interface record per node, shared by all the links it is part of
+        node_interfaces = {}
+        for (node_id, ip) in node_ips.items():
+            if_xrn = PlXrn(auth=self.driver.hrn, interface='node%s:eth0' % node_id)
+            node_interfaces[node_id] = Interface({'component_id': if_xrn.urn, 'ipv4': ip})
+
+        component_manager_id = hrn_to_urn(self.driver.hrn, 'authority+am')
+        links = []
+        for (site_id1, site_id2) in pairs:
             site1 = sites[site_id1]
             site2 = sites[site_id2]
-            # get hrns
-            site1_hrn = self.driver.hrn + '.' + site1['login_base']
-            site2_hrn = self.driver.hrn + '.' + site2['login_base']
-
-            for s1_node_id in site1['node_ids']:
-                for s2_node_id in site2['node_ids']:
-                    if s1_node_id not in nodes or s2_node_id not in nodes:
-                        continue
-                    node1 = nodes[s1_node_id]
-                    node2 = nodes[s2_node_id]
-                    # set interfaces
-                    # just get first interface of the first node
-                    if1_xrn = PlXrn(auth=self.driver.hrn, interface='node%s:eth0' % (node1['node_id']))
-                    if1_ipv4 = interfaces[node1['interface_ids'][0]]['ip']
-                    if2_xrn = PlXrn(auth=self.driver.hrn, interface='node%s:eth0' % (node2['node_id']))
-                    if2_ipv4 = interfaces[node2['interface_ids'][0]]['ip']
-
-                    if1 = Interface({'component_id': if1_xrn.urn, 'ipv4': if1_ipv4} )
-                    if2 = Interface({'component_id': if2_xrn.urn, 'ipv4': if2_ipv4} )
-
-                    # set link
-                    link = Link({'capacity': '1000000', 'latency': '0', 'packet_loss': '0', 'type': 'ipv4'})
+            component_name = "%s:%s" % (site1['login_base'], site2['login_base'])
+            fields = {'capacity': '1000000', 'latency': '0', 'packet_loss': '0', 'type': 'ipv4',
+                      'component_name': component_name,
+                      'component_id': PlXrn(auth=self.driver.hrn, interface=component_name).get_urn(),
+                      'component_manager_id': component_manager_id}
+            interfaces1 = [ node_interfaces[node_id] for node_id in site1['node_ids'] if node_id in node_interfaces ]
+            interfaces2 = [ node_interfaces[node_id] for node_id in site2['node_ids'] if node_id in node_interfaces ]
+            for if1 in interfaces1:
+                for if2 in interfaces2:
+                    link = Link(fields)
                     link['interface1'] = if1
                     link['interface2'] = if2
-                    link['component_name'] = "%s:%s" % (site1['login_base'], site2['login_base'])
-                    link['component_id'] = PlXrn(auth=self.driver.hrn, interface=link['component_name']).get_urn()
-                    link['component_manager_id'] =  hrn_to_urn(self.driver.hrn, 'authority+am')
                     links.append(link)
 
+        with PlAggregate._links_lock:
+            PlAggregate._links[key] = links
+            while len(PlAggregate._links) > self.links_cache_size:
+                PlAggregate._links.popitem(last=False)
         return links
 
     def get_node_tags(self, filter=None):
@@ -143,7 +179,7 @@ class PlAggregate:
             filter['slice_id'] = list(slice_ids)
         # get all slices
         fields = ['slice_id', 'name', 'hrn', 'person_ids', 'node_ids', 'slice_tag_ids', 'expires']
-        all_slices = self.driver.shell.GetSlices(filter, fields)
+        all_slices = self.driver.mirror.GetSlices(filter, fields)
         if slice_hrn:
             slices = [slice for slice in all_slices if slice['hrn'] == slice_hrn]
         else:
@@ -164,7 +200,7 @@ class PlAggregate:
         for slice in slices:
             person_ids.extend(slice['person_ids'])
         if person_ids:
-            persons = self.driver.shell.GetPersons(person_ids)
+            persons = self.driver.mirror.GetPersons(person_ids)
                  
         # get user keys
         keys = {}
@@ -173,14 +209,14 @@ class PlAggregate:
             key_ids.extend(person['key_ids'])
         
         if key_ids:
-            key_list = self.driver.shell.GetKeys(key_ids)
+            key_list = self.driver.mirror.GetKeys(key_ids)
             for key in key_list:
                 keys[key['key_id']] = key  
 
         # construct user key info
         users = []
         for person in persons:
-            person_urn = hrn_to_urn(self.driver.shell.GetPersonHrn(int(person['person_id'])), 'user')
+            person_urn = hrn_to_urn(self.driver.mirror.GetPersonHrn(int(person['person_id'])), 'user')
             user = {
                 'login': slice['name'], 
                 'user_urn': person_urn,
@@ -315,7 +351,7 @@ class PlAggregate:
         geni_available = options.get('geni_available')
         if geni_available == True:
             filter['boot_state'] = 'boot'
-        nodes = self.driver.shell.GetNodes(filter)
+        nodes = self.driver.mirror.GetNodes(filter)
         for node in nodes:
             nodes_dict[node['node_id']] = node
         return nodes_dict
@@ -353,33 +389,22 @@ class PlAggregate:
     def get_leases(self, slice=None, options=None):
         if options is None: options={}
         
+        # leases and the hrns they refer to come from the shared index,
+        # rather than from 2 PLCAPI calls per lease
+        lease_index = LeaseIndex(self.driver)
         now = int(time.time())
-        filter={}
-        filter.update({'clip':now})
         if slice:
-           filter.update({'name':slice['name']})
-        return_fields = ['lease_id', 'hostname', 'site_id', 'name', 't_from', 't_until']
-        leases = self.driver.shell.GetLeases(filter)
-        grain = self.driver.shell.GetLeaseGranularity()
-
-        site_ids = []
-        for lease in leases:
-            site_ids.append(lease['site_id'])
+            leases = lease_index.get_leases_with_hrns(self.driver.shell, slice_name=slice['name'], t_from=now)
+        else:
+            leases = lease_index.get_leases_with_hrns(self.driver.shell, t_from=now)
+        grain = lease_index.get_grain(self.driver.shell)
 
-        # get sites
-        sites_dict  = self.get_sites({'site_id': site_ids}) 
-  
         rspec_leases = []
-        for lease in leases:
+        for (lease, node_hrn, slice_hrn) in leases:
 
             rspec_lease = Lease()
             
-            # xxx how to retrieve site['login_base']
-            site_id=lease['site_id']
-            site=sites_dict[site_id]
-
-            rspec_lease['component_id'] = hrn_to_urn(self.driver.shell.GetNodeHrn(lease['hostname']), 'node')
-            slice_hrn = self.driver.shell.GetSliceHrn(lease['slice_id'])
+            rspec_lease['component_id'] = hrn_to_urn(node_hrn, 'node')
             slice_urn = hrn_to_urn(slice_hrn, 'slice')
             rspec_lease['slice_id'] = slice_urn
             rspec_lease['start_time'] = lease['t_from']
@@ -24,6 +24,8 @@ from sfa.planetlab.plshell import PlShell
 from sfa.planetlab.plaggregate import PlAggregate
 from sfa.planetlab.plslices import PlSlices
 from sfa.planetlab.plxrn import PlXrn, slicename_to_hrn, hostname_to_hrn, hrn_to_pl_slicename, top_auth, hash_loginbase
+from sfa.planetlab.plleases import LeaseIndex
+from sfa.planetlab.plmirror import PlMirror, PlMirrorShell
 
 
 def list_to_dict(recs, key):
@@ -47,10 +49,15 @@ class PlDriver (Driver):
         Driver.__init__ (self, api)
         config=api.config
         self.shell = PlShell (config)
+        # reads that can be served from memory, see PlMirror
+        if getattr(config, 'SFA_PLC_MIRROR', True):
+            self.mirror = PlMirrorShell (PlMirror (config.SFA_PLC_URL), self.shell)
+        else:
+            self.mirror = self.shell
         self.cache=None
         if config.SFA_AGGREGATE_CACHING:
             if PlDriver.cache is None:
-                PlDriver.cache = Cache()
+                PlDriver.cache = Cache(namespace='aggregate', config=config)
             self.cache = PlDriver.cache
 
     def sliver_to_slice_xrn(self, xrn):
@@ -359,16 +366,16 @@ class PlDriver (Driver):
         # get pl records
         nodes, sites, slices, persons, keys = {}, {}, {}, {}, {}
         if node_ids:
-            node_list = self.shell.GetNodes({'peer_id': None, 'node_id': node_ids})
+            node_list = self.mirror.GetNodes({'peer_id': None, 'node_id': node_ids})
             nodes = list_to_dict(node_list, 'node_id')
         if site_ids:
-            site_list = self.shell.GetSites({'peer_id': None, 'site_id': site_ids})
+            site_list = self.mirror.GetSites({'peer_id': None, 'site_id': site_ids})
             sites = list_to_dict(site_list, 'site_id')
         if slice_ids:
-            slice_list = self.shell.GetSlices({'peer_id': None, 'slice_id': slice_ids})
+            slice_list = self.mirror.GetSlices({'peer_id': None, 'slice_id': slice_ids})
             slices = list_to_dict(slice_list, 'slice_id')
         if person_ids:
-            person_list = self.shell.GetPersons({'peer_id': None, 'person_id': person_ids})
+            person_list = self.mirror.GetPersons({'peer_id': None, 'person_id': person_ids})
             persons = list_to_dict(person_list, 'person_id')
             for person in persons:
                 key_ids.extend(persons[person]['key_ids'])
@@ -377,7 +384,7 @@ class PlDriver (Driver):
                       'slice': slices, 'user': persons}
 
         if key_ids:
-            key_list = self.shell.GetKeys(key_ids)
+            key_list = self.mirror.GetKeys(key_ids)
             keys = list_to_dict(key_list, 'key_id')
 
         # fill record info
@@ -425,16 +432,16 @@ class PlDriver (Driver):
         # get pl records
         slices, persons, sites, nodes = {}, {}, {}, {}
         if site_ids:
-            site_list = self.shell.GetSites({'peer_id': None, 'site_id': site_ids}, ['site_id', 'login_base'])
+            site_list = self.mirror.GetSites({'peer_id': None, 'site_id': site_ids}, ['site_id', 'login_base'])
             sites = list_to_dict(site_list, 'site_id')
         if person_ids:
-            person_list = self.shell.GetPersons({'peer_id': None, 'person_id': person_ids}, ['person_id', 'email'])
+            person_list = self.mirror.GetPersons({'peer_id': None, 'person_id': person_ids}, ['person_id', 'email'])
             persons = list_to_dict(person_list, 'person_id')
         if slice_ids:
-            slice_list = self.shell.GetSlices({'peer_id': None, 'slice_id': slice_ids}, ['slice_id', 'name'])
+            slice_list = self.mirror.GetSlices({'peer_id': None, 'slice_id': slice_ids}, ['slice_id', 'name'])
             slices = list_to_dict(slice_list, 'slice_id')       
         if node_ids:
-            node_list = self.shell.GetNodes({'peer_id': None, 'node_id': node_ids}, ['node_id', 'hostname'])
+            node_list = self.mirror.GetNodes({'peer_id': None, 'node_id': node_ids}, ['node_id', 'hostname'])
             nodes = list_to_dict(node_list, 'node_id')
        
         # convert ids to hrns
@@ -499,7 +506,7 @@ class PlDriver (Driver):
         site_pis = {}
         if site_ids:
             pi_filter = {'peer_id': None, '|roles': ['pi'], '|site_ids': site_ids} 
-            pi_list = self.shell.GetPersons(pi_filter, ['person_id', 'site_ids'])
+            pi_list = self.mirror.GetPersons(pi_filter, ['person_id', 'site_ids'])
             for pi in pi_list:
                 # we will need the pi's hrns also
                 person_ids.append(pi['person_id'])
@@ -518,7 +525,7 @@ class PlDriver (Driver):
         
         # get the registry records
         person_list, persons = [], {}
-        person_list = self.api.dbsession().query (RegRecord).filter(RegRecord.pointer.in_(person_ids))
+        person_list = self.api.dbsession().query (RegRecord).filter_by(type='user').filter(RegRecord.pointer.in_(person_ids))
         # create a hrns keyed on the sfa record's pointer.
         # Its possible for multiple records to have the same pointer so
         # the dict's value will be a list of hrns.
@@ -528,7 +535,7 @@ class PlDriver (Driver):
 
         # get the pl records
         pl_person_list, pl_persons = [], {}
-        pl_person_list = self.shell.GetPersons(person_ids, ['person_id', 'roles'])
+        pl_person_list = self.mirror.GetPersons(person_ids, ['person_id', 'roles'])
         pl_persons = list_to_dict(pl_person_list, 'person_id')
 
         # fill sfa info
@@ -746,6 +753,7 @@ class PlDriver (Driver):
                 self.shell.DeleteSliceFromNodes(slice_id, node_ids)
                 if len(leases_ids) > 0:
                     self.shell.DeleteLeases(leases_ids)
+                    LeaseIndex(self).refresh_slice(self.shell, slice_name)
      
                 # delete sliver allocation states
                 dbsession=self.api.dbsession()
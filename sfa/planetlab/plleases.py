@@ -0,0 +1,184 @@
+from __future__ import with_statement
+
+import time
+import threading
+from bisect import insort
+
+from sfa.util.sfalogging import logger
+
+"""
+LeaseIndex: the current and future leases of a PLC, kept in memory
+one (singleton) instance per PLC, shared by PlAggregate.get_leases (and
+thus describe) and PlSlices.verify_slice_leases - thread-safe
+
+leases are indexed by hostname and by slice name, sorted by t_from;
+the node and slice hrns they refer to are resolved in bulk, and only
+for the objects that were not known yet
+
+the whole set is fetched again at most every refresh_period seconds;
+in between, leases that are over are dropped locally, and the leases
+of a given slice are re-read when SFA changes them
+"""
+
+class _lease_index:
+
+    _instances = {}
+    _instances_lock = threading.Lock()
+    # in seconds
+    refresh_period = 30
+
+    lease_fields = ['lease_id', 'hostname', 'node_id', 'site_id', 'slice_id', 'name', 't_from', 't_until']
+
+    def __init__(self, url):
+        self.url = url
+        self._lock = threading.RLock()
+        self._refreshed = 0
+        self.grain = None
+        self.leases_by_id = {}
+        self.by_hostname = {}
+        self.by_slice = {}
+        self.node_hrns = {}
+        self.slice_hrns = {}
+
+    def invalidate(self):
+        with self._lock:
+            self._refreshed = 0
+
+    def refresh(self, shell):
+        with self._lock:
+            now = int(time.time())
+            if self.grain is None:
+                self.grain = shell.GetLeaseGranularity()
+            if now - self._refreshed < self.refresh_period:
+                self._expire(now)
+                return
+            leases = shell.GetLeases({'clip': now}, self.lease_fields)
+            self._reset(leases)
+            self._refreshed = now
+            self._resolve_hrns(shell)
+            logger.debug("LeaseIndex: loaded %d leases from %s"%(len(leases), self.url))
+
+    # re-read the leases of one slice, e.g. after they have been changed
+    def refresh_slice(self, shell, slice_name):
+        with self._lock:
+            now = int(time.time())
+            if self.grain is None:
+                self.grain = shell.GetLeaseGranularity()
+            leases = shell.GetLeases({'name': slice_name, 'clip': now}, self.lease_fields)
+            for lease in self.by_slice.get(slice_name, [])[:]:
+                self._remove(lease)
+            for lease in leases:
+                self._add(lease)
+            self._resolve_hrns(shell)
+            return self._lookup(self.by_slice.get(slice_name, []), None, None)
+
+    def _reset(self, leases):
+        self.leases_by_id = {}
+        self.by_hostname = {}
+        self.by_slice = {}
+        for lease in leases:
+            self._add(lease)
+        # forget about the objects that no lease refers to anymore
+        for hostname in self.node_hrns.keys():
+            if hostname not in self.by_hostname:
+                del self.node_hrns[hostname]
+        slice_ids = set([lease['slice_id'] for lease in leases])
+        for slice_id in self.slice_hrns.keys():
+            if slice_id not in slice_ids:
+                del self.slice_hrns[slice_id]
+
+    def _add(self, lease):
+        if lease['lease_id'] in self.leases_by_id:
+            self._remove(self.leases_by_id[lease['lease_id']])
+        self.leases_by_id[lease['lease_id']] = lease
+        insort(self.by_hostname.setdefault(lease['hostname'], []), (lease['t_from'], lease['lease_id']))
+        insort(self.by_slice.setdefault(lease['name'], []), (lease['t_from'], lease['lease_id']))
+
+    def _remove(self, lease):
+        if isinstance(lease, tuple):
+            lease = self.leases_by_id[lease[1]]
+        del self.leases_by_id[lease['lease_id']]
+        for (index, key) in [ (self.by_hostname, lease['hostname']), (self.by_slice, lease['name']) ]:
+            entries = index[key]
+            entries.remove( (lease['t_from'], lease['lease_id']) )
+            if not entries:
+                del index[key]
+
+    def _expire(self, now):
+        for lease in [ lease for lease in self.leases_by_id.values() if lease['t_until'] <= now ]:
+            self._remove(lease)
+
+    def _resolve_hrns(self, shell):
+        hostnames = [ hostname for hostname in self.by_hostname if hostname not in self.node_hrns ]
+        if hostnames:
+            for node in shell.GetNodes({'hostname': hostnames}, ['hostname', 'hrn']):
+                self.node_hrns[node['hostname']] = node['hrn']
+        slice_ids = set([ lease['slice_id'] for lease in self.leases_by_id.values()
+                          if lease['slice_id'] not in self.slice_hrns ])
+        if slice_ids:
+            for slice in shell.GetSlices({'slice_id': list(slice_ids)}, ['slice_id', 'hrn']):
+                self.slice_hrns[slice['slice_id']] = slice['hrn']
+        # should not happen, but let us not lose track of a lease
+        # just because its node or slice hrn could not be found in bulk
+        for hostname in hostnames:
+            if not self.node_hrns.get(hostname):
+                self.node_hrns[hostname] = shell.GetNodeHrn(hostname)
+        for slice_id in slice_ids:
+            if not self.slice_hrns.get(slice_id):
+                self.slice_hrns[slice_id] = shell.GetSliceHrn(slice_id)
+
+    def _lookup(self, entries, t_from, t_until):
+        leases = []
+        for (start, lease_id) in entries:
+            if t_until is not None and start >= t_until:
+                break
+            lease = self.leases_by_id[lease_id]
+            if t_from is not None and lease['t_until'] <= t_from:
+                continue
+            leases.append(lease)
+        return leases
+
+    def _get_leases(self, slice_name, hostname, t_from, t_until):
+        if slice_name is not None:
+            leases = self._lookup(self.by_slice.get(slice_name, []), t_from, t_until)
+            if hostname is not None:
+                leases = [ lease for lease in leases if lease['hostname'] == hostname ]
+            return leases
+        if hostname is not None:
+            return self._lookup(self.by_hostname.get(hostname, []), t_from, t_until)
+        leases = []
+        for entries in self.by_hostname.values():
+            leases += self._lookup(entries, t_from, t_until)
+        return leases
+
+    def get_leases(self, shell, slice_name=None, hostname=None, t_from=None, t_until=None):
+        """
+        @param t_from, t_until restrict to the leases overlapping this time window
+        @return a list of lease dicts, as returned by GetLeases, sorted by t_from
+        within each node or slice
+        """
+        self.refresh(shell)
+        with self._lock:
+            return self._get_leases(slice_name, hostname, t_from, t_until)
+
+    def get_leases_with_hrns(self, shell, slice_name=None, hostname=None, t_from=None, t_until=None):
+        """
+        same as get_leases, but the hrns are looked up along with the leases,
+        so that a concurrent refresh cannot drop them in between
+        @return a list of (lease, node_hrn, slice_hrn) tuples
+        """
+        self.refresh(shell)
+        with self._lock:
+            return [ (lease, self.node_hrns.get(lease['hostname']), self.slice_hrns.get(lease['slice_id']))
+                     for lease in self._get_leases(slice_name, hostname, t_from, t_until) ]
+
+    def get_grain(self, shell):
+        self.refresh(shell)
+        return self.grain
+
+def LeaseIndex (driver):
+    url = driver.api.config.SFA_PLC_URL
+    with _lease_index._instances_lock:
+        if url not in _lease_index._instances:
+            _lease_index._instances[url] = _lease_index(url)
+        return _lease_index._instances[url]
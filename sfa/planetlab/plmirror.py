@@ -0,0 +1,435 @@
+from __future__ import with_statement
+
+import time
+import threading
+from copy import deepcopy
+
+from sfa.util.sfalogging import logger
+
+"""
+PlMirror: an in-memory copy of the PLC objects that SFA reads - sites,
+persons, keys, nodes and slices - indexed by id, by name and by hrn;
+one (singleton) instance per PLC, shared by all the drivers of the
+process - thread-safe
+
+it is used in place of the shell for reads, as in
+    mirror.GetNodes({'peer_id': None, 'node_id': node_ids}, ['node_id', 'hostname'])
+queries that it cannot answer locally (tags other than hrn, filters
+with modifiers, ...) are passed on to PLC
+
+each table is refreshed at most every refresh_period seconds:
+. for the objects that have a last_updated field, only the new and
+  changed objects are fetched, along with the list of ids to spot
+  the deleted ones
+. the other tables, and all of them every full_refresh_period
+  seconds, are fetched again entirely
+writes go to PLC through the shell as usual, and PlShell reports them
+here so that the objects they affect get fetched again on next read
+"""
+
+class PlTable:
+
+    def __init__(self, method, id_field, name_field=None, change_field=None, has_hrn=True):
+        self.method = method
+        self.id_field = id_field
+        self.name_field = name_field
+        self.change_field = change_field
+        self.has_hrn = has_hrn
+        self.records = {}
+        self.by_name = {}
+        self.by_hrn = {}
+        self.hrns = {}
+        self.last_change = None
+        self.refreshed = 0
+        self.full_refreshed = 0
+        # ids, or names, to fetch again
+        self.dirty = set()
+        self.stale = True
+        # a refresh that takes over invalidations is in progress
+        self.catching_up = False
+        self.refresh_lock = threading.Lock()
+
+    def fetch(self, shell, filter):
+        records = getattr(shell, self.method)(filter)
+        hrns = {}
+        if self.has_hrn and records:
+            if isinstance(filter, dict):
+                hrn_filter = [ record[self.id_field] for record in records ]
+            else:
+                hrn_filter = filter
+            for record in getattr(shell, self.method)(hrn_filter, [self.id_field, 'hrn']):
+                hrns[record[self.id_field]] = record['hrn']
+        return (records, hrns)
+
+    def store(self, record, hrn):
+        id = record[self.id_field]
+        self.remove(id)
+        self.records[id] = record
+        if self.name_field and record.get(self.name_field) is not None:
+            self.by_name[record[self.name_field]] = id
+        if hrn is not None:
+            self.hrns[id] = hrn
+            self.by_hrn[hrn] = id
+        if self.change_field and record.get(self.change_field) is not None:
+            self.last_change = max(self.last_change, record[self.change_field])
+
+    def remove(self, id):
+        record = self.records.pop(id, None)
+        if record is None:
+            return
+        if self.name_field and self.by_name.get(record.get(self.name_field)) == id:
+            del self.by_name[record[self.name_field]]
+        hrn = self.hrns.pop(id, None)
+        if hrn is not None and self.by_hrn.get(hrn) == id:
+            del self.by_hrn[hrn]
+
+    ##
+    # what a refresh has to fetch, or None if the table is up to date;
+    # called under the mirror lock, it takes over the pending invalidations
+    def plan(self, refresh_period, full_refresh_period):
+        now = time.time()
+        due = now - self.refreshed >= refresh_period
+        if not self.stale and not self.dirty and not due:
+            return None
+        full = self.stale or self.change_field is None and due or now - self.full_refreshed >= full_refresh_period
+        plan = {'now': now, 'due': due, 'full': full, 'ids': self.dirty,
+                'known': set(self.records.keys()), 'last_change': self.last_change}
+        self.catching_up = full or bool(self.dirty)
+        self.stale = False
+        self.dirty = set()
+        return plan
+
+    # the PLC side of a refresh, done without the mirror lock
+    def fetch_plan(self, shell, plan):
+        if plan['full']:
+            return self.fetch(shell, {})
+        ids = set(plan['ids'])
+        removed = set()
+        if plan['due']:
+            current_ids = set([ record[self.id_field]
+                                for record in getattr(shell, self.method)({}, [self.id_field]) ])
+            removed = plan['known'] - current_ids
+            ids |= current_ids - plan['known']
+            if plan['last_change'] is not None:
+                # ']' stands for >= in PLCAPI filters
+                changed = getattr(shell, self.method)({']'+self.change_field: plan['last_change']}, [self.id_field])
+                ids |= set([ record[self.id_field] for record in changed ])
+        if not ids:
+            return (removed, ids, [], {})
+        (records, hrns) = self.fetch(shell, list(ids))
+        return (removed, ids, records, hrns)
+
+    # swaps in what fetch_plan returned, under the mirror lock
+    def apply(self, plan, fetched):
+        self.catching_up = False
+        if plan['full']:
+            (records, hrns) = fetched
+            self.records, self.by_name, self.by_hrn, self.hrns = {}, {}, {}, {}
+            self.last_change = None
+            for record in records:
+                self.store(record, hrns.get(record[self.id_field]))
+            self.refreshed = self.full_refreshed = plan['now']
+            logger.debug("PlMirror: loaded %d objects with %s"%(len(records), self.method))
+            return
+        (removed, ids, records, hrns) = fetched
+        for id in removed:
+            self.remove(id)
+        for id in ids:
+            self.remove(self.by_name.get(id, id))
+        for record in records:
+            self.store(record, hrns.get(record[self.id_field]))
+        if plan['due']:
+            self.refreshed = plan['now']
+
+    # gives the invalidations back when the fetch failed
+    def cancel(self, plan):
+        self.catching_up = False
+        self.dirty |= plan['ids']
+        if plan['full']:
+            self.stale = True
+
+    ##
+    # PLC is only queried outside of the mirror lock, so that reads go on
+    # with the current objects in the meantime; refreshes of one table are
+    # serialized, and a reader waits for the one in progress only when
+    # the table has invalidations pending, i.e. after a write
+    def refresh(self, shell, lock, refresh_period, full_refresh_period):
+        with lock:
+            urgent = bool(self.stale or self.dirty or self.catching_up)
+        if not self.refresh_lock.acquire(urgent):
+            return
+        try:
+            with lock:
+                plan = self.plan(refresh_period, full_refresh_period)
+            if plan is None:
+                return
+            try:
+                fetched = self.fetch_plan(shell, plan)
+            except:
+                with lock:
+                    self.cancel(plan)
+                raise
+            with lock:
+                self.apply(plan, fetched)
+        finally:
+            self.refresh_lock.release()
+
+    def invalidate(self, keys=None):
+        if keys is None:
+            self.stale = True
+            return
+        for key in keys:
+            if isinstance(key, (int, long)):
+                self.dirty.add(key)
+            elif isinstance(key, basestring) and self.name_field:
+                self.dirty.add(self.by_name.get(key, key))
+            else:
+                self.stale = True
+
+    ##
+    # the ids or names explicitly asked for in a filter, that we do not know of
+    def missing(self, filter):
+        if isinstance(filter, dict):
+            keys = filter.get(self.id_field, [])
+        elif filter is None:
+            keys = []
+        else:
+            keys = filter
+        if not isinstance(keys, (list, tuple, set)):
+            keys = [keys]
+        return [ key for key in keys
+                 if isinstance(key, (int, long)) and key not in self.records
+                 or isinstance(key, basestring) and self.name_field and key not in self.by_name ]
+
+    ##
+    # the ids of the objects a PLCAPI filter designates, or None if that
+    # filter cannot be evaluated locally
+    def select(self, filter):
+        if filter is None:
+            return self.records.keys()
+        if not isinstance(filter, dict):
+            if not isinstance(filter, (list, tuple, set)):
+                filter = [filter]
+            ids = []
+            for key in filter:
+                if isinstance(key, (int, long)):
+                    if key in self.records: ids.append(key)
+                elif isinstance(key, basestring) and self.name_field:
+                    if key in self.by_name: ids.append(self.by_name[key])
+                else:
+                    return None
+            return ids
+        ids = self.records.keys()
+        for (field, value) in filter.items():
+            if field == 'hrn' and self.has_hrn:
+                values = value if isinstance(value, (list, tuple, set)) else [value]
+                hrn_ids = set([ self.by_hrn[hrn] for hrn in values if hrn in self.by_hrn ])
+                ids = [ id for id in ids if id in hrn_ids ]
+                continue
+            any = field.startswith('|')
+            if any: field = field[1:]
+            if not field or not field[0].isalpha():
+                return None
+            if ids and field not in self.records[ids[0]]:
+                return None
+            if any:
+                if not isinstance(value, (list, tuple, set)): value = [value]
+                value = set(value)
+                ids = [ id for id in ids
+                        if value.intersection(self.records[id][field] or []) ]
+            elif isinstance(value, (list, tuple, set)):
+                value = set(value)
+                ids = [ id for id in ids if self.records[id][field] in value ]
+            else:
+                ids = [ id for id in ids if self.records[id][field] == value ]
+        return ids
+
+    ##
+    # copies of the records, restricted to fields if provided,
+    # or None if some of these fields are not mirrored
+    def project(self, ids, fields):
+        result = []
+        for id in ids:
+            record = self.records[id]
+            if fields is None:
+                result.append(deepcopy(record))
+                continue
+            projected = {}
+            for field in fields:
+                if field == 'hrn' and self.has_hrn:
+                    projected['hrn'] = self.hrns.get(id)
+                elif field in record:
+                    projected[field] = deepcopy(record[field])
+                else:
+                    return None
+            result.append(projected)
+        return result
+
+class _pl_mirror:
+
+    _instances = {}
+    _instances_lock = threading.Lock()
+    # in seconds
+    refresh_period = 60
+    full_refresh_period = 600
+
+    # the PLCAPI writes that SFA issues, and the objects they affect,
+    # as (table, index of the argument that designates them, if any);
+    # a None table is the one of the object type given as first argument
+    writes = {
+        'AddSite': [('sites', None)],
+        'UpdateSite': [('sites', 0)],
+        'DeleteSite': [('sites', 0), ('persons', None), ('nodes', None), ('slices', None)],
+        'SetSiteHrn': [('sites', 0)],
+        'SetSiteSfaCreated': [('sites', 0)],
+        'AddSiteTag': [('sites', 0)],
+        'AddPerson': [('persons', None)],
+        'UpdatePerson': [('persons', 0)],
+        'DeletePerson': [('persons', 0), ('sites', None), ('slices', None), ('keys', None)],
+        'SetPersonHrn': [('persons', 0)],
+        'SetPersonSfaCreated': [('persons', 0)],
+        'AddRoleToPerson': [('persons', 1)],
+        'AddPersonToSite': [('persons', 0), ('sites', 1)],
+        'AddPersonKey': [('persons', 0), ('keys', None)],
+        'DeleteKey': [('keys', 0), ('persons', None)],
+        'AddPersonToSlice': [('persons', 0), ('slices', 1)],
+        'DeletePersonFromSlice': [('persons', 0), ('slices', 1)],
+        'AddSlice': [('slices', None), ('sites', None)],
+        'UpdateSlice': [('slices', 0)],
+        'DeleteSlice': [('slices', 0), ('persons', None), ('nodes', None), ('sites', None)],
+        'SetSliceHrn': [('slices', 0)],
+        'SetSliceSfaCreated': [('slices', 0)],
+        'AddSliceTag': [('slices', 0)],
+        'UpdateSliceTag': [('slices', None)],
+        'DeleteSliceTag': [('slices', None)],
+        'AddSliceToNodes': [('slices', 0), ('nodes', 1)],
+        'DeleteSliceFromNodes': [('slices', 0), ('nodes', 1)],
+        'AddNode': [('nodes', None), ('sites', 0)],
+        'UpdateNode': [('nodes', 0)],
+        'DeleteNode': [('nodes', 0), ('sites', None), ('slices', None)],
+        'SetNodeHrn': [('nodes', 0)],
+        'SetNodeSfaCreated': [('nodes', 0)],
+        'BindObjectToPeer': [(None, 1)],
+        'UnBindObjectFromPeer': [(None, 1)],
+        # leases are not mirrored, see LeaseIndex
+        'AddLeases': [],
+        'UpdateLeases': [],
+        'DeleteLeases': [],
+        }
+    # the object types of BindObjectToPeer and UnBindObjectFromPeer
+    object_tables = {'site': 'sites', 'person': 'persons', 'key': 'keys',
+                     'node': 'nodes', 'slice': 'slices'}
+
+    def __init__(self, url):
+        self.url = url
+        self._lock = threading.RLock()
+        self.tables = {
+            'sites': PlTable('GetSites', 'site_id', 'login_base', 'last_updated'),
+            'persons': PlTable('GetPersons', 'person_id', 'email', 'last_updated'),
+            'keys': PlTable('GetKeys', 'key_id', has_hrn=False),
+            'nodes': PlTable('GetNodes', 'node_id', 'hostname', 'last_updated'),
+            'slices': PlTable('GetSlices', 'slice_id', 'name'),
+            }
+        self.tables_by_method = dict([ (table.method, table) for table in self.tables.values() ])
+        self.hits = 0
+        self.misses = 0
+
+    def refresh(self, shell, table):
+        table.refresh(shell, self._lock, self.refresh_period, self.full_refresh_period)
+
+    def get(self, shell, method, filter=None, fields=None):
+        table = self.tables_by_method[method]
+        self.refresh(shell, table)
+        # read through for the objects created since the last refresh
+        with self._lock:
+            missing = table.missing(filter)
+            if missing:
+                table.invalidate(missing)
+        if missing:
+            self.refresh(shell, table)
+        with self._lock:
+            ids = table.select(filter)
+            if ids is not None:
+                result = table.project(ids, fields)
+                if result is not None:
+                    self.hits += 1
+                    return result
+            self.misses += 1
+        logger.debug("PlMirror: passing %s(%r, %r) on to PLC"%(method, filter, fields))
+        if fields is None:
+            return getattr(shell, method)(filter)
+        return getattr(shell, method)(filter, fields)
+
+    def get_hrn(self, shell, method, id):
+        table = self.tables_by_method[method]
+        self.refresh(shell, table)
+        with self._lock:
+            if id in table.hrns:
+                return table.hrns[id]
+        return getattr(shell, method[:-1] + 'Hrn')(id)
+
+    # called by PlShell once a write has been sent
+    def written(self, method, args):
+        if method not in self.writes:
+            if method.startswith('Get'):
+                return
+            affected = [ (name, None) for name in self.tables ]
+        else:
+            affected = self.writes[method]
+        with self._lock:
+            for (name, index) in affected:
+                if name is None:
+                    name = self.object_tables.get(args[0] if args else None)
+                    if name is None:
+                        continue
+                keys = None
+                if index is not None and index < len(args):
+                    keys = args[index]
+                    if not isinstance(keys, (list, tuple)):
+                        keys = [keys]
+                self.tables[name].invalidate(keys)
+
+    def invalidate(self):
+        with self._lock:
+            for table in self.tables.values():
+                table.invalidate()
+
+    def stats(self):
+        with self._lock:
+            return {'url': self.url, 'hits': self.hits, 'misses': self.misses,
+                    'objects': dict([ (name, len(table.records)) for (name, table) in self.tables.items() ])}
+
+class PlMirrorShell:
+    """
+    what a driver uses to read through the mirror; exposes the same
+    GetSites/GetPersons/GetKeys/GetNodes/GetSlices as PlShell,
+    and GetSiteHrn/GetPersonHrn/GetNodeHrn/GetSliceHrn
+    """
+
+    def __init__(self, mirror, shell):
+        self.mirror = mirror
+        self.shell = shell
+
+    def __getattr__(self, name):
+        if name in self.mirror.tables_by_method:
+            def func(filter=None, fields=None):
+                return self.mirror.get(self.shell, name, filter, fields)
+            return func
+        if name.startswith('Get') and name.endswith('Hrn') and name[:-3] + 's' in self.mirror.tables_by_method:
+            def func(id):
+                return self.mirror.get_hrn(self.shell, name[:-3] + 's', id)
+            return func
+        raise AttributeError, name
+
+def PlMirror (url):
+    with _pl_mirror._instances_lock:
+        if url not in _pl_mirror._instances:
+            _pl_mirror._instances[url] = _pl_mirror(url)
+        return _pl_mirror._instances[url]
+
+# to be called whenever a write to PLC has been issued
+def pl_mirror_written (url, method, args):
+    with _pl_mirror._instances_lock:
+        mirror = _pl_mirror._instances.get(url)
+    if mirror is not None:
+        mirror.written(method, args)
@@ -1,9 +1,141 @@
+from __future__ import with_statement
+
 import sys
+import time
 import xmlrpclib
 import socket
+import threading
+from httplib import HTTPConnection, HTTPSConnection
 from urlparse import urlparse
 
 from sfa.util.sfalogging import logger
+from sfa.client.sfaserverproxy import XMLRPCTransport, HTTPSConnectionPool
+from sfa.planetlab.plmirror import pl_mirror_written
+
+class PlTransport(XMLRPCTransport):
+    """
+    A keep-alive xmlrpc transport to PLC, over http or https;
+    unlike the one used between SFA peers, it does not use client
+    certificates, and leaves faults as xmlrpclib.Fault
+    """
+
+    def __init__(self, scheme, pool):
+        XMLRPCTransport.__init__(self, pool=pool)
+        self.scheme = scheme
+
+    def make_connection(self, host):
+        host, extra_headers, x509 = self.get_host_info(host)
+        if self.scheme == 'https':
+            return HTTPSConnection(host)
+        return HTTPConnection(host)
+
+    def getparser(self):
+        return xmlrpclib.Transport.getparser(self)
+
+"""
+PlcEndpoint: what it takes to talk to one PLC, shared by all the PlShell
+objects of the process - thread-safe
+
+. whether PLC runs locally, which takes a couple of DNS lookups, is
+  figured once and then trusted for locality_ttl seconds
+. xmlrpc calls go through a pool of kept-alive connections
+. it counts the calls made, and how long they took, per PLCAPI method;
+  these are logged every stats_period seconds
+"""
+
+class _plc_endpoint:
+
+    _instances = {}
+    _instances_lock = threading.Lock()
+    # in seconds
+    locality_ttl = 300
+    stats_period = 300
+    # connections to PLC
+    max_idle = 4
+    max_active = 8
+
+    def __init__(self, url):
+        self.url = url
+        self._lock = threading.Lock()
+        self._is_local = None
+        self._locality_checked = 0
+        self._plc_direct_access = None
+        self.pool = HTTPSConnectionPool(max_idle=self.max_idle, max_active=self.max_active)
+        transport = PlTransport(urlparse(url).scheme, self.pool)
+        self.proxy = xmlrpclib.ServerProxy(url, transport, verbose = False, allow_none = True)
+        self.methods = {}
+        self.last_stats = time.time()
+
+    def is_local(self):
+        with self._lock:
+            now = time.time()
+            if self._is_local is None or now - self._locality_checked > self.locality_ttl:
+                self._is_local = self.compute_locality()
+                self._locality_checked = now
+            return self._is_local
+
+    def compute_locality(self):
+        # try to figure if the url is local
+        hostname=urlparse(self.url).hostname
+        if hostname == 'localhost': return True
+        # otherwise compare IP addresses; 
+        # this might fail for any number of reasons, so let's harden that
+        try:
+            url_ip=socket.gethostbyname(hostname)
+            local_ip=socket.gethostbyname(socket.gethostname())
+            return url_ip==local_ip
+        except:
+            return False
+
+    # whether the PLCAPI code is available for the capability mode
+    def plc_direct_access(self):
+        with self._lock:
+            if self._plc_direct_access is None:
+                try:
+                    # too bad this is not installed properly
+                    plcapi_path="/usr/share/plc_api"
+                    if plcapi_path not in sys.path: sys.path.append(plcapi_path)
+                    import PLC.Shell
+                    self._plc_direct_access=True
+                except:
+                    self._plc_direct_access=False
+            return self._plc_direct_access
+
+    def record(self, method, elapsed, failed):
+        with self._lock:
+            metrics = self.methods.get(method)
+            if metrics is None:
+                metrics = self.methods[method] = {'calls': 0, 'errors': 0, 'time': 0., 'max': 0.}
+            metrics['calls'] += 1
+            if failed: metrics['errors'] += 1
+            metrics['time'] += elapsed
+            metrics['max'] = max(metrics['max'], elapsed)
+            now = time.time()
+            log_stats = now - self.last_stats > self.stats_period
+            if log_stats: self.last_stats = now
+        if log_stats:
+            logger.info("PLC stats: %r" % self.stats())
+
+    def stats(self):
+        with self._lock:
+            methods = {}
+            for (method, metrics) in self.methods.items():
+                methods[method] = dict(metrics)
+                methods[method]['average'] = metrics['time'] / metrics['calls']
+            return {'url': self.url, 'local': self._is_local,
+                    'connections': self.pool.stats(), 'methods': methods}
+
+def PlcEndpoint (url):
+    with _plc_endpoint._instances_lock:
+        if url not in _plc_endpoint._instances:
+            _plc_endpoint._instances[url] = _plc_endpoint(url)
+        return _plc_endpoint._instances[url]
+
+# the metrics of all the PLCs this process talks to
+def plc_stats():
+    with _plc_endpoint._instances_lock:
+        endpoints = _plc_endpoint._instances.values()
+    return [ endpoint.stats() for endpoint in endpoints ]
 
 class PlShell:
     """
@@ -43,54 +175,179 @@ class PlShell:
     # use the 'capability' auth mechanism for higher performance when the PLC db is local    
     def __init__ ( self, config ) :
         url = config.SFA_PLC_URL
-        # try to figure if the url is local
-        hostname=urlparse(url).hostname
-        is_local=False
-        if hostname == 'localhost': is_local=True
-        # otherwise compare IP addresses; 
-        # this might fail for any number of reasons, so let's harden that
-        try:
-            # xxx todo this seems to result in a DNS request for each incoming request to the AM
-            # should be cached or improved
-            url_ip=socket.gethostbyname(hostname)
-            local_ip=socket.gethostbyname(socket.gethostname())
-            if url_ip==local_ip: is_local=True
-        except:
-            pass
-
-        if is_local:
-            try:
-                # too bad this is not installed properly
-                plcapi_path="/usr/share/plc_api"
-                if plcapi_path not in sys.path: sys.path.append(plcapi_path)
-                import PLC.Shell
-                plc_direct_access=True
-            except:
-                plc_direct_access=False
-        if is_local and plc_direct_access:
-            logger.info('plshell access - capability')
+        self.url = url
+        # locality, connections and metrics are shared by all the PlShell objects
+        # in the process, see PlcEndpoint
+        self.endpoint = PlcEndpoint(url)
+        if self.endpoint.is_local() and self.endpoint.plc_direct_access():
+            logger.debug('plshell access - capability')
             self.plauth = { 'AuthMethod': 'capability',
                             'Username':   str(config.SFA_PLC_USER),
                             'AuthString': str(config.SFA_PLC_PASSWORD),
                             }
+            import PLC.Shell
             self.proxy = PLC.Shell.Shell ()
 
         else:
-            logger.info('plshell access - xmlrpc')
+            logger.debug('plshell access - xmlrpc')
             self.plauth = { 'AuthMethod': 'password',
                             'Username':   str(config.SFA_PLC_USER),
                             'AuthString': str(config.SFA_PLC_PASSWORD),
                             }
-            self.proxy = xmlrpclib.Server(url, verbose = False, allow_none = True)
+            self.proxy = self.endpoint.proxy
+
+    def actual_name(self, name):
+        actual_name=None
+        if name in PlShell.direct_calls: actual_name=name
+        if name in PlShell.alias_calls: actual_name=PlShell.alias_calls[name]
+        if not actual_name:
+            raise Exception, "Illegal method call %s for PL driver"%(name)
+        return actual_name
 
     def __getattr__(self, name):
         def func(*args, **kwds):
-            actual_name=None
-            if name in PlShell.direct_calls: actual_name=name
-            if name in PlShell.alias_calls: actual_name=PlShell.alias_calls[name]
-            if not actual_name:
-                raise Exception, "Illegal method call %s for PL driver"%(name)
-            result=getattr(self.proxy, actual_name)(self.plauth, *args, **kwds)
+            actual_name=self.actual_name(name)
+            started = time.time()
+            failed = True
+            try:
+                result=getattr(self.proxy, actual_name)(self.plauth, *args, **kwds)
+                failed = False
+            finally:
+                self.endpoint.record(actual_name, time.time() - started, failed)
+                pl_mirror_written(self.url, actual_name, args)
             logger.debug('PlShell %s (%s) returned ... '%(name,actual_name))
             return result
         return func
+
+    def batch(self):
+        """
+        @return a PlBatch object, to be used as a context manager:
+        the calls made on it are sent to PLC in a single system.multicall
+        when the with block exits
+
+            with shell.batch() as batch:
+                role = batch.AddRoleToPerson('user', person_id)
+                site = batch.AddPersonToSite(person_id, site_id)
+            role.result()
+        """
+        return PlBatch(self)
+
+    # urls that we know have no system.multicall
+    no_multicall = set()
+    # how many calls at most go in one system.multicall
+    max_batch = 100
+
+    def run_batch(self, calls):
+        for i in range(0, len(calls), PlShell.max_batch):
+            chunk = calls[i:i+PlShell.max_batch]
+            if self.url in PlShell.no_multicall or not self.multicall(chunk):
+                for call in chunk:
+                    started = time.time()
+                    try:
+                        call.set_result(getattr(self.proxy, call.actual_name)(self.plauth, *call.args))
+                    except Exception, e:
+                        call.set_exception(e)
+                    self.endpoint.record(call.actual_name, time.time() - started, call.exception is not None)
+            for call in chunk:
+                pl_mirror_written(self.url, call.actual_name, call.args)
+            logger.debug('PlShell batch of %d calls returned ... '%len(chunk))
+
+    # the fault code for an unknown method, as per the xmlrpc specifications for fault codes
+    method_not_found = -32601
+
+    # whether a fault means that there is no system.multicall at the other end;
+    # not all servers use method_not_found - e.g. SimpleXMLRPCServer answers
+    # with code 1, and PLCAPI with its own code - but they name the method
+    @staticmethod
+    def lacks_multicall(fault):
+        return fault.faultCode == PlShell.method_not_found or \
+            'system.multicall' in str(fault.faultString)
+
+    # returns False if the other end does not support system.multicall
+    # any other failure of the multicall as a whole is raised
+    def multicall(self, calls):
+        params = [ {'methodName': call.actual_name, 'params': [self.plauth] + list(call.args)}
+                   for call in calls ]
+        started = time.time()
+        try:
+            results = self.proxy.system.multicall(params)
+        except (xmlrpclib.Fault, AttributeError), e:
+            if isinstance(e, xmlrpclib.Fault) and not PlShell.lacks_multicall(e):
+                self.endpoint.record('system.multicall', time.time() - started, True)
+                raise
+            logger.info('PlShell: no system.multicall at %s (%s), using sequential calls'%(self.url, e))
+            PlShell.no_multicall.add(self.url)
+            return False
+        self.endpoint.record('system.multicall', time.time() - started, False)
+        for (call, result) in zip(calls, results):
+            if isinstance(result, dict):
+                call.set_exception(xmlrpclib.Fault(result['faultCode'], result['faultString']))
+            else:
+                call.set_result(result[0])
+        return True
+
+class PlCall:
+    """
+    the outcome of one call made in a PlBatch, available once the batch is sent
+    """
+
+    def __init__(self, name, actual_name, args):
+        self.name = name
+        self.actual_name = actual_name
+        self.args = args
+        self.done = False
+        self.value = None
+        self.exception = None
+
+    def set_result(self, value):
+        self.value = value
+        self.done = True
+
+    def set_exception(self, exception):
+        self.exception = exception
+        self.done = True
+
+    def result(self):
+        if not self.done:
+            raise Exception, "PlShell call %s has not been sent yet"%self.name
+        if self.exception is not None:
+            raise self.exception
+        return self.value
+
+class PlBatch:
+
+    def __init__(self, shell):
+        self.shell = shell
+        self.calls = []
+        self.pending = []
+
+    def __getattr__(self, name):
+        if name.startswith('__'):
+            raise AttributeError, name
+        def func(*args, **kwds):
+            if kwds:
+                raise Exception, "PlShell batch call %s does not support keyword arguments"%name
+            call = PlCall(name, self.shell.actual_name(name), args)
+            self.calls.append(call)
+            self.pending.append(call)
+            return call
+        return func
+
+    def send(self):
+        pending, self.pending = self.pending, []
+        if pending:
+            self.shell.run_batch(pending)
+
+    # the results in the order the calls were made; raises the first failure
+    def results(self):
+        self.send()
+        return [ call.result() for call in self.calls ]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        # do not send anything if the block did not complete
+        if exc_type is None:
+            self.send()
+        return False
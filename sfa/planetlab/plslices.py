@@ -1,3 +1,5 @@
+from __future__ import with_statement
+
 import time
 from types import StringTypes
 from collections import defaultdict
@@ -8,6 +10,7 @@ from sfa.util.xrn import Xrn, get_leaf, get_authority, urn_to_hrn
 from sfa.rspecs.rspec import RSpec
 from sfa.planetlab.vlink import VLink
 from sfa.planetlab.topology import Topology
+from sfa.planetlab.plleases import LeaseIndex
 from sfa.planetlab.plxrn import PlXrn, hrn_to_pl_slicename, xrn_to_hostname, top_auth, hash_loginbase
 from sfa.storage.model import SliverAllocation
 
@@ -30,7 +33,7 @@ class PlSlices:
         
         # from PLCAPI.GetSlivers.get_slivers()
         slice_fields = ['slice_id', 'name', 'instantiation', 'expires', 'person_ids', 'slice_tag_ids']
-        slices = self.driver.shell.GetSlices(slice_name, slice_fields)
+        slices = self.driver.mirror.GetSlices(slice_name, slice_fields)
         # Build up list of users and slice attributes
         person_ids = set()
         all_slice_tag_ids = set()
@@ -40,7 +43,7 @@ class PlSlices:
         person_ids = list(person_ids)
         all_slice_tag_ids = list(all_slice_tag_ids)
         # Get user information
-        all_persons_list = self.driver.shell.GetPersons({'person_id':person_ids,'enabled':True}, 
+        all_persons_list = self.driver.mirror.GetPersons({'person_id':person_ids,'enabled':True}, 
                                                         ['person_id', 'enabled', 'key_ids'])
         all_persons = {}
         for person in all_persons_list:
@@ -52,7 +55,7 @@ class PlSlices:
             key_ids.update(person['key_ids'])
         key_ids = list(key_ids)
         # Get user account keys
-        all_keys_list = self.driver.shell.GetKeys(key_ids, ['key_id', 'key', 'key_type'])
+        all_keys_list = self.driver.mirror.GetKeys(key_ids, ['key_id', 'key', 'key_type'])
         all_keys = {}
         for key in all_keys_list:
             all_keys[key['key_id']] = key
@@ -142,9 +145,10 @@ class PlSlices:
 
     def verify_slice_leases(self, slice, rspec_requested_leases):
 
-        leases = self.driver.shell.GetLeases({'name':slice['name'], 'clip':int(time.time())}, 
-                                             ['lease_id','name', 'hostname', 't_from', 't_until'])
-        grain = self.driver.shell.GetLeaseGranularity()
+        # always start from what PLC currently has for this slice
+        lease_index = LeaseIndex(self.driver)
+        leases = lease_index.refresh_slice(self.driver.shell, slice['name'])
+        grain = lease_index.get_grain(self.driver.shell)
 
         requested_leases = []
         for lease in rspec_requested_leases:
@@ -195,12 +199,18 @@ class PlSlices:
    
 
         try:
+            # the deleted leases may free the slots of the added ones,
+            # so nothing gets added if the deletion fails
             self.driver.shell.DeleteLeases(deleted_leases_id)
-            for lease in added_leases:
-                self.driver.shell.AddLeases(lease['hostname'], slice['name'], lease['t_from'], lease['t_until'])
+            with self.driver.shell.batch() as batch:
+                for lease in added_leases:
+                    batch.AddLeases(lease['hostname'], slice['name'], lease['t_from'], lease['t_until'])
+            batch.results()
 
         except: 
             logger.log_exc('Failed to add/remove slice leases')
+        if deleted_leases_id or added_leases:
+            lease_index.refresh_slice(self.driver.shell, slice['name'])
 
         return leases
 
@@ -355,11 +365,13 @@ class PlSlices:
                     'sfa_created': 'True',
             }
             site_id = self.driver.shell.AddSite(site)
-            # plcapi tends to mess with the incoming hrn so let's make sure
-            self.driver.shell.SetSiteHrn (site_id, site_hrn)
+            with self.driver.shell.batch() as batch:
+                # plcapi tends to mess with the incoming hrn so let's make sure
+                batch.SetSiteHrn (site_id, site_hrn)
+                # exempt federated sites from monitor policies
+                batch.AddSiteTag(site_id, 'exempt_site_until', "20200101")
+            batch.results()
             site['site_id'] = site_id
-            # exempt federated sites from monitor policies
-            self.driver.shell.AddSiteTag(site_id, 'exempt_site_until', "20200101")
 
         return site
 
@@ -402,11 +414,13 @@ class PlSlices:
             }
             # add the slice
             slice_id = self.driver.shell.AddSlice(slice)
-            # plcapi tends to mess with the incoming hrn so let's make sure
-            self.driver.shell.SetSliceHrn (slice_id, slice_hrn)
-            # cannot be set with AddSlice
-            # set the expiration
-            self.driver.shell.UpdateSlice(slice_id, {'expires': expires})
+            with self.driver.shell.batch() as batch:
+                # plcapi tends to mess with the incoming hrn so let's make sure
+                batch.SetSliceHrn (slice_id, slice_hrn)
+                # cannot be set with AddSlice
+                # set the expiration
+                batch.UpdateSlice(slice_id, {'expires': expires})
+            batch.results()
 
         return self.driver.shell.GetSlices(slice_id)[0]
 
@@ -450,12 +464,17 @@ class PlSlices:
             person_record['email']=default_email
             logger.debug ("second chance with email=%s"%person_record['email'])
             person_id = int (self.driver.shell.AddPerson(person_record))
-        self.driver.shell.AddRoleToPerson('user', person_id)
-        self.driver.shell.AddPersonToSite(person_id, site_id)
-        # plcapi tends to mess with the incoming hrn so let's make sure
-        self.driver.shell.SetPersonHrn (person_id, user_hrn)
-        # also 'enabled':True does not seem to pass through with AddPerson
-        self.driver.shell.UpdatePerson (person_id, {'enabled': True})
+        # the person is set up only once it has its role and site
+        with self.driver.shell.batch() as batch:
+            batch.AddRoleToPerson('user', person_id)
+            batch.AddPersonToSite(person_id, site_id)
+        batch.results()
+        with self.driver.shell.batch() as batch:
+            # plcapi tends to mess with the incoming hrn so let's make sure
+            batch.SetPersonHrn (person_id, user_hrn)
+            # also 'enabled':True does not seem to pass through with AddPerson
+            batch.UpdatePerson (person_id, {'enabled': True})
+        batch.results()
 
         return person_id
 
@@ -510,8 +529,10 @@ class PlSlices:
         del_person_ids  = set(slice_person_ids) - set(target_existing_person_ids)
 
         # delete 
-        for person_id in del_person_ids:
-            self.driver.shell.DeletePersonFromSlice (person_id, slice_id)
+        with self.driver.shell.batch() as batch:
+            for person_id in del_person_ids:
+                batch.DeletePersonFromSlice (person_id, slice_id)
+        batch.results()
 
         # about the last 2 sets, for managing keys, we need to trace back person_id -> user
         # and for this we need all the Person objects; we already have the target_existing ones
@@ -529,9 +550,11 @@ class PlSlices:
         
         persons_to_verify_keys = {}
         # add 
-        for person_id in add_person_ids:
-            self.driver.shell.AddPersonToSlice(person_id, slice_id)
-            persons_to_verify_keys[person_id] = user_by_person_id(person_id)
+        with self.driver.shell.batch() as batch:
+            for person_id in add_person_ids:
+                batch.AddPersonToSlice(person_id, slice_id)
+                persons_to_verify_keys[person_id] = user_by_person_id(person_id)
+        batch.results()
         # Update kept persons
         for person_id in keep_person_ids:
             persons_to_verify_keys[person_id] = user_by_person_id(person_id)
@@ -544,16 +567,21 @@ class PlSlices:
     def verify_keys(self, persons_to_verify_keys, options=None):
         if options is None: options={}
         # we only add keys that comes from sfa to persons in PL
-        for person_id in persons_to_verify_keys:
-             person_sfa_keys = persons_to_verify_keys[person_id].get('keys', [])
-             person_pl_keys = self.driver.shell.GetKeys({'person_id': int(person_id)})
-             person_pl_keys_list = [key['key'] for key in person_pl_keys]
+        with self.driver.shell.batch() as batch:
+            pl_keys_by_person_id = dict ( [ (person_id, batch.GetKeys({'person_id': int(person_id)}))
+                                            for person_id in persons_to_verify_keys ] )
+        with self.driver.shell.batch() as batch:
+            for person_id in persons_to_verify_keys:
+                 person_sfa_keys = persons_to_verify_keys[person_id].get('keys', [])
+                 person_pl_keys = pl_keys_by_person_id[person_id].result()
+                 person_pl_keys_list = [key['key'] for key in person_pl_keys]
 
-             keys_to_add = set(person_sfa_keys).difference(person_pl_keys_list)
+                 keys_to_add = set(person_sfa_keys).difference(person_pl_keys_list)
 
-             for key_string in keys_to_add:
-                  key = {'key': key_string, 'key_type': 'ssh'}
-                  self.driver.shell.AddPersonKey(int(person_id), key)
+                 for key_string in keys_to_add:
+                      key = {'key': key_string, 'key_type': 'ssh'}
+                      batch.AddPersonKey(int(person_id), key)
+        batch.results()
 
 
     def verify_slice_attributes(self, slice, requested_slice_attributes, options=None, admin=False):
@@ -607,19 +635,25 @@ class PlSlices:
                     added_slice_attributes.append(requested_attribute)
 
 
-        # remove stale attributes
-        for attribute in removed_slice_attributes:
+        with self.driver.shell.batch() as batch:
+            # remove stale attributes
+            removed = [ (attribute, batch.DeleteSliceTag(attribute['slice_tag_id']))
+                        for attribute in removed_slice_attributes ]
+            # add requested_attributes
+            added = [ (attribute, batch.AddSliceTag(slice['name'], attribute['name'], 
+                                                    attribute['value'], attribute.get('node_id', None)))
+                      for attribute in added_slice_attributes ]
+
+        for (attribute, call) in removed:
             try:
-                self.driver.shell.DeleteSliceTag(attribute['slice_tag_id'])
+                call.result()
             except Exception, e:
                 logger.warn('Failed to remove sliver attribute. name: %s, value: %s, node_id: %s\nCause:%s'\
                                 % (slice['name'], attribute['value'],  attribute.get('node_id'), str(e)))
 
-        # add requested_attributes
-        for attribute in added_slice_attributes:
+        for (attribute, call) in added:
             try:
-                self.driver.shell.AddSliceTag(slice['name'], attribute['name'], 
-                                              attribute['value'], attribute.get('node_id', None))
+                call.result()
             except Exception, e:
                 logger.warn('Failed to add sliver attribute. name: %s, value: %s, node_id: %s\nCause:%s'\
                                 % (slice['name'], attribute['value'],  attribute.get('node_id'), str(e)))
@@ -11,20 +11,36 @@ from sfa.util.sfalogging import logger
 class Topology(set):
     """
     Parse the topology configuration file. 
+    The file is parsed once, and then again only when it gets modified
     """
 
+    # config_file -> (mtime, frozenset of site_id tuples)
+    _parsed = {}
+
     def __init__(self, config_file = "/etc/sfa/topology"):
         set.__init__(self) 
         try:
-            # load the links
-            f = open(config_file, 'r')
-            for line in f:
-                ignore = line.find('#')
-                if ignore > -1:
-                    line = line[0:ignore]
-                tup = line.split()
-                if len(tup) > 1:
-                    self.add((tup[0], tup[1]))    
+            mtime = os.stat(config_file).st_mtime
+            parsed = Topology._parsed.get(config_file)
+            if parsed is None or parsed[0] != mtime:
+                parsed = (mtime, frozenset(self.parse(config_file)))
+                Topology._parsed[config_file] = parsed
+            self.update(parsed[1])
         except Exception, e:
             logger.log_exc("Could not find or load the configuration file: %s" % config_file)
             raise
+
+    @staticmethod
+    def parse(config_file):
+        links = []
+        # load the links
+        f = open(config_file, 'r')
+        for line in f:
+            ignore = line.find('#')
+            if ignore > -1:
+                line = line[0:ignore]
+            tup = line.split()
+            if len(tup) > 1:
+                links.append((tup[0], tup[1]))    
+        f.close()
+        return links
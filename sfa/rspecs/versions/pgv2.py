@@ -1,5 +1,6 @@
 from copy import deepcopy
 from StringIO import StringIO
+from lxml import etree
 from sfa.util.xrn import Xrn
 from sfa.rspecs.version import RSpecVersion
 from sfa.rspecs.elements.versions.pgv2Link import PGv2Link
@@ -202,6 +203,40 @@ class PGv2(RSpecVersion):
         if isinstance(in_rspec, basestring):
             in_rspec = RSpec(in_rspec)
 
+        # same flavour: no need to go through the node objects
+        if in_rspec.xml.namespaces.get('default') == self.namespace:
+            self.merge_subtrees(in_rspec)
+        else:
+            self.merge_elements(in_rspec)
+
+    def merge_subtrees(self, in_rspec):
+        """
+        Move the nodes, links and leases of in_rspec - that must use the same 
+        namespace as this one - under our root element; in_rspec is emptied
+        """
+        root = self.xml.root.element
+        sliver_type_tag = '{%s}sliver_type' % self.namespace
+        for child in list(in_rspec.xml.root.element):
+            if not isinstance(child.tag, basestring):
+                # comments and the like
+                continue
+            tag = etree.QName(child).localname
+            if tag == 'node':
+                if not child.get('component_name'):
+                    # this node element is part of a lease
+                    continue
+                # protogeni rspecs need to advertise the available sliver types
+                if child.find(sliver_type_tag) is None:
+                    etree.SubElement(child, sliver_type_tag, name='plab-vserver')
+            elif tag not in ['link', 'lease']:
+                continue
+            root.append(child)
+
+    def merge_elements(self, in_rspec):
+        """
+        Merge in_rspec, possibly of another flavour, through the node,
+        link and lease objects
+        """
         nodes = in_rspec.version.get_nodes()
         # protogeni rspecs need to advertise the availabel sliver types
         main_nodes = []
@@ -218,12 +253,6 @@ class PGv2(RSpecVersion):
         # Leases
         leases = in_rspec.version.get_leases()
         self.add_leases(leases)
-        #
-        #rspec = RSpec(in_rspec)
-        #for child in rspec.xml.iterchildren():
-        #    self.xml.root.append(child)
-        
-        
 
     def cleanup(self):
         # remove unncecessary elements, attributes
@@ -0,0 +1,428 @@
+##
+# An event-driven alternative to ThreadedServer
+#
+# ThreadedServer hands each incoming connection over to one of its
+# threads, that then does the TLS handshake, reads the request, runs
+# the API call and writes the answer; a slow client thus ties up a
+# thread for as long as it takes, and connections are not reused.
+#
+# Here a single thread multiplexes all the connections with poll(),
+# and takes care of the TLS handshakes and of the HTTP framing; only
+# complete requests are handed over to a pool of worker threads that
+# run XmlrpcApi.handle(). Connections are kept alive between requests
+# (HTTP/1.1), and the server keeps track of its queue depth, see stats()
+#
+# Select with sfa-start.py --server-mode=event, or SFA_SERVER_MODE
+##
+
+from __future__ import with_statement
+
+import os
+import time
+import errno
+import socket
+import select
+import threading
+import xmlrpclib
+from collections import deque
+from Queue import Queue
+
+from OpenSSL import SSL
+
+from sfa.util.sfalogging import logger
+from sfa.util.cache import Cache, cache_stats
+from sfa.util.config import Config
+from sfa.trust.certificate import Certificate
+from sfa.server.threadedserver import make_ssl_context, server_workers
+
+# don't hard code an api class anymore here
+from sfa.generic import Generic
+
+# connection states
+HANDSHAKE = 'handshake'
+READING = 'reading'
+PROCESSING = 'processing'
+WRITING = 'writing'
+CLOSED = 'closed'
+
+class HttpError(Exception):
+    def __init__(self, code, reason):
+        Exception.__init__(self, "%s %s" % (code, reason))
+        self.code = code
+        self.reason = reason
+
+##
+# One client connection, and where we stand with it
+
+class Connection:
+
+    def __init__(self, server, sock, client_address):
+        self.server = server
+        self.sock = sock
+        self.fileno = sock.fileno()
+        self.client_address = client_address
+        self.ssl = SSL.Connection(server.ssl_context, sock)
+        self.ssl.set_accept_state()
+        self.state = HANDSHAKE
+        self.peer_cert = None
+        self.inbuf = ""
+        self.outbuf = ""
+        self.keep_alive = False
+        self.requests = 0
+        self.last_activity = time.time()
+
+    # the poll events we are interested in
+    def get_events(self, want=None):
+        if self.state == PROCESSING:
+            return 0
+        if want == 'write' or (want is None and self.state == WRITING):
+            return select.POLLOUT
+        return select.POLLIN
+
+    def do_handshake(self):
+        self.ssl.do_handshake()
+        self.peer_cert = Certificate()
+        self.peer_cert.load_from_pyopenssl_x509(self.ssl.get_peer_certificate())
+        self.state = READING
+
+    # read what's available, returns False when the peer is gone
+    def do_read(self):
+        while True:
+            try:
+                data = self.ssl.recv(65536)
+            except SSL.WantReadError:
+                return True
+            except (SSL.ZeroReturnError, SSL.SysCallError):
+                return False
+            if not data:
+                return False
+            self.inbuf += data
+            if len(self.inbuf) > self.server.max_request_size:
+                raise HttpError(413, "Request Entity Too Large")
+
+    # returns (headers, body) once a complete request is in, None otherwise
+    def parse_request(self):
+        end = self.inbuf.find("\r\n\r\n")
+        if end < 0:
+            if len(self.inbuf) > self.server.max_header_size:
+                raise HttpError(431, "Request Header Fields Too Large")
+            return None
+        lines = self.inbuf[:end].split("\r\n")
+        try:
+            (command, path, version) = lines[0].split()
+        except ValueError:
+            raise HttpError(400, "Bad Request")
+        headers = {}
+        for line in lines[1:]:
+            if ':' in line:
+                (name, value) = line.split(':', 1)
+                headers[name.strip().lower()] = value.strip()
+        if command != 'POST':
+            raise HttpError(501, "Unsupported method (%r)" % command)
+        if 'content-length' not in headers:
+            raise HttpError(411, "Length Required")
+        try:
+            length = int(headers['content-length'])
+        except ValueError:
+            raise HttpError(400, "Bad Request")
+        if len(self.inbuf) < end + 4 + length:
+            return None
+        body = self.inbuf[end+4:end+4+length]
+        self.inbuf = self.inbuf[end+4+length:]
+        connection = headers.get('connection', '').lower()
+        if version == 'HTTP/1.1':
+            self.keep_alive = connection != 'close'
+        else:
+            self.keep_alive = connection == 'keep-alive'
+        return (headers, body)
+
+    def set_response(self, body, code=200, reason="OK"):
+        headers = [ "HTTP/1.1 %d %s" % (code, reason),
+                    "Content-Type: text/xml",
+                    "Content-Length: %d" % len(body) ]
+        if self.keep_alive:
+            headers.append("Connection: keep-alive")
+        else:
+            headers.append("Connection: close")
+        self.outbuf = "\r\n".join(headers) + "\r\n\r\n" + body
+        self.state = WRITING
+
+    # write what we can, returns True when all has been sent
+    def do_write(self):
+        while self.outbuf:
+            try:
+                sent = self.ssl.send(self.outbuf[:65536])
+            except SSL.WantWriteError:
+                return False
+            self.outbuf = self.outbuf[sent:]
+        return True
+
+    def close(self):
+        self.state = CLOSED
+        try: self.ssl.shutdown()
+        except: pass
+        try: self.sock.close()
+        except: pass
+
+##
+# Implements an HTTPS xmlrpc server, with the same interface as ThreadedServer
+
+class EventServer:
+
+    allow_reuse_address = True
+    request_queue_size = 128
+    # seconds before an idle connection gets closed
+    keep_alive_timeout = 15
+    # seconds allowed for a handshake or a request to come in
+    request_timeout = 60
+    max_header_size = 64 * 1024
+    max_request_size = 64 * 1024 * 1024
+    # seconds between 2 reports of the server stats in the logs; 0 to disable
+    stats_period = 300
+
+    def __init__(self, server_address, key_file, cert_file, workers=None):
+        logger.debug("EventServer.__init__, server_address=%s, "
+                     "cert_file=%s, key_file=%s"%(server_address,cert_file,key_file))
+        self.server_address = server_address
+        self.interface = None
+        self.key_file = key_file
+        self.cert_file = cert_file
+        self.method_map = {}
+        self.cache = Cache(namespace='server', config=Config())
+        self.api_context = None
+        self.api_context_lock = threading.Lock()
+        self.workers = workers or server_workers()
+        self.ssl_context = make_ssl_context(key_file, cert_file, self)
+
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        if self.allow_reuse_address:
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.socket.bind(server_address)
+        self.socket.listen(self.request_queue_size)
+        self.socket.setblocking(0)
+
+        self.connections = {}
+        self.poller = select.poll()
+        self.poller.register(self.socket.fileno(), select.POLLIN)
+        # the worker threads post their results here, and wake us up through the pipe
+        self.requests = Queue()
+        self.results = deque()
+        (self.wakeup_read, self.wakeup_write) = os.pipe()
+        self.poller.register(self.wakeup_read, select.POLLIN)
+
+        # metrics
+        self.stats_lock = threading.Lock()
+        self.busy_workers = 0
+        self.max_queued = 0
+        self.handled = 0
+        self.kept_alive = 0
+        self.accepted = 0
+        self.last_stats = time.time()
+
+    # the part of SfaApi that is shared by all requests
+    def get_api_context(self):
+        if self.api_context is None:
+            with self.api_context_lock:
+                if self.api_context is None:
+                    generic = Generic.the_flavour()
+                    self.api_context = generic.make_api_context(interface = self.interface,
+                                                                key_file = self.key_file,
+                                                                cert_file = self.cert_file,
+                                                                cache = self.cache)
+        return self.api_context
+
+    def stats(self):
+        with self.stats_lock:
+            return { 'connections': len(self.connections),
+                     'queued': self.requests.qsize(),
+                     'max_queued': self.max_queued,
+                     'busy_workers': self.busy_workers,
+                     'workers': self.workers,
+                     'accepted': self.accepted,
+                     'handled': self.handled,
+                     'kept_alive': self.kept_alive,
+                     }
+
+    ########## the worker threads
+    def worker_thread(self):
+        while True:
+            (connection, body) = self.requests.get()
+            with self.stats_lock:
+                self.busy_workers += 1
+            try:
+                response = self.process_request(connection, body)
+            finally:
+                with self.stats_lock:
+                    self.busy_workers -= 1
+                    self.handled += 1
+            self.results.append( (connection, response) )
+            os.write(self.wakeup_write, 'x')
+
+    def process_request(self, connection, body):
+        api = None
+        try:
+            # the expensive part of the api is built once per server
+            api = self.get_api_context().make_api(peer_cert = connection.peer_cert)
+            api.remote_addr = connection.client_address
+            return api.handle(connection.client_address, body, self.method_map)
+        except Exception, fault:
+            # This should only happen if the module is buggy
+            logger.log_exc("EventServer.process_request")
+            if api is None:
+                return xmlrpclib.dumps(xmlrpclib.Fault(1, str(fault)), methodresponse = True)
+            return api.prepare_response(fault)
+        # avoid session/connection leaks : do this no matter what
+        finally:
+            if api is not None:
+                api.close_dbsession()
+
+    ########## the event loop
+    def serve_forever(self):
+        for x in range(self.workers):
+            t = threading.Thread(target = self.worker_thread)
+            t.setDaemon(1)
+            t.start()
+        logger.info("EventServer listening on %s:%s with %d workers" % \
+                    (self.server_address[0], self.server_address[1], self.workers))
+        while True:
+            self.handle_events(timeout=1.)
+
+    def handle_events(self, timeout=None):
+        try:
+            events = self.poller.poll(timeout * 1000 if timeout is not None else None)
+        except select.error, e:
+            if e.args[0] == errno.EINTR:
+                return
+            raise
+        for (fd, event) in events:
+            if fd == self.socket.fileno():
+                self.accept()
+            elif fd == self.wakeup_read:
+                os.read(self.wakeup_read, 4096)
+            elif fd in self.connections:
+                self.handle_connection(self.connections[fd], event)
+        self.handle_results()
+        self.check_timeouts()
+
+    def accept(self):
+        while True:
+            try:
+                (sock, client_address) = self.socket.accept()
+            except socket.error, e:
+                if e.args[0] not in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                    logger.warning("EventServer.accept: %s" % e)
+                return
+            sock.setblocking(0)
+            connection = Connection(self, sock, client_address)
+            self.connections[connection.fileno] = connection
+            self.poller.register(connection.fileno, select.POLLIN)
+            with self.stats_lock:
+                self.accepted += 1
+
+    def update_events(self, connection, want=None):
+        if connection.state != CLOSED:
+            self.poller.modify(connection.fileno, connection.get_events(want))
+
+    def close_connection(self, connection):
+        if connection.fileno in self.connections:
+            del self.connections[connection.fileno]
+            try: self.poller.unregister(connection.fileno)
+            except: pass
+        connection.close()
+
+    def handle_connection(self, connection, event):
+        connection.last_activity = time.time()
+        try:
+            if event & (select.POLLERR | select.POLLNVAL | select.POLLHUP):
+                self.close_connection(connection)
+                return
+            if connection.state == HANDSHAKE:
+                connection.do_handshake()
+            if connection.state == READING:
+                if not connection.do_read():
+                    self.close_connection(connection)
+                    return
+                request = connection.parse_request()
+                if request is not None:
+                    (headers, body) = request
+                    if connection.requests > 0:
+                        with self.stats_lock:
+                            self.kept_alive += 1
+                    connection.requests += 1
+                    connection.state = PROCESSING
+                    self.requests.put( (connection, body) )
+                    with self.stats_lock:
+                        self.max_queued = max(self.max_queued, self.requests.qsize())
+            if connection.state == WRITING:
+                self.write(connection)
+                return
+            self.update_events(connection)
+        except SSL.WantReadError:
+            self.update_events(connection, 'read')
+        except SSL.WantWriteError:
+            self.update_events(connection, 'write')
+        except HttpError, e:
+            logger.warning("EventServer: %s from %s" % (e, connection.client_address))
+            connection.keep_alive = False
+            connection.set_response("", e.code, e.reason)
+            self.write(connection)
+        except SSL.Error, e:
+            logger.debug("EventServer: SSL error with %s: %s" % (connection.client_address, e))
+            self.close_connection(connection)
+        except Exception, e:
+            logger.log_exc("EventServer.handle_connection")
+            self.close_connection(connection)
+
+    def write(self, connection):
+        try:
+            if not connection.do_write():
+                self.update_events(connection, 'write')
+                return
+        except SSL.WantReadError:
+            self.update_events(connection, 'read')
+            return
+        except SSL.Error, e:
+            logger.debug("EventServer: SSL error with %s: %s" % (connection.client_address, e))
+            self.close_connection(connection)
+            return
+        if not connection.keep_alive:
+            self.close_connection(connection)
+            return
+        connection.state = READING
+        self.update_events(connection)
+        # the next request may already be there
+        if connection.inbuf:
+            self.handle_connection(connection, 0)
+
+    def handle_results(self):
+        while self.results:
+            (connection, response) = self.results.popleft()
+            if connection.state == CLOSED:
+                continue
+            connection.last_activity = time.time()
+            connection.set_response(response)
+            self.write(connection)
+
+    def check_timeouts(self):
+        now = time.time()
+        for connection in self.connections.values():
+            if connection.state == PROCESSING:
+                continue
+            if connection.state == READING and not connection.inbuf:
+                timeout = self.keep_alive_timeout
+            else:
+                timeout = self.request_timeout
+            if now - connection.last_activity > timeout:
+                self.close_connection(connection)
+        if self.stats_period and now - self.last_stats > self.stats_period:
+            self.last_stats = now
+            logger.info("EventServer stats: %r" % self.stats())
+            logger.info("Cache stats: %r" % cache_stats())
+            # loaded here so that this module can be imported without a db server
+            from sfa.storage.alchemy import db_pool_stats
+            logger.info("DB pool stats: %r" % db_pool_stats())
+
+    def server_close(self):
+        for connection in self.connections.values():
+            self.close_connection(connection)
+        self.socket.close()
@@ -175,6 +175,9 @@ def main():
          help="refresh trusted certs", default=False)
     parser.add_option("-d", "--daemon", dest="daemon", action="store_true",
          help="Run as daemon.", default=False)
+    parser.add_option("-m", "--server-mode", dest="server_mode", choices=['threaded', 'event'],
+         help="threaded (one thread per connection) or event (event loop + worker pool)"
+              " - default is SFA_SERVER_MODE from the config", default=None)
     (options, args) = parser.parse_args()
     
     config = Config()
@@ -194,6 +197,10 @@ def main():
     
     if options.trusted_certs:
         install_peer_certs(server_key_file, server_cert_file)   
+
+    if options.server_mode:
+        from sfa.server.sfaserver import SfaServer
+        SfaServer.server_mode = options.server_mode
     
     # start registry server
     if (options.registry):
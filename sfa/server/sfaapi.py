@@ -1,5 +1,6 @@
 import os, os.path
 import datetime
+import threading
 
 from sfa.util.faults import SfaFault, SfaAPIError, RecordNotFound
 from sfa.util.genicode import GENICODE
@@ -10,11 +11,75 @@ from sfa.trust.auth import Auth
 from sfa.trust.certificate import Keypair, Certificate
 from sfa.trust.credential import Credential
 from sfa.trust.rights import determine_rights
+from sfa.trust.hierarchy import Hierarchy
 from sfa.util.version import version_core
 from sfa.server.xmlrpcapi import XmlrpcApi
 from sfa.client.return_value import ReturnValue
 
 from sfa.storage.alchemy import alchemy
+from sfa.managers.managerwrapper import ManagerWrapper
+
+####################
+class SfaApiContext:
+    """
+    The process-lifetime part of an SfaApi, i.e.
+    (*) the configuration, interface and hrn
+    (*) the server key and certificate
+    (*) the neighbour sfa services from /etc/sfa/{aggregates,registries}.xml
+    (*) the manager, and the testbed driver
+
+    All this is expensive to build, and does not change from one request
+    to the other; so a server builds one context (see Generic.make_api_context)
+    and then each incoming request gets a lightweight SfaApi on top of it,
+    that only holds the per-request stuff (peer cert, remote addr, db session)
+
+    The drivers - and the shells they use to reach the testbed - are not 
+    thread-safe, so there is one driver per thread; for the same reason 
+    the db session is per-thread, the driver sees it through self.api.dbsession()
+    """
+
+    def __init__ (self, generic, interface, config = "/etc/sfa/sfa_config",
+                  key_file = None, cert_file = None, cache = None):
+        self.generic = generic
+        self.config = Config(config)
+        self.interface = interface
+        self.hrn = self.config.SFA_INTERFACE_HRN
+        self.key_file = key_file
+        self.key = Keypair(filename=self.key_file)
+        self.cert_file = cert_file
+        self.cert = Certificate(filename=self.cert_file)
+        self.cache = cache
+        if self.cache is None:
+            self.cache = Cache(namespace='server', config=self.config)
+        self.hierarchy = Hierarchy()
+
+        # load registries
+        from sfa.server.registry import Registries
+        self.registries = Registries() 
+
+        # load aggregates
+        from sfa.server.aggregate import Aggregates
+        self.aggregates = Aggregates()
+
+        self.manager = ManagerWrapper(generic.make_manager(interface), interface, self.config)
+        self._local = threading.local()
+
+    # a new api object for an incoming request
+    def make_api (self, peer_cert = None):
+        return self.generic.make_api(peer_cert = peer_cert, context = self)
+
+    def get_driver (self):
+        driver = getattr(self._local, 'driver', None)
+        if driver is None:
+            driver = self.generic.make_driver(self)
+            self._local.driver = driver
+        return driver
+
+    def dbsession (self):
+        return alchemy.thread_session()
+
+    def close_dbsession (self):
+        alchemy.close_thread_session()
 
 ####################
 class SfaApi (XmlrpcApi): 
@@ -38,13 +103,35 @@ class SfaApi (XmlrpcApi):
     def __init__ (self, encoding="utf-8", methods='sfa.methods', 
                   config = "/etc/sfa/sfa_config", 
                   peer_cert = None, interface = None, 
-                  key_file = None, cert_file = None, cache = None):
+                  key_file = None, cert_file = None, cache = None,
+                  context = None):
         
         XmlrpcApi.__init__ (self, encoding)
         
         # we may be just be documenting the API
         if config is None:
             return
+
+        # the cheap way: reuse the process-lifetime stuff
+        self.context = context
+        if context is not None:
+            self.config = context.config
+            self.credential = None
+            self.auth = Auth(peer_cert, config=context.config, hierarchy=context.hierarchy)
+            self.interface = context.interface
+            self.hrn = context.hrn
+            self.key_file = context.key_file
+            self.key = context.key
+            self.cert_file = context.cert_file
+            self.cert = context.cert
+            self.cache = context.cache
+            self.registries = context.registries
+            self.aggregates = context.aggregates
+            self.manager = context.manager
+            self.driver = context.get_driver()
+            self._dbsession = None
+            return
+
         # Load configuration
         self.config = Config(config)
         self.credential = None
@@ -57,7 +144,7 @@ class SfaApi (XmlrpcApi):
         self.cert = Certificate(filename=self.cert_file)
         self.cache = cache
         if self.cache is None:
-            self.cache = Cache()
+            self.cache = Cache(namespace='server', config=self.config)
 
         # load registries
         from sfa.server.registry import Registries
@@ -77,25 +164,28 @@ class SfaApi (XmlrpcApi):
         credential to determine the caller and look for the caller's key/cert 
         in the registry hierarchy cache. 
         """       
-        from sfa.trust.hierarchy import Hierarchy
         if not isinstance(cred, Credential):
             cred_obj = Credential(string=cred)
         else:
             cred_obj = cred
         caller_gid = cred_obj.get_gid_caller()
-        hierarchy = Hierarchy()
-        auth_info = hierarchy.get_auth_info(caller_gid.get_hrn())
+        auth_info = self.auth.hierarchy.get_auth_info(caller_gid.get_hrn())
         key_file = auth_info.get_privkey_filename()
         cert_file = auth_info.get_gid_filename()
         server = interface.server_proxy(key_file, cert_file, timeout)
         return server
                
     def dbsession(self):
+        # shared with the driver
+        if self.context is not None:
+            return self.context.dbsession()
         if self._dbsession is None:
             self._dbsession=alchemy.session()
         return self._dbsession
 
     def close_dbsession(self):
+        if self.context is not None:
+            return self.context.close_dbsession()
         if self._dbsession is None: return
         alchemy.close_session(self._dbsession)
         self._dbsession=None
@@ -180,7 +270,7 @@ class SfaApi (XmlrpcApi):
         new_cred = Credential(subject = object_gid.get_subject())
         new_cred.set_gid_caller(object_gid)
         new_cred.set_gid_object(object_gid)
-        new_cred.set_issuer_keys(auth_info.get_privkey_filename(), auth_info.get_gid_filename())
+        new_cred.set_issuer_keys(auth_info.get_pkey_object(), auth_info.get_gid_object())
         
         r1 = determine_rights(type, hrn)
         new_cred.set_privileges(r1)
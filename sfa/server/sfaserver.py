@@ -11,6 +11,7 @@ import threading
 from sfa.server.threadedserver import ThreadedServer, SecureXMLRpcRequestHandler
 
 from sfa.util.sfalogging import logger
+from sfa.util.config import Config
 from sfa.trust.certificate import Keypair, Certificate
 
 ##
@@ -22,6 +23,10 @@ from sfa.trust.certificate import Keypair, Certificate
 
 class SfaServer(threading.Thread):
 
+    # 'threaded' or 'event' - None means SFA_SERVER_MODE from the config
+    # see sfa-start.py --server-mode
+    server_mode = None
+
     ##
     # Create a new SfaServer object.
     #
@@ -36,18 +41,26 @@ class SfaServer(threading.Thread):
         self.key = Keypair(filename = key_file)
         self.cert = Certificate(filename = cert_file)
         #self.server = SecureXMLRPCServer((ip, port), SecureXMLRpcRequestHandler, key_file, cert_file)
-        self.server = ThreadedServer((ip, int(port)), SecureXMLRpcRequestHandler, key_file, cert_file)
+        server_mode = SfaServer.server_mode or getattr(Config(), 'SFA_SERVER_MODE', 'threaded')
+        if server_mode == 'event':
+            from sfa.server.eventserver import EventServer
+            self.server = EventServer((ip, int(port)), key_file, cert_file)
+        else:
+            self.server = ThreadedServer((ip, int(port)), SecureXMLRpcRequestHandler, key_file, cert_file)
         self.server.interface=interface
         self.trusted_cert_list = None
         self.register_functions()
-        logger.info("Starting SfaServer, interface=%s"%interface)
+        logger.info("Starting SfaServer, interface=%s, server mode=%s"%(interface,server_mode))
 
     ##
     # Register functions that will be served by the XMLRPC server. This
     # function should be overridden by each descendant class.
 
     def register_functions(self):
-        self.server.register_function(self.noop)
+        # only ThreadedServer is a SimpleXMLRPCDispatcher, EventServer
+        # serves the sfa methods and nothing else
+        if hasattr(self.server, 'register_function'):
+            self.server.register_function(self.noop)
 
     ##
     # Sample no-op server function. The no-op function decodes the credential
@@ -6,6 +6,8 @@
 # TODO: investigate ways to combine this with existing PLC server?
 ##
 
+from __future__ import with_statement
+
 import sys
 import socket
 import traceback
@@ -81,6 +83,34 @@ def verify_callback(conn, x509, err, depth, preverify):
 
     return 0
 
+##
+# The SSL context used by the servers; peers need to present a certificate,
+# that is checked against the trusted roots (but see verify_callback)
+
+def make_ssl_context(key_file, cert_file, app_data=None):
+    ctx = SSL.Context(SSL.SSLv23_METHOD)
+    ctx.use_privatekey_file(key_file)        
+    ctx.use_certificate_file(cert_file)
+    # If you wanted to verify certs against known CAs.. this is how you would do it
+    #ctx.load_verify_locations('/etc/sfa/trusted_roots/plc.gpo.gid')
+    config = Config()
+    # this also loads the process-wide trusted roots store, that Auth will then reuse
+    trusted_cert_files = TrustedRoots(config.get_trustedroots_dir()).get_store().get_file_list()
+    for cert_file in trusted_cert_files:
+        ctx.load_verify_locations(cert_file)
+    ctx.set_verify(SSL.VERIFY_PEER | SSL.VERIFY_FAIL_IF_NO_PEER_CERT, verify_callback)
+    ctx.set_verify_depth(5)
+    ctx.set_app_data(app_data)
+    return ctx
+
+##
+# The number of threads that run the API calls
+# (SFA_SERVER_WORKERS in the config)
+
+def server_workers(config=None):
+    if config is None: config=Config()
+    return int(getattr(config, 'SFA_SERVER_WORKERS', 25))
+
 ##
 # taken from the web (XXX find reference). Implements HTTPS xmlrpc request handler
 class SecureXMLRpcRequestHandler(SimpleXMLRPCServer.SimpleXMLRPCRequestHandler):
@@ -102,12 +132,8 @@ class SecureXMLRpcRequestHandler(SimpleXMLRPCServer.SimpleXMLRPCRequestHandler):
         try:
             peer_cert = Certificate()
             peer_cert.load_from_pyopenssl_x509(self.connection.get_peer_certificate())
-            generic=Generic.the_flavour()
-            self.api = generic.make_api (peer_cert = peer_cert, 
-                                         interface = self.server.interface, 
-                                         key_file = self.server.key_file, 
-                                         cert_file = self.server.cert_file,
-                                         cache = self.cache)
+            # the expensive part of the api is built once per server
+            self.api = self.server.get_api_context().make_api(peer_cert = peer_cert)
             #logger.info("SecureXMLRpcRequestHandler.do_POST:")
             #logger.info("interface=%s"%self.server.interface)
             #logger.info("key_file=%s"%self.server.key_file)
@@ -157,31 +183,35 @@ class SecureXMLRPCServer(BaseHTTPServer.HTTPServer,SimpleXMLRPCServer.SimpleXMLR
         self.key_file = key_file
         self.cert_file = cert_file
         self.method_map = {}
+        # built upon the first request, once interface is known
+        self.api_context = None
+        self.api_context_lock = threading.Lock()
         # add cache to the request handler
-        HandlerClass.cache = Cache()
+        HandlerClass.cache = Cache(namespace='server', config=Config())
         #for compatibility with python 2.4 (centos53)
         if sys.version_info < (2, 5):
             SimpleXMLRPCServer.SimpleXMLRPCDispatcher.__init__(self)
         else:
            SimpleXMLRPCServer.SimpleXMLRPCDispatcher.__init__(self, True, None)
         SocketServer.BaseServer.__init__(self, server_address, HandlerClass)
-        ctx = SSL.Context(SSL.SSLv23_METHOD)
-        ctx.use_privatekey_file(key_file)        
-        ctx.use_certificate_file(cert_file)
-        # If you wanted to verify certs against known CAs.. this is how you would do it
-        #ctx.load_verify_locations('/etc/sfa/trusted_roots/plc.gpo.gid')
-        config = Config()
-        trusted_cert_files = TrustedRoots(config.get_trustedroots_dir()).get_file_list()
-        for cert_file in trusted_cert_files:
-            ctx.load_verify_locations(cert_file)
-        ctx.set_verify(SSL.VERIFY_PEER | SSL.VERIFY_FAIL_IF_NO_PEER_CERT, verify_callback)
-        ctx.set_verify_depth(5)
-        ctx.set_app_data(self)
+        ctx = make_ssl_context(key_file, cert_file, self)
         self.socket = SSL.Connection(ctx, socket.socket(self.address_family,
                                                         self.socket_type))
         self.server_bind()
         self.server_activate()
 
+    # the part of SfaApi that is shared by all requests
+    def get_api_context(self):
+        if self.api_context is None:
+            with self.api_context_lock:
+                if self.api_context is None:
+                    generic = Generic.the_flavour()
+                    self.api_context = generic.make_api_context(interface = self.interface,
+                                                                key_file = self.key_file,
+                                                                cert_file = self.cert_file,
+                                                                cache = self.RequestHandlerClass.cache)
+        return self.api_context
+
     # _dispatch
     #
     # Convert an exception on the server to a full stack trace and send it to
@@ -231,10 +261,8 @@ class ThreadPoolMixIn(SocketServer.ThreadingMixIn):
     """
     use a thread pool instead of a new thread on every request
     """
-    # XX TODO: Make this configurable
-    # config = Config()
-    # numThreads = config.SFA_SERVER_NUM_THREADS
-    numThreads = 25
+    # None means SFA_SERVER_WORKERS from the config
+    numThreads = None
     allow_reuse_address = True  # seems to fix socket.error on server restart
 
     def serve_forever(self):
@@ -244,7 +272,8 @@ class ThreadPoolMixIn(SocketServer.ThreadingMixIn):
         # set up the threadpool
         self.requests = Queue()
 
-        for x in range(self.numThreads):
+        numThreads = self.numThreads or server_workers()
+        for x in range(numThreads):
             t = threading.Thread(target = self.process_request_thread)
             t.setDaemon(1)
             t.start()
@@ -1,7 +1,10 @@
+from __future__ import with_statement
 from types import StringTypes
+import threading
 
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
+import sqlalchemy
+from sqlalchemy import create_engine, event
+from sqlalchemy.orm import sessionmaker, scoped_session
 
 from sqlalchemy import Column, Integer, String
 from sqlalchemy import ForeignKey
@@ -11,6 +14,84 @@ from sfa.util.sfalogging import logger
 # this module is designed to be loaded when the configured db server is reachable
 # OTOH model can be loaded from anywhere including the client-side
 
+# the engine - and so its connection pool - is shared by all the interfaces
+# that run in the process; the pool settings come from sfa_config
+def engine_options (config):
+    options = { 'pool_size' : int(getattr(config, 'SFA_DB_POOL_SIZE', 25)),
+                'max_overflow' : int(getattr(config, 'SFA_DB_MAX_OVERFLOW', 10)),
+                # seconds after which a connection gets renewed; -1 for never
+                'pool_recycle' : int(getattr(config, 'SFA_DB_POOL_RECYCLE', 3600)),
+                }
+    # test a connection before handing it out, so one that the
+    # server has dropped in the meanwhile does not fail a request
+    # create_engine rejects this option before sqlalchemy 1.2
+    if has_pre_ping():
+        options['pool_pre_ping'] = bool(getattr(config, 'SFA_DB_POOL_PRE_PING', True))
+    return options
+
+def has_pre_ping ():
+    try:
+        version = tuple([ int(x) for x in sqlalchemy.__version__.split('.')[:2] ])
+    except ValueError:
+        return False
+    return version >= (1,2)
+
+class PoolStats:
+    """
+    counts what happens in a connection pool; a steadily growing number of
+    connects means that connections get churned, a checked_out that sticks
+    to size+max_overflow means that the pool is exhausted
+    """
+
+    def __init__ (self, engine):
+        self.engine = engine
+        self.lock = threading.Lock()
+        self.connects = 0
+        self.checkouts = 0
+        self.checkins = 0
+        self.invalidated = 0
+        self.max_checked_out = 0
+        self.checked_out = 0
+        event.listen (engine, 'connect', self.on_connect)
+        event.listen (engine, 'checkout', self.on_checkout)
+        event.listen (engine, 'checkin', self.on_checkin)
+        event.listen (engine, 'invalidate', self.on_invalidate)
+
+    def on_connect (self, dbapi_connection, connection_record):
+        with self.lock:
+            self.connects += 1
+
+    def on_checkout (self, dbapi_connection, connection_record, connection_proxy):
+        with self.lock:
+            self.checkouts += 1
+            self.checked_out += 1
+            self.max_checked_out = max (self.max_checked_out, self.checked_out)
+
+    def on_checkin (self, dbapi_connection, connection_record):
+        with self.lock:
+            self.checkins += 1
+            self.checked_out = max (self.checked_out - 1, 0)
+
+    def on_invalidate (self, dbapi_connection, connection_record, exception):
+        with self.lock:
+            self.invalidated += 1
+
+    def stats (self):
+        pool = self.engine.pool
+        with self.lock:
+            stats = { 'connects' : self.connects,
+                      'checkouts' : self.checkouts,
+                      'checkins' : self.checkins,
+                      'invalidated' : self.invalidated,
+                      'checked_out' : self.checked_out,
+                      'max_checked_out' : self.max_checked_out,
+                      }
+        # QueuePool only
+        for name in [ 'size', 'checkedin', 'overflow' ]:
+            if hasattr (pool, name):
+                stats[name] = getattr (pool, name)()
+        return stats
+
 class Alchemy:
 
     def __init__ (self, config):
@@ -29,15 +110,27 @@ class Alchemy:
         # the TCP fallback method
         tcp_url = "postgresql+psycopg2://%s:%s@%s:%s/%s"%\
             (config.SFA_DB_USER,config.SFA_DB_PASSWORD,config.SFA_DB_HOST,config.SFA_DB_PORT,dbname)
+        options = engine_options (config)
+        if not has_pre_ping():
+            logger.info("sqlalchemy %s has no pool_pre_ping, stale db connections are not detected"%sqlalchemy.__version__)
+        # what to log - the urls carry the password
+        where = { unix_url : "unix socket, port %s"%config.SFA_DB_PORT,
+                  tcp_url : "%s:%s"%(config.SFA_DB_HOST,config.SFA_DB_PORT) }
         for url in [ unix_url, tcp_url ] :
             try:
                 logger.debug("Trying db URL %s"%url)
-                self.engine = create_engine (url)
+                self.engine = create_engine (url, **options)
                 self.check()
                 self.url=url
+                self.pool_stats = PoolStats (self.engine)
+                # build the session factories once
+                self.sessionmaker = sessionmaker (bind=self.engine)
+                # one session per thread, see scoped_dbsession below
+                self.scoped_session = scoped_session (self.sessionmaker)
+                logger.debug("db pool settings %r"%options)
                 return
             except:
-                pass
+                logger.log_exc("Could not connect to database %s through %s"%(dbname,where[url]))
         self.engine=None
         raise Exception,"Could not connect to database %s as %s with psycopg2"%(dbname,config.SFA_DB_USER)
 
@@ -51,8 +144,7 @@ class Alchemy:
 
     def global_session (self):
         if self._session is None:
-            Session=sessionmaker ()
-            self._session=Session(bind=self.engine)
+            self._session=self.sessionmaker()
             logger.debug('alchemy.global_session created session %s'%self._session)
         return self._session
 
@@ -64,8 +156,7 @@ class Alchemy:
 
     # create a dbsession to be managed separately
     def session (self):
-        Session=sessionmaker()
-        session=Session (bind=self.engine)
+        session=self.sessionmaker()
         logger.debug('alchemy.session created session %s'%session)
         return session
 
@@ -73,10 +164,24 @@ class Alchemy:
         logger.debug('alchemy.close_session closed session %s'%session)
         session.close()
 
+    # the session of the current thread, created on first use
+    def thread_session (self):
+        return self.scoped_session()
+
+    # close the current thread's session if any, and give its connection back to the pool
+    def close_thread_session (self):
+        if not self.scoped_session.registry.has(): return
+        self.scoped_session.remove()
+
 ####################
 from sfa.util.config import Config
 
 alchemy=Alchemy (Config())
 engine=alchemy.engine
 global_dbsession=alchemy.global_session()
+# the module-level, per-thread session factory used by the servers
+scoped_dbsession=alchemy.scoped_session
+
+def db_pool_stats ():
+    return alchemy.pool_stats.stats()
 
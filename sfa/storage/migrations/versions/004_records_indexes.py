@@ -0,0 +1,55 @@
+# this move is about indexing the records table on the columns that the registry
+# searches on: (type,hrn) in GetCredential/Resolve/Register, authority and hrn
+# prefixes in List, and (type,pointer) when going from testbed objects to records
+
+import sys
+
+from sqlalchemy import Table, MetaData, Column, Index
+from sqlalchemy import Integer, String
+from sqlalchemy.engine.reflection import Inspector
+from migrate.changeset.constraint import UniqueConstraint
+
+metadata=MetaData()
+
+records = \
+    Table ( 'records', metadata,
+            Column ('record_id', Integer, primary_key=True),
+            Column ('type', String),
+            Column ('hrn', String),
+            Column ('authority', String),
+            Column ('pointer', Integer),
+            )
+
+indexes = [
+    Index ('records_authority_idx', records.c.authority),
+    Index ('records_type_pointer_idx', records.c.type, records.c.pointer),
+    # also used for equality on hrn alone
+    Index ('records_hrn_pattern_idx', records.c.hrn, postgresql_ops={'hrn': 'text_pattern_ops'}),
+    ]
+
+type_hrn_key = UniqueConstraint ('type', 'hrn', table=records, name='records_type_hrn_key')
+# only if the db already has duplicates
+type_hrn_index = Index ('records_type_hrn_idx', records.c.type, records.c.hrn)
+
+def upgrade(migrate_engine):
+    metadata.bind = migrate_engine
+    for index in indexes:
+        index.create()
+    duplicates = migrate_engine.execute (
+        "select type, hrn from records group by type, hrn having count(*) > 1").fetchall()
+    if not duplicates:
+        type_hrn_key.create()
+    else:
+        print >> sys.stderr, "records: %d (type,hrn) pairs are not unique, e.g. %s - not adding records_type_hrn_key"%\
+            (len(duplicates), duplicates[0])
+        type_hrn_index.create()
+
+def downgrade(migrate_engine):
+    metadata.bind = migrate_engine
+    index_names = [ index['name'] for index in Inspector.from_engine(migrate_engine).get_indexes('records') ]
+    if type_hrn_index.name in index_names:
+        type_hrn_index.drop()
+    else:
+        type_hrn_key.drop()
+    for index in indexes:
+        index.drop()
@@ -4,6 +4,7 @@ from datetime import datetime
 from sqlalchemy import or_, and_ 
 from sqlalchemy import Column, Integer, String, DateTime
 from sqlalchemy import Table, Column, MetaData, join, ForeignKey
+from sqlalchemy import Index, UniqueConstraint
 from sqlalchemy.orm import relationship, backref
 from sqlalchemy.orm import column_property
 from sqlalchemy.orm import object_mapper
@@ -92,6 +93,13 @@ class RegRecord (Base,AlchemyObj):
     last_updated        = Column (DateTime)
     # use the 'type' column to decide which subclass the object is of
     __mapper_args__     = { 'polymorphic_on' : classtype }
+    # see migration 004 - the unique constraint also indexes (type,hrn)
+    # the pattern index serves lookups on hrn alone, including prefix searches in List
+    __table_args__      = ( UniqueConstraint ('type', 'hrn', name='records_type_hrn_key'),
+                            Index ('records_authority_idx', 'authority'),
+                            Index ('records_type_pointer_idx', 'type', 'pointer'),
+                            Index ('records_hrn_pattern_idx', 'hrn', postgresql_ops={'hrn': 'text_pattern_ops'}),
+                            )
 
     fields = [ 'type', 'hrn', 'gid', 'authority', 'peer_authority' ]
     def __init__ (self, type=None, hrn=None, gid=None, authority=None, peer_authority=None, 
@@ -457,6 +465,75 @@ augment_map={'authority': {'reg-pis':'reg_pis',},
              }
 
 def augment_with_sfa_builtins (local_record):
+    augment_records_with_sfa_builtins ([local_record])
+
+# how many record_ids go in one IN clause
+augment_chunk = 1000
+
+# do the same for a whole set of records at once, in a constant number of queries
+# per augment_chunk records rather than one query per record and relationship
+def augment_records_with_sfa_builtins (local_records):
+    # don't ruin the import of that file in a client world
+    from sfa.util.xrn import Xrn
+    from sqlalchemy.orm import object_session
+    dbsession = None
+    if local_records:
+        dbsession = object_session (local_records[0])
+    # detached records: use the relationships as-is
+    if dbsession is None:
+        for local_record in local_records:
+            augment_one_with_sfa_builtins (local_record)
+        return
+    ids_by_type = {}
+    for local_record in local_records:
+        ids_by_type.setdefault (local_record.type, []).append (local_record.record_id)
+    # record_id -> field_name -> list
+    fields = {}
+    def collect (field_name, query, ids):
+        for i in range (0, len(ids), augment_chunk):
+            for (record_id, value) in query (ids[i:i+augment_chunk]):
+                fields.setdefault (record_id, {}).setdefault (field_name, []).append (value)
+    # users have keys and this is needed to synthesize 'users' sent over to CreateSliver
+    user_ids = ids_by_type.get ('user', [])
+    collect ('reg-keys', lambda ids: dbsession.query (RegKey.record_id, RegKey.key)\
+                 .filter (RegKey.record_id.in_(ids)), user_ids)
+    collect ('reg-pi-authorities', lambda ids: dbsession.query (authority_pi_table.c.pi_id, RegRecord.hrn)\
+                 .join (RegRecord, RegRecord.record_id==authority_pi_table.c.authority_id)\
+                 .filter (authority_pi_table.c.pi_id.in_(ids)), user_ids)
+    collect ('reg-slices', lambda ids: dbsession.query (slice_researcher_table.c.researcher_id, RegRecord.hrn)\
+                 .join (RegRecord, RegRecord.record_id==slice_researcher_table.c.slice_id)\
+                 .filter (slice_researcher_table.c.researcher_id.in_(ids)), user_ids)
+    collect ('reg-pis', lambda ids: dbsession.query (authority_pi_table.c.authority_id, RegRecord.hrn)\
+                 .join (RegRecord, RegRecord.record_id==authority_pi_table.c.pi_id)\
+                 .filter (authority_pi_table.c.authority_id.in_(ids)), ids_by_type.get ('authority', []))
+    collect ('reg-researchers', lambda ids: dbsession.query (slice_researcher_table.c.slice_id, RegRecord.hrn)\
+                 .join (RegRecord, RegRecord.record_id==slice_researcher_table.c.researcher_id)\
+                 .filter (slice_researcher_table.c.slice_id.in_(ids)), ids_by_type.get ('slice', []))
+    for local_record in local_records:
+        # add a 'urn' field
+        setattr(local_record,'reg-urn',Xrn(xrn=local_record.hrn,type=local_record.type).urn)
+        record_fields = fields.get (local_record.record_id, {})
+        if local_record.type=='user':
+            setattr(local_record, 'reg-keys', record_fields.get ('reg-keys', []))
+        for field_name in augment_map.get(local_record.type,{}):
+            setattr (local_record, field_name, record_fields.get (field_name, []))
+
+# walk the records that a query returns, augment_chunk at a time,
+# and with a server-side cursor where the database supports it
+# so that only one chunk of records needs to be held in memory
+def iter_records_with_sfa_builtins (query, chunk=augment_chunk):
+    records = []
+    for record in query.yield_per (chunk):
+        records.append (record)
+        if len(records) >= chunk:
+            augment_records_with_sfa_builtins (records)
+            yield records
+            records = []
+    if records:
+        augment_records_with_sfa_builtins (records)
+        yield records
+
+def augment_one_with_sfa_builtins (local_record):
     # don't ruin the import of that file in a client world
     from sfa.util.xrn import Xrn
     # add a 'urn' field
@@ -474,4 +551,3 @@ def augment_with_sfa_builtins (local_record):
         hrns = [ r.hrn for r in related_records ]
         setattr (local_record, field_name, hrns)
     
-
@@ -17,6 +17,7 @@ from sfa.trust.rights import Rights
 from sfa.trust.certificate import Keypair, Certificate
 from sfa.trust.credential import Credential
 from sfa.trust.trustedroots import TrustedRoots
+from sfa.trust.credential_cache import VerifiedCredentials
 from sfa.trust.hierarchy import Hierarchy
 from sfa.trust.sfaticket import SfaTicket
 from sfa.trust.speaksfor_util import determine_speaks_for
@@ -27,18 +28,25 @@ class Auth:
     Credential based authentication
     """
 
-    def __init__(self, peer_cert = None, config = None ):
+    def __init__(self, peer_cert = None, config = None, hierarchy = None):
         self.peer_cert = peer_cert
-        self.hierarchy = Hierarchy()
+        # config and hierarchy can be shared among instances, see SfaApiContext
         if not config:
-            self.config = Config()
+            config = Config()
+        self.config = config
+        if not hierarchy:
+            hierarchy = Hierarchy()
+        self.hierarchy = hierarchy
         self.load_trusted_certs()
 
     def load_trusted_certs(self):
-        self.trusted_cert_list = \
-            TrustedRoots(self.config.get_trustedroots_dir()).get_list()
-        self.trusted_cert_file_list = \
-            TrustedRoots(self.config.get_trustedroots_dir()).get_file_list()
+        # this is shared among all Auth instances, and only
+        # reloaded when the contents of the directory change
+        trusted_roots = TrustedRoots(self.config.get_trustedroots_dir()).get_store()
+        self.trusted_cert_list = trusted_roots.get_list()
+        self.trusted_cert_file_list = trusted_roots.get_file_list()
+        # identifies the set of trusted roots in the verified credentials cache
+        self.trusted_roots_fingerprint = trusted_roots.get_fingerprint()
 
     # this convenience methods extracts speaking_for_xrn
     # from the passed options using 'geni_speaking_for'
@@ -157,8 +165,7 @@ class Auth:
                 raise InsufficientRights(operation)
 
         if self.trusted_cert_list:
-            self.client_cred.verify(self.trusted_cert_file_list,
-                                    self.config.SFA_CREDENTIAL_SCHEMA)
+            self.verify_credential(self.client_cred)
         else:
            raise MissingTrustedRoots(self.config.get_trustedroots_dir())
        
@@ -172,6 +179,25 @@ class Auth:
                                        (target_hrn, hrn) )       
         return True
 
+    def verify_credential(self, cred):
+        """
+        Run Credential.verify unless this very credential has already
+        been verified against the current trusted roots
+        """
+        verified_credentials = VerifiedCredentials()
+        max_entries = getattr(self.config, 'SFA_CREDENTIAL_CACHE_SIZE', None)
+        if max_entries is not None:
+            verified_credentials.max_entries = max_entries
+        xml = cred.get_xml()
+        if verified_credentials.is_verified(xml, self.trusted_roots_fingerprint):
+            logger.debug("Auth.verify_credential: credential already verified")
+            return True
+        cred.verify(self.trusted_cert_file_list,
+                    self.config.SFA_CREDENTIAL_SCHEMA,
+                    backend=getattr(self.config, 'SFA_CREDENTIAL_VERIFIER', None) or None)
+        verified_credentials.add(xml, self.trusted_roots_fingerprint, cred.get_chain_expiration())
+        return True
+
     def check_ticket(self, ticket):
         """
         Check if the ticket was signed by a trusted cert
@@ -35,10 +35,16 @@
 ##
 #
 
+from __future__ import with_statement
+
 import functools
 import os
+import datetime
 import tempfile
 import base64
+import hashlib
+import threading
+from collections import OrderedDict
 from tempfile import mkstemp
 
 from OpenSSL import crypto
@@ -287,6 +293,106 @@ class Keypair:
         if filename: result += "Filename %s\n"%filename
         return result
 
+##
+# VerifiedSigners: remembers the (certificate, issuer public key) pairs
+# for which the signature has already been checked, so that walking up
+# a GID chain costs one lookup per link instead of one RSA operation per
+# candidate signer. A signature does not change over time, so entries
+# never become stale; expiration is checked separately
+# memory-only - thread-safe - bounded (least recently used entries go first)
+
+class _verified_signers_impl:
+
+    _instance = None
+    max_entries = 10000
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    # @param key as returned by Certificate.get_signer_key
+    def is_verified(self, key):
+        with self._lock:
+            if self._entries.pop(key, None) is None:
+                self.misses += 1
+                return False
+            self._entries[key] = True
+            self.hits += 1
+            return True
+
+    def add(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = True
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def stats(self):
+        return {'entries': len(self._entries), 'max_entries': self.max_entries,
+                'hits': self.hits, 'misses': self.misses}
+
+def VerifiedSigners ():
+    if not _verified_signers_impl._instance:
+        _verified_signers_impl._instance = _verified_signers_impl()
+    return _verified_signers_impl._instance
+
+##
+# IssuerIndex: a set of trusted certs, indexed by subject and by subject
+# key identifier, so that verify_chain only tries the roots that may have
+# issued a given certificate
+# the index for a given list of trusted certs is built once and then
+# reused, see issuer_index(); this works as long as the callers pass the
+# same certificate objects, as the trusted roots store does
+
+class IssuerIndex:
+
+    def __init__(self, trusted_certs):
+        self.by_subject = {}
+        self.by_key_id = {}
+        for trusted_cert in trusted_certs:
+            self.by_subject.setdefault(subject_key(trusted_cert.x509.get_subject()), []).append(trusted_cert)
+            key_id = trusted_cert.get_key_identifier('subjectKeyIdentifier')
+            if key_id:
+                self.by_key_id.setdefault(key_id, []).append(trusted_cert)
+
+    # the trusted certs that may have signed cert
+    def get_candidates(self, cert):
+        key_id = cert.get_key_identifier('authorityKeyIdentifier')
+        if key_id and key_id in self.by_key_id:
+            return self.by_key_id[key_id]
+        return self.by_subject.get(subject_key(cert.x509.get_issuer()), [])
+
+_issuer_indexes = OrderedDict()
+_issuer_indexes_lock = threading.Lock()
+_issuer_indexes_max = 16
+
+def issuer_index(trusted_certs):
+    # the index keeps a reference to the certs, so their ids remain valid
+    key = tuple([ id(trusted_cert) for trusted_cert in trusted_certs ])
+    with _issuer_indexes_lock:
+        entry = _issuer_indexes.pop(key, None)
+        if entry is not None:
+            _issuer_indexes[key] = entry
+            return entry[1]
+    index = IssuerIndex(trusted_certs)
+    with _issuer_indexes_lock:
+        _issuer_indexes[key] = (list(trusted_certs), index)
+        while len(_issuer_indexes) > _issuer_indexes_max:
+            _issuer_indexes.popitem(last=False)
+    return index
+
+def subject_key(x509name):
+    return tuple(x509name.get_components())
+
 ##
 # The certificate class implements a general purpose X509 certificate, making
 # use of the appropriate pyOpenSSL or M2Crypto abstractions. It also adds
@@ -679,10 +785,53 @@ class Certificate:
     # @param cert certificate object
 
     def is_signed_by_cert(self, cert):
+        signers = VerifiedSigners()
+        key = self.get_signer_key(cert)
+        if signers.is_verified(key):
+            return True
         k = cert.get_pubkey()
         result = self.verify(k)
+        if result:
+            signers.add(key)
         return result
 
+    ##
+    # Identifies this certificate, i.e. the sha1 of its DER encoding
+
+    def get_fingerprint(self):
+        return hashlib.sha1(crypto.dump_certificate(crypto.FILETYPE_ASN1, self.x509)).hexdigest()
+
+    ##
+    # Identifies the public key in this certificate
+
+    def get_pubkey_fingerprint(self):
+        if hasattr(crypto, 'dump_publickey'):
+            der = crypto.dump_publickey(crypto.FILETYPE_ASN1, self.x509.get_pubkey())
+        else:
+            der = self.get_pubkey().get_pubkey_string()
+        return hashlib.sha1(der).hexdigest()
+
+    # the key of this (certificate, signer) pair in VerifiedSigners
+    def get_signer_key(self, cert):
+        return (self.get_fingerprint(), cert.get_pubkey_fingerprint())
+
+    ##
+    # Return the key identifier found in the subjectKeyIdentifier or
+    # authorityKeyIdentifier extension, or None
+
+    def get_key_identifier(self, name):
+        for i in range(self.x509.get_extension_count()):
+            extension = self.x509.get_extension(i)
+            if extension.get_short_name() != name:
+                continue
+            for line in str(extension).splitlines():
+                line = line.strip()
+                if line.startswith('keyid:'):
+                    line = line[len('keyid:'):]
+                if line:
+                    return line.upper()
+        return None
+
     ##
     # Set the parent certficiate.
     #
@@ -697,6 +846,16 @@ class Certificate:
     def get_parent(self):
         return self.parent
 
+    ##
+    # Return the end of the validity period, as a naive UTC datetime, or
+    # None if it is not set
+
+    def get_expiration(self):
+        not_after = self.x509.get_notAfter()
+        if not not_after:
+            return None
+        return datetime.datetime.strptime(not_after, "%Y%m%d%H%M%SZ")
+
     ##
     # Verification examines a chain of certificates to ensure that each parent
     # signs the child, and that some certificate in the chain is signed by a
@@ -730,7 +889,8 @@ class Certificate:
             raise CertExpired(self.pretty_cert(), "client cert")
 
         # if this cert is signed by a trusted_cert, then we are set
-        for trusted_cert in trusted_certs:
+        # only the trusted certs that match our issuer need be tried
+        for trusted_cert in issuer_index(trusted_certs).get_candidates(self):
             if self.is_signed_by_cert(trusted_cert):
                 # verify expiration of trusted_cert ?
                 if not trusted_cert.x509.has_expired():
@@ -47,12 +47,29 @@ from sfa.util.faults import CredentialNotVerifiable, ChildRightsNotSubsetOfParen
 from sfa.util.sfalogging import logger
 from sfa.util.sfatime import utcparse, SFATIME_FORMAT
 from sfa.trust.rights import Right, Rights, determine_rights
+from sfa.trust.certificate import Keypair
 from sfa.trust.gid import GID
+from sfa.trust.trustedroots import load_trusted_gid
 from sfa.util.xrn import urn_to_hrn, hrn_authfor_hrn
 
+if HAVELXML:
+    from sfa.trust import xmlsig
+
 # 31 days, in seconds 
 DEFAULT_CREDENTIAL_LIFETIME = 86400 * 28
 
+##
+# The xml signatures in a credential can be checked either
+# 'native'ly, i.e. in-process (this requires lxml), or by running
+# 'xmlsec1' once per signature in the delegation chain
+# the server side picks one with SFA_CREDENTIAL_VERIFIER, see Auth
+
+verify_backends = [ 'native', 'xmlsec1' ]
+default_verify_backend = 'native'
+
+# same for creating the signature in Credential.sign
+default_sign_backend = 'native'
+
 
 # TODO:
 # . make privs match between PG and PL
@@ -313,13 +330,24 @@ class Credential(object):
         
     ##
     # Need the issuer's private key and name
-    # @param key Keypair object containing the private key of the issuer
-    # @param gid GID of the issuing authority
+    # @param key Keypair object containing the private key of the issuer,
+    #     or the name of the file that holds it
+    # @param gid GID of the issuing authority, or the name of the file that holds it
 
     def set_issuer_keys(self, privkey, gid):
         self.issuer_privkey = privkey
         self.issuer_gid = gid
 
+    def get_issuer_pkey_object(self):
+        if isinstance(self.issuer_privkey, StringTypes):
+            return Keypair(filename=self.issuer_privkey)
+        return self.issuer_privkey
+
+    def get_issuer_gid_object(self):
+        if isinstance(self.issuer_gid, StringTypes):
+            return GID(filename=self.issuer_gid)
+        return self.issuer_gid
+
 
     ##
     # Set this credential's parent
@@ -380,6 +408,23 @@ class Credential(object):
         # at this point self.expiration is normalized as a datetime - DON'T call utcparse again
         return self.expiration
 
+    ##
+    # get the earliest expiration among this credential, its parents, and the
+    # caller and object GIDs they carry (with their own parents); this is
+    # how long a successful verify() holds
+
+    def get_chain_expiration(self):
+        expirations = []
+        cred = self
+        while cred:
+            expirations.append(cred.get_expiration())
+            for gid in [ cred.get_gid_caller(), cred.get_gid_object() ]:
+                while gid:
+                    expirations.append(gid.get_expiration())
+                    gid = gid.get_parent()
+            cred = cred.parent
+        return min([ expiration for expiration in expirations if expiration is not None ])
+
     ##
     # set the privileges
     #
@@ -614,7 +659,8 @@ class Credential(object):
     # not be changed else the signature is no longer valid.  So, once
     # you have loaded an existing signed credential, do not call encode() or sign() on it.
 
-    def sign(self):
+    # @param backend: 'native' or 'xmlsec1', defaults to default_sign_backend
+    def sign(self, backend=None):
         if not self.issuer_privkey or not self.issuer_gid:
             return
         doc = parseString(self.get_xml())
@@ -629,33 +675,61 @@ class Credential(object):
 
         self.xml = doc.toxml()
 
-
-        # Split the issuer GID into multiple certificates if it's a chain
-        chain = GID(filename=self.issuer_gid)
-        gid_files = []
-        while chain:
-            gid_files.append(chain.save_to_random_tmp_file(False))
-            if chain.get_parent():
-                chain = chain.get_parent()
-            else:
-                chain = None
-
-
-        # Call out to xmlsec1 to sign it
+        # the issuer GID and its parents, if it's a chain
+        chain = []
+        gid = self.get_issuer_gid_object()
+        while gid:
+            chain.append(gid)
+            gid = gid.get_parent()
+
+        if backend is None:
+            backend = default_sign_backend
+        if backend == 'native' and not HAVELXML:
+            logger.warning("Credential.sign: lxml not available, falling back to xmlsec1")
+            backend = 'xmlsec1'
         ref = 'Sig_%s' % self.get_refid()
-        filename = self.save_to_random_tmp_file()
-        signed = os.popen('%s --sign --node-id "%s" --privkey-pem %s,%s %s' \
-                 % (self.xmlsec_path, ref, self.issuer_privkey, ",".join(gid_files), filename)).read()
-        os.remove(filename)
-
-        for gid_file in gid_files:
-            os.remove(gid_file)
-
-        self.xml = signed
+        if backend == 'native':
+            self.xml = self.sign_native(ref, chain)
+        else:
+            self.xml = self.sign_xmlsec1(ref, chain)
 
         # Update signatures
         self.decode()       
 
+    ##
+    # Fill in the signature template in-process, this produces
+    # the same output as xmlsec1
+    def sign_native(self, ref, chain):
+        root = xmlsig.parse(self.xml)
+        pkey = self.get_issuer_pkey_object().get_openssl_pkey()
+        xmlsig.sign_signature(root, ref, pkey, chain)
+        return xmlsig.serialize(root)
+
+    ##
+    # Call out to xmlsec1 to sign it
+    def sign_xmlsec1(self, ref, chain):
+        # Split the issuer GID into multiple certificates
+        gid_files = [ gid.save_to_random_tmp_file(False) for gid in chain ]
+        privkey_file = None
+        if isinstance(self.issuer_privkey, StringTypes):
+            privkey_filename = self.issuer_privkey
+        else:
+            (fd, privkey_file) = mkstemp(suffix='pkey')
+            os.write(fd, self.issuer_privkey.as_pem())
+            os.close(fd)
+            privkey_filename = privkey_file
+        filename = self.save_to_random_tmp_file()
+        try:
+            signed = os.popen('%s --sign --node-id "%s" --privkey-pem %s,%s %s' \
+                     % (self.xmlsec_path, ref, privkey_filename, ",".join(gid_files), filename)).read()
+        finally:
+            os.remove(filename)
+            for gid_file in gid_files:
+                os.remove(gid_file)
+            if privkey_file:
+                os.remove(privkey_file)
+        return signed
+
         
     ##
     # Retrieve the attributes of the credential from the XML.
@@ -764,7 +838,13 @@ class Credential(object):
     #   must be done elsewhere
     #
     # @param trusted_certs: The certificates of trusted CA certificates
-    def verify(self, trusted_certs=None, schema=None, trusted_certs_required=True):
+    # @param backend: 'native' or 'xmlsec1', defaults to default_verify_backend
+    def verify(self, trusted_certs=None, schema=None, trusted_certs_required=True, backend=None):
+        if backend is None:
+            backend = default_verify_backend
+        if backend not in verify_backends:
+            raise ValueError("unknown credential verify backend %s - expecting one of %r" % \
+                             (backend, verify_backends))
         if not self.xml:
             self.decode()
 
@@ -792,7 +872,8 @@ class Credential(object):
                 try:
                     # Failures here include unreadable files
                     # or non PEM files
-                    trusted_cert_objects.append(GID(filename=f))
+                    # files from a trusted roots directory are parsed only once
+                    trusted_cert_objects.append(load_trusted_gid(f))
                     ok_trusted_certs.append(f)
                 except Exception, exc:
                     logger.error("Failed to load trusted cert from %s: %r"%( f, exc))
@@ -804,9 +885,6 @@ class Credential(object):
                                           (self.pretty_cred(),
                                            self.expiration.strftime(SFATIME_FORMAT)))
 
-        # Verify the signatures
-        filename = self.save_to_random_tmp_file()
-
         # If caller explicitly passed in None that means skip cert chain validation.
         # - Strange and not typical
         if trusted_certs is not None:
@@ -822,42 +900,17 @@ class Credential(object):
         for ref in parentRefs:
             refs.append("Sig_%s" % ref)
 
-        for ref in refs:
-            # If caller explicitly passed in None that means skip xmlsec1 validation.
-            # Strange and not typical
-            if trusted_certs is None:
-                break
-
-            # Thierry - jan 2015
-            # up to fedora20 we used os.popen and checked that the output begins with OK
-            # turns out, with fedora21, there is extra input before this 'OK' thing
-            # looks like we're better off just using the exit code - that's what it is made for
-            #cert_args = " ".join(['--trusted-pem %s' % x for x in trusted_certs])
-            #command = '{} --verify --node-id "{}" {} {} 2>&1'.\
-            #          format(self.xmlsec_path, ref, cert_args, filename)
-            command = [ self.xmlsec_path, '--verify', '--node-id', ref ]
-            for trusted in trusted_certs:
-                command += ["--trusted-pem", trusted ]
-            command += [ filename ]
-            logger.debug("Running " + " ".join(command))
-            try:
-                verified = subprocess.check_output(command, stderr=subprocess.STDOUT)
-                logger.debug("xmlsec command returned {}".format(verified))
-                if "OK\n" not in verified:
-                    logger.warning("WARNING: xmlsec1 seemed to return fine but without a OK in its output")
-            except subprocess.CalledProcessError as e:
-                verified = e.output
-                # xmlsec errors have a msg= which is the interesting bit.
-                mstart = verified.find("msg=")
-                msg = ""
-                if mstart > -1 and len(verified) > 4:
-                    mstart = mstart + 4
-                    mend = verified.find('\\', mstart)
-                    msg = verified[mstart:mend]
-                logger.warning("Credential.verify - failed - xmlsec1 returned {}".format(verified.strip()))
-                raise CredentialNotVerifiable("xmlsec1 error verifying cred %s using Signature ID %s: %s" % \
-                                              (self.pretty_cred(), ref, msg))
-        os.remove(filename)
+        # Verify the signatures
+        # If caller explicitly passed in None that means skip signature validation.
+        # Strange and not typical
+        if trusted_certs is not None:
+            if backend == 'native' and not HAVELXML:
+                logger.warning("Credential.verify: lxml not available, falling back to xmlsec1")
+                backend = 'xmlsec1'
+            if backend == 'native':
+                self.verify_signatures_native(refs, trusted_cert_objects)
+            else:
+                self.verify_signatures_xmlsec1(refs, trusted_certs)
 
         # Verify the parents (delegation)
         if self.parent:
@@ -868,6 +921,62 @@ class Credential(object):
         self.verify_issuer(trusted_cert_objects)
         return True
 
+    ##
+    # Check the xml signatures in-process, see sfa.trust.xmlsig
+    #
+    # @param refs the ids of the Signature elements to check
+    # @param trusted_cert_objects a list of trusted GID objects
+    def verify_signatures_native(self, refs, trusted_cert_objects):
+        root = xmlsig.parse(self.xml)
+        for ref in refs:
+            try:
+                xmlsig.verify_signature(root, ref, trusted_cert_objects)
+            except CredentialNotVerifiable, e:
+                logger.warning("Credential.verify - failed - {}".format(e.value))
+                raise CredentialNotVerifiable("error verifying cred %s using Signature ID %s: %s" % \
+                                              (self.pretty_cred(), ref, e.value))
+
+    ##
+    # Check the xml signatures by running xmlsec1 once per signature
+    #
+    # @param refs the ids of the Signature elements to check
+    # @param trusted_certs a list of trusted GID filenames
+    def verify_signatures_xmlsec1(self, refs, trusted_certs):
+        filename = self.save_to_random_tmp_file()
+        try:
+            for ref in refs:
+                # Thierry - jan 2015
+                # up to fedora20 we used os.popen and checked that the output begins with OK
+                # turns out, with fedora21, there is extra input before this 'OK' thing
+                # looks like we're better off just using the exit code - that's what it is made for
+                #cert_args = " ".join(['--trusted-pem %s' % x for x in trusted_certs])
+                #command = '{} --verify --node-id "{}" {} {} 2>&1'.\
+                #          format(self.xmlsec_path, ref, cert_args, filename)
+                command = [ self.xmlsec_path, '--verify', '--node-id', ref ]
+                for trusted in trusted_certs:
+                    command += ["--trusted-pem", trusted ]
+                command += [ filename ]
+                logger.debug("Running " + " ".join(command))
+                try:
+                    verified = subprocess.check_output(command, stderr=subprocess.STDOUT)
+                    logger.debug("xmlsec command returned {}".format(verified))
+                    if "OK\n" not in verified:
+                        logger.warning("WARNING: xmlsec1 seemed to return fine but without a OK in its output")
+                except subprocess.CalledProcessError as e:
+                    verified = e.output
+                    # xmlsec errors have a msg= which is the interesting bit.
+                    mstart = verified.find("msg=")
+                    msg = ""
+                    if mstart > -1 and len(verified) > 4:
+                        mstart = mstart + 4
+                        mend = verified.find('\\', mstart)
+                        msg = verified[mstart:mend]
+                    logger.warning("Credential.verify - failed - xmlsec1 returned {}".format(verified.strip()))
+                    raise CredentialNotVerifiable("xmlsec1 error verifying cred %s using Signature ID %s: %s" % \
+                                                  (self.pretty_cred(), ref, msg))
+        finally:
+            os.remove(filename)
+
     ##
     # Creates a list of the credential and its parents, with the root 
     # (original delegated credential) as the last item in the list
@@ -0,0 +1,94 @@
+from __future__ import with_statement
+
+import threading
+import hashlib
+import datetime
+from collections import OrderedDict
+
+from sfa.util.sfalogging import logger
+
+"""
+VerifiedCredentials: remembers the credentials that went successfully
+through Credential.verify, so that the crypto part of Auth.check runs
+once per credential and not once per call
+memory-only - thread-safe - bounded (least recently used entries go first)
+implemented as a (singleton) hash (xml digest, roots fingerprint)->expiration
+
+the rights and target checks are NOT cached, they are cheap and depend
+on the call being made
+"""
+
+debug=False
+
+class _verified_credentials_impl:
+
+    _instance = None
+    # default number of credentials that we remember
+    max_entries = 1000
+
+    def __init__(self, max_entries=None):
+        if max_entries is not None:
+            self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._roots_fingerprint = None
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def digest(xml):
+        if isinstance(xml, unicode):
+            xml = xml.encode('utf-8')
+        return hashlib.sha1(xml).hexdigest()
+
+    # entries are only valid for one set of trusted roots
+    # so start afresh as soon as we see another set
+    def _check_roots(self, roots_fingerprint):
+        if roots_fingerprint != self._roots_fingerprint:
+            if self._entries and debug:
+                logger.debug("VerifiedCredentials: trusted roots changed, flushing %d entries"%len(self._entries))
+            self._entries.clear()
+            self._roots_fingerprint = roots_fingerprint
+
+    # return True if this credential has already been verified against these roots
+    def is_verified(self, xml, roots_fingerprint):
+        key = self.digest(xml)
+        with self._lock:
+            self._check_roots(roots_fingerprint)
+            expiration = self._entries.pop(key, None)
+            if expiration is None or expiration < datetime.datetime.utcnow():
+                self.misses += 1
+                return False
+            # mark as most recently used
+            self._entries[key] = expiration
+            self.hits += 1
+            return True
+
+    # remember a credential that was successfully verified against these roots
+    # @param expiration the credential's get_chain_expiration()
+    def add(self, xml, roots_fingerprint, expiration):
+        if self.max_entries <= 0:
+            return
+        key = self.digest(xml)
+        with self._lock:
+            self._check_roots(roots_fingerprint)
+            self._entries.pop(key, None)
+            self._entries[key] = expiration
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def stats(self):
+        return {'entries': len(self._entries), 'max_entries': self.max_entries,
+                'hits': self.hits, 'misses': self.misses}
+
+def VerifiedCredentials ():
+    if not _verified_credentials_impl._instance:
+        _verified_credentials_impl._instance = _verified_credentials_impl()
+    return _verified_credentials_impl._instance
@@ -0,0 +1,181 @@
+from __future__ import with_statement
+
+import threading
+from collections import deque
+
+from sfa.util.sfalogging import logger
+from sfa.trust.certificate import Keypair
+from sfa.trust.gid import GID
+from sfa.trust.hierarchy import Hierarchy
+
+"""
+GidFactory: creates keypairs and GIDs in a pool of worker processes
+
+generating a RSA keypair and signing a GID are CPU-bound, so threads
+would not help; the factory keeps a stock of keypairs that the workers
+generate in the background, so that keypair() returns right away,
+and create_gid_async() signs GIDs in parallel, each worker loading
+the authority keys it needs only once (see hierarchy.load_pkey)
+
+one (singleton) instance per authorities directory, meant for the
+importers - sfaadmin runs them in a process of their own; forking
+workers from a multithreaded server is not safe, so the registry
+manager makes its keypairs in-process
+keypairs and GIDs travel between processes as PEM strings
+
+if no worker process can be started, everything is done in-process;
+a worker that dies takes the jobs it was running with it, so the
+waits on the workers are bounded
+"""
+
+# the worker side
+_worker_hierarchy = None
+
+def _init_worker (basedir):
+    global _worker_hierarchy
+    _worker_hierarchy = Hierarchy (basedir)
+
+def _create_keypair ():
+    try:
+        return Keypair(create=True).as_pem()
+    except:
+        return None
+
+def _create_gid (xrn, uuid, pem, email):
+    try:
+        if pem:
+            pkey = Keypair(string=pem)
+        else:
+            pkey = Keypair(create=True)
+        gid = _worker_hierarchy.create_gid(xrn, uuid, pkey, email=email)
+        return gid.save_to_string(save_parents=True)
+    # the exception is pickled back to the caller, and some - like the sfa
+    # faults - cannot be unpickled, which would block the pool for good
+    except Exception, e:
+        raise Exception("%s: %s"%(e.__class__.__name__, e))
+
+# what create_gid_async returns when the job was done in-process
+class _done:
+    def __init__ (self, gid=None, exception=None):
+        self.gid = gid
+        self.exception = exception
+    def get (self, timeout=None):
+        if self.exception is not None:
+            raise self.exception
+        return self.gid
+
+class _pending:
+    def __init__ (self, result, timeout):
+        self.result = result
+        self.timeout = timeout
+    def get (self, timeout=None):
+        if timeout is None:
+            timeout = self.timeout
+        return GID(string=self.result.get(timeout))
+
+class _gid_factory:
+
+    _instances = {}
+    _instances_lock = threading.Lock()
+    # number of worker processes; None means one per CPU
+    workers = None
+    # how many keypairs to keep ready
+    stock_size = 16
+    # seconds to wait for a keypair from the workers before making one here
+    keypair_timeout = 5
+    # seconds to wait for a GID from the workers
+    gid_timeout = 60
+
+    def __init__ (self, hierarchy):
+        self.hierarchy = hierarchy
+        self._lock = threading.Lock()
+        self._stocked = threading.Condition(self._lock)
+        self.stock = deque()
+        self.ordered = 0
+        # set when the workers did not deliver in time; keypair() does not
+        # wait for them anymore until they deliver again
+        self.starved = False
+        self.pool = None
+        try:
+            import multiprocessing
+            self.pool = multiprocessing.Pool(self.workers, _init_worker, (hierarchy.basedir,))
+        except Exception, e:
+            logger.warning("GidFactory: could not start worker processes, running in-process - %s"%e)
+
+    ### keypairs
+    def _stock_keypair (self, pem):
+        with self._lock:
+            self.ordered = max (self.ordered - 1, 0)
+            if pem is not None:
+                self.stock.append (pem)
+                self.starved = False
+            self._stocked.notify()
+
+    def _order_keypairs (self):
+        if self.pool is None: return
+        with self._lock:
+            missing = self.stock_size - len(self.stock) - self.ordered
+            self.ordered += max (missing, 0)
+        for i in range (missing):
+            self.pool.apply_async (_create_keypair, callback=self._stock_keypair)
+
+    def keypair (self):
+        """
+        @return a new Keypair, from the stock if possible
+        """
+        self._order_keypairs ()
+        pem = None
+        with self._lock:
+            if not self.stock and self.ordered and not self.starved:
+                self._stocked.wait (self.keypair_timeout)
+                if not self.stock:
+                    # the orders were lost with a dead worker, or the workers
+                    # are swamped; order again, but do not wait on them
+                    logger.warning("GidFactory: no keypair from the workers after %ss"%self.keypair_timeout)
+                    self.ordered = 0
+                    self.starved = True
+            if self.stock:
+                pem = self.stock.popleft()
+        self._order_keypairs ()
+        if pem is None:
+            return Keypair(create=True)
+        return Keypair(string=pem)
+
+    ### GIDs
+    def create_gid (self, xrn, uuid, pkey=None, email=None):
+        """
+        sign a GID in this process, with a new keypair if pkey is None
+        """
+        if pkey is None:
+            pkey = self.keypair()
+        return self.hierarchy.create_gid(xrn, uuid, pkey, email=email)
+
+    def create_gid_async (self, xrn, uuid, pkey=None, email=None):
+        """
+        same as create_gid, but done in a worker process
+        @return an object whose get() method returns the GID, or raises
+        the exception that occurred when creating it - or
+        multiprocessing.TimeoutError after gid_timeout seconds
+        """
+        pem = None
+        if pkey is not None:
+            # keys that come with no private part - like the ones converted
+            # from ssh public keys - cannot be sent over in PEM
+            try:
+                pem = pkey.as_pem()
+            except:
+                pem = None
+        if self.pool is None or (pkey is not None and pem is None):
+            try:
+                return _done (gid = self.create_gid(xrn, uuid, pkey, email))
+            except Exception, e:
+                return _done (exception = e)
+        return _pending (self.pool.apply_async (_create_gid, (xrn, uuid, pem, email)), self.gid_timeout)
+
+def GidFactory (hierarchy=None):
+    if hierarchy is None:
+        hierarchy = Hierarchy()
+    with _gid_factory._instances_lock:
+        if hierarchy.basedir not in _gid_factory._instances:
+            _gid_factory._instances[hierarchy.basedir] = _gid_factory(hierarchy)
+        return _gid_factory._instances[hierarchy.basedir]
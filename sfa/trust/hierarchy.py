@@ -11,7 +11,10 @@
 #      *.PKEY - private key file
 ##
 
+from __future__ import with_statement
+
 import os
+import threading
 
 from sfa.util.faults import MissingAuthority
 from sfa.util.sfalogging import logger
@@ -22,6 +25,25 @@ from sfa.trust.gid import GID, create_uuid
 from sfa.util.config import Config
 from sfa.trust.sfaticket import SfaTicket
 
+##
+# The authorities private keys, once loaded, are kept for the lifetime of
+# the process, so that e.g. the registry does not read and parse them each
+# time it signs a credential; a key gets reloaded if its file changes
+
+_loaded_pkeys = {}
+_loaded_pkeys_lock = threading.Lock()
+
+def load_pkey(filename):
+    mtime = os.stat(filename).st_mtime
+    with _loaded_pkeys_lock:
+        loaded = _loaded_pkeys.get(filename)
+    if loaded is not None and loaded[0] == mtime:
+        return loaded[1]
+    pkey = Keypair(filename = filename)
+    with _loaded_pkeys_lock:
+        _loaded_pkeys[filename] = (mtime, pkey)
+    return pkey
+
 ##
 # The AuthInfo class contains the information for an authority. This information
 # includes the GID, private key, and database connection information.
@@ -71,7 +93,7 @@ class AuthInfo:
     # Get the private key in the form of a Keypair object
 
     def get_pkey_object(self):
-        return Keypair(filename = self.privkey_filename)
+        return load_pkey(self.privkey_filename)
 
     ##
     # Replace the GID with a new one. The file specified by gid_filename is
@@ -143,8 +165,9 @@ class Hierarchy:
     #
     # @param xrn the human readable name of the authority to create (urn will be converted to hrn) 
     # @param create_parents if true, also create the parents if they do not exist
+    # @param pkey the keypair to use if the authority has none yet, instead of creating one
 
-    def create_auth(self, xrn, create_parents=False):
+    def create_auth(self, xrn, create_parents=False, pkey=None):
         hrn, type = urn_to_hrn(str(xrn))
         logger.debug("Hierarchy: creating authority: %s"% hrn)
 
@@ -168,7 +191,8 @@ class Hierarchy:
             logger.debug("using existing key %r for authority %r"%(privkey_filename,hrn))
             pkey = Keypair(filename = privkey_filename)
         else:
-            pkey = Keypair(create = True)
+            if pkey is None:
+                pkey = Keypair(create = True)
             pkey.save_to_file(privkey_filename)
 
         gid = self.create_gid(xrn, create_uuid(), pkey)
@@ -317,11 +341,11 @@ class Hierarchy:
         if not parent_hrn or hrn == self.config.SFA_INTERFACE_HRN:
             # if there is no parent hrn, then it must be self-signed. this
             # is where we terminate the recursion
-            cred.set_issuer_keys(auth_info.get_privkey_filename(), auth_info.get_gid_filename())
+            cred.set_issuer_keys(auth_info.get_pkey_object(), auth_info.get_gid_object())
         else:
             # we need the parent's private key in order to sign this GID
             parent_auth_info = self.get_auth_info(parent_hrn)
-            cred.set_issuer_keys(parent_auth_info.get_privkey_filename(), parent_auth_info.get_gid_filename())
+            cred.set_issuer_keys(parent_auth_info.get_pkey_object(), parent_auth_info.get_gid_object())
 
             
             cred.set_parent(self.get_auth_cred(parent_hrn, kind))
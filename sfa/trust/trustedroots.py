@@ -1,11 +1,18 @@
+from __future__ import with_statement
+
+import os
 import os.path
+import time
 import glob
+import hashlib
+import threading
 
+from sfa.trust.certificate import subject_key
 from sfa.trust.gid import GID
 from sfa.util.sfalogging import logger
 
 class TrustedRoots:
-    
+
     # we want to avoid reading all files in the directory
     # this is because it's common to have backups of all kinds
     # e.g. *~, *.hide, *-00, *.bak and the like
@@ -20,18 +27,25 @@ class TrustedRoots:
     def add_gid(self, gid):
         fn = os.path.join(self.basedir, gid.get_hrn() + ".gid")
         gid.save_to_file(fn)
+        self.get_store().invalidate()
+
+    # the process-wide parsed contents of the directory
+    def get_store(self):
+        return TrustedRootsStore(self.basedir)
 
     def get_list(self):
-        gid_list = [GID(filename=cert_file) for cert_file in self.get_file_list()]
-        return gid_list
+        return self.get_store().get_list()
 
     def get_file_list(self):
+        return self.get_store().get_file_list()
+
+    def scan_file_list(self):
         file_list  = []
         pattern=os.path.join(self.basedir,"*")
         for cert_file in glob.glob(pattern):
             if os.path.isfile(cert_file):
                 if self.has_supported_extension(cert_file):
-                    file_list.append(cert_file) 
+                    file_list.append(cert_file)
                 else:
                     logger.warning("File %s ignored - supported extensions are %r"%\
                                        (cert_file,TrustedRoots.supported_extensions))
@@ -41,3 +55,133 @@ class TrustedRoots:
         (_,ext)=os.path.splitext(path)
         ext=ext.replace('.','').lower()
         return ext in TrustedRoots.supported_extensions
+
+"""
+TrustedRootsStore: the parsed GIDs of a trusted roots directory
+one (singleton) instance per directory, shared by Auth, Credential.verify
+and the SSL setup in the server - thread-safe
+
+the directory is reloaded only when its mtime, or the set of inodes it
+contains, has changed; this is checked at most every check_period seconds
+"""
+
+class _trusted_roots_store:
+
+    _instances = {}
+    _instances_lock = threading.Lock()
+    # in seconds
+    check_period = 1
+
+    def __init__(self, dir):
+        self.basedir = dir
+        self._lock = threading.RLock()
+        self._signature = None
+        self._checked = 0
+        self.gid_list = []
+        self.file_list = []
+        self.gids_by_file = {}
+        self.gids_by_subject = {}
+        self.gids_by_pubkey = {}
+        self.fingerprint = None
+
+    # what we use to detect changes
+    def _compute_signature(self):
+        try:
+            dir_mtime = os.stat(self.basedir).st_mtime
+            inodes = []
+            for name in os.listdir(self.basedir):
+                st = os.stat(os.path.join(self.basedir, name))
+                inodes.append( (name, st.st_ino, st.st_mtime, st.st_size) )
+        except OSError:
+            return None
+        return (dir_mtime, frozenset(inodes))
+
+    def invalidate(self):
+        with self._lock:
+            self._signature = None
+            self._checked = 0
+
+    def refresh(self):
+        with self._lock:
+            now = time.time()
+            if self._signature is not None and now - self._checked < self.check_period:
+                return
+            self._checked = now
+            signature = self._compute_signature()
+            if signature is not None and signature == self._signature:
+                return
+            self._load()
+            self._signature = signature
+
+    def _load(self):
+        gid_list = []
+        file_list = []
+        gids_by_file = {}
+        gids_by_subject = {}
+        gids_by_pubkey = {}
+        for cert_file in TrustedRoots(self.basedir).scan_file_list():
+            try:
+                gid = GID(filename=cert_file)
+            except Exception, e:
+                logger.error("Failed to load trusted cert from %s: %r"%(cert_file, e))
+                continue
+            gid_list.append(gid)
+            file_list.append(cert_file)
+            gids_by_file[cert_file] = gid
+            gids_by_subject.setdefault(subject_key(gid.x509.get_subject()), []).append(gid)
+            gids_by_pubkey.setdefault(pubkey_fingerprint(gid), []).append(gid)
+        logger.debug("TrustedRootsStore: loaded %d trusted roots from %s"%(len(gid_list), self.basedir))
+        self.gid_list = gid_list
+        self.file_list = file_list
+        self.gids_by_file = gids_by_file
+        self.gids_by_subject = gids_by_subject
+        self.gids_by_pubkey = gids_by_pubkey
+        self.fingerprint = hashlib.sha1("".join(
+            sorted([gid.save_to_string(save_parents=True) for gid in gid_list]))).hexdigest()
+
+    def get_list(self):
+        self.refresh()
+        return self.gid_list
+
+    def get_file_list(self):
+        self.refresh()
+        return self.file_list
+
+    # identifies the current set of trusted roots
+    def get_fingerprint(self):
+        self.refresh()
+        return self.fingerprint
+
+    def get_gid(self, filename):
+        self.refresh()
+        return self.gids_by_file.get(filename)
+
+    # @param subject an X509Name, e.g. a cert's x509.get_issuer()
+    def get_by_subject(self, subject):
+        self.refresh()
+        return self.gids_by_subject.get(subject_key(subject), [])
+
+    # @param fingerprint as returned by pubkey_fingerprint
+    def get_by_pubkey(self, fingerprint):
+        self.refresh()
+        return self.gids_by_pubkey.get(fingerprint, [])
+
+def TrustedRootsStore (dir):
+    with _trusted_roots_store._instances_lock:
+        if dir not in _trusted_roots_store._instances:
+            _trusted_roots_store._instances[dir] = _trusted_roots_store(dir)
+        return _trusted_roots_store._instances[dir]
+
+def pubkey_fingerprint(cert):
+    return cert.get_pubkey_fingerprint()
+
+##
+# Return a GID for a trusted cert filename, using the parsed copy
+# held by a store if that file is part of a known trusted roots directory
+
+def load_trusted_gid(filename):
+    for store in _trusted_roots_store._instances.values():
+        gid = store.get_gid(filename)
+        if gid is not None:
+            return gid
+    return GID(filename=filename)
@@ -0,0 +1,361 @@
+##
+# In-process support for the XML-DSig enveloped signatures found in
+# SFA credentials.
+#
+# Checking these signatures used to be delegated to the xmlsec1 binary,
+# at the cost of a temporary file and a fork for each signature in a
+# delegation chain. The code below performs the same checks with lxml
+# (canonicalization) and pyOpenSSL (RSA), see Credential.verify
+#
+# Signing is handled the same way, see Credential.sign; the filled-in
+# template comes out exactly as xmlsec1 --sign would write it
+##
+
+import copy
+import hashlib
+import base64
+
+from lxml import etree
+from OpenSSL import crypto
+
+from sfa.util.faults import CredentialNotVerifiable
+from sfa.util.sfalogging import logger
+from sfa.trust.certificate import Certificate
+
+DSIG_NS = "http://www.w3.org/2000/09/xmldsig#"
+XML_NS = "http://www.w3.org/XML/1998/namespace"
+
+C14N = "http://www.w3.org/TR/2001/REC-xml-c14n-20010315"
+C14N_WITH_COMMENTS = C14N + "#WithComments"
+EXC_C14N = "http://www.w3.org/2001/10/xml-exc-c14n#"
+EXC_C14N_WITH_COMMENTS = EXC_C14N + "WithComments"
+ENVELOPED_SIGNATURE = DSIG_NS + "enveloped-signature"
+
+canonicalization_methods = [ C14N, C14N_WITH_COMMENTS, EXC_C14N, EXC_C14N_WITH_COMMENTS ]
+
+digest_methods = {
+    DSIG_NS + "sha1" : hashlib.sha1,
+    "http://www.w3.org/2001/04/xmlenc#sha256" : hashlib.sha256,
+    }
+
+signature_methods = {
+    DSIG_NS + "rsa-sha1" : "sha1",
+    "http://www.w3.org/2001/04/xmldsig-more#rsa-sha256" : "sha256",
+    }
+
+def ds(tag):
+    return "{%s}%s" % (DSIG_NS, tag)
+
+##
+# Parse a signed document; the result is an lxml root element
+
+def parse(xml):
+    if isinstance(xml, unicode):
+        xml = xml.encode('utf-8')
+    try:
+        return etree.fromstring(xml)
+    except etree.XMLSyntaxError, e:
+        raise CredentialNotVerifiable("Malformed credential: %s" % e)
+
+##
+# Locate an element by its xml:id
+
+def find_by_id(root, node_id):
+    found = root.xpath('//*[@xml:id=$node_id]', node_id=node_id)
+    if not found:
+        return None
+    return found[0]
+
+##
+# Canonicalize element as the apex of a document subset, the way xmlsec1
+# (libxml2) does it for a same-document reference.
+#
+# With inclusive C14N 1.0 the apex gets all the namespaces in scope, and
+# also inherits the xml:* attributes of its ancestors; this matters for
+# SignedInfo, whose enclosing Signature carries an xml:id
+#
+# @param exclude an optional descendant of element that is left out,
+#     which is what the enveloped-signature transform amounts to
+
+def canonicalize(element, algorithm=C14N, exclude=None, with_comments=None):
+    if algorithm not in canonicalization_methods:
+        raise CredentialNotVerifiable("Unsupported canonicalization %s" % algorithm)
+    exclusive = algorithm in [EXC_C14N, EXC_C14N_WITH_COMMENTS]
+    if with_comments is None:
+        with_comments = algorithm in [C14N_WITH_COMMENTS, EXC_C14N_WITH_COMMENTS]
+
+    apex = etree.Element(element.tag, nsmap=element.nsmap)
+    for (name, value) in element.attrib.items():
+        apex.set(name, value)
+    if not exclusive:
+        xml_prefix = "{%s}" % XML_NS
+        ancestor = element.getparent()
+        while ancestor is not None:
+            for (name, value) in ancestor.attrib.items():
+                if name.startswith(xml_prefix) and apex.get(name) is None:
+                    apex.set(name, value)
+            ancestor = ancestor.getparent()
+    apex.text = element.text
+    for child in element:
+        apex.append(copy.deepcopy(child))
+
+    if exclude is not None:
+        # locate the excluded node in the copy from its position in the original
+        path = []
+        node = exclude
+        while node is not None and node is not element:
+            parent = node.getparent()
+            if parent is not None:
+                path.insert(0, parent.index(node))
+            node = parent
+        if node is element and path:
+            target = apex
+            for index in path:
+                target = target[index]
+            remove_keeping_tail(target)
+
+    return etree.tostring(apex, method='c14n', exclusive=exclusive,
+                          with_comments=with_comments)
+
+##
+# Remove a node from its tree, but not the text that follows it
+
+def remove_keeping_tail(node):
+    parent = node.getparent()
+    if node.tail:
+        previous = node.getprevious()
+        if previous is not None:
+            previous.tail = (previous.tail or '') + node.tail
+        else:
+            parent.text = (parent.text or '') + node.tail
+    parent.remove(node)
+
+##
+# Compute the digest of a Reference element, as found in SignedInfo
+
+def reference_digest(root, reference, signature):
+    uri = reference.get('URI')
+    if not uri or not uri.startswith('#'):
+        raise CredentialNotVerifiable("Unsupported reference URI %r" % uri)
+    target = find_by_id(root, uri[1:])
+    if target is None:
+        raise CredentialNotVerifiable("Reference %s not found" % uri)
+
+    exclude = None
+    algorithm = C14N
+    transforms = reference.find(ds('Transforms'))
+    if transforms is not None:
+        for transform in transforms.findall(ds('Transform')):
+            name = transform.get('Algorithm')
+            if name == ENVELOPED_SIGNATURE:
+                exclude = signature
+            elif name in canonicalization_methods:
+                algorithm = name
+            else:
+                raise CredentialNotVerifiable("Unsupported transform %s" % name)
+
+    digest_method = reference.find(ds('DigestMethod')).get('Algorithm')
+    if digest_method not in digest_methods:
+        raise CredentialNotVerifiable("Unsupported digest method %s" % digest_method)
+    # a bare '#id' reference drops comments, whatever the canonicalization
+    canonical = canonicalize(target, algorithm, exclude=exclude, with_comments=False)
+    return base64.b64encode(digest_methods[digest_method](canonical).digest())
+
+##
+# Return the certificates shipped in the KeyInfo of a signature
+
+def signature_certificates(signature):
+    certificates = []
+    for node in signature.iterfind(".//%s/%s" % (ds('X509Data'), ds('X509Certificate'))):
+        if node.text and node.text.strip():
+            certificates.append(Certificate(string=node.text))
+    return certificates
+
+##
+# Make sure that signer can be traced back to one of the trusted certs,
+# possibly through the other certificates found in KeyInfo
+# (this is what xmlsec1 does with its --trusted-pem arguments)
+
+def verify_trust(signer, certificates, trusted_certs):
+    if signer.x509.has_expired():
+        raise CredentialNotVerifiable("Signer %s has expired" % signer.pretty_cert())
+    signer_string = signer.save_to_string(save_parents=False)
+    for trusted_cert in trusted_certs:
+        if trusted_cert.save_to_string(save_parents=False) == signer_string:
+            return trusted_cert
+
+    # rebuild the chain from the untrusted certificates
+    pool = [ certificate for certificate in certificates if certificate is not signer ]
+    current = signer
+    while pool:
+        issuers = [ certificate for certificate in pool
+                    if certificate.x509.get_subject() == current.x509.get_issuer() ]
+        if not issuers:
+            break
+        current.set_parent(issuers[0])
+        pool.remove(issuers[0])
+        current = issuers[0]
+
+    try:
+        return signer.verify_chain(trusted_certs)
+    except Exception, e:
+        raise CredentialNotVerifiable("Signer %s is not trusted: %s" % (signer.pretty_cert(), e))
+
+##
+# Verify the signature whose xml:id is node_id (e.g. 'Sig_ref0')
+#
+# . every Reference in SignedInfo must match its digest
+# . SignatureValue must be the RSA signature of the canonical SignedInfo
+#   by one of the certificates in KeyInfo
+# . that certificate must chain up to a trusted cert
+#
+# Returns the signer Certificate; raises CredentialNotVerifiable otherwise
+#
+# @param root lxml root element for the credential (see parse)
+# @param trusted_certs a list of Certificate (or GID) objects
+
+def verify_signature(root, node_id, trusted_certs):
+    signature = find_by_id(root, node_id)
+    if signature is None or signature.tag != ds('Signature'):
+        raise CredentialNotVerifiable("Signature %s not found" % node_id)
+    signed_info = signature.find(ds('SignedInfo'))
+    if signed_info is None:
+        raise CredentialNotVerifiable("Signature %s has no SignedInfo" % node_id)
+
+    references = signed_info.findall(ds('Reference'))
+    if not references:
+        raise CredentialNotVerifiable("Signature %s has no Reference" % node_id)
+    for reference in references:
+        expected = "".join((reference.findtext(ds('DigestValue')) or '').split())
+        if reference_digest(root, reference, signature) != expected:
+            raise CredentialNotVerifiable("Digest mismatch for reference %s in %s" % \
+                                          (reference.get('URI'), node_id))
+
+    c14n_method = signed_info.find(ds('CanonicalizationMethod')).get('Algorithm')
+    signature_method = signed_info.find(ds('SignatureMethod')).get('Algorithm')
+    if signature_method not in signature_methods:
+        raise CredentialNotVerifiable("Unsupported signature method %s" % signature_method)
+    canonical = canonicalize(signed_info, c14n_method)
+    value = base64.b64decode(signature.findtext(ds('SignatureValue')) or '')
+
+    certificates = signature_certificates(signature)
+    signer = None
+    for certificate in certificates:
+        try:
+            crypto.verify(certificate.x509, value, canonical, signature_methods[signature_method])
+            signer = certificate
+            break
+        except crypto.Error:
+            continue
+    if signer is None:
+        raise CredentialNotVerifiable("Signature %s does not match any of its %d certificates" % \
+                                      (node_id, len(certificates)))
+
+    verify_trust(signer, certificates, trusted_certs)
+    logger.debug("xmlsig: signature %s OK, signed by %s" % (node_id, signer.get_subject()))
+    return signer
+
+##
+# base64, in lines of 64 characters as xmlsec1 writes it
+
+def base64_lines(data, trailing_newline=False):
+    encoded = base64.b64encode(data)
+    lines = [ encoded[i:i+64] for i in range(0, len(encoded), 64) ]
+    result = "\n".join(lines)
+    if trailing_newline:
+        result += "\n"
+    return result
+
+##
+# Format an X509Name the way xmlsec1 does (RFC 2253, i.e. last component first)
+
+def rfc2253_name(x509name):
+    parts = []
+    for (name, value) in reversed(x509name.get_components()):
+        escaped = ""
+        for (index, char) in enumerate(value):
+            if char in ',+"\\<>;' \
+                    or (index == 0 and char in '# ') \
+                    or (index == len(value)-1 and char == ' '):
+                escaped += "\\" + char
+            elif ord(char) < 32 or ord(char) > 126:
+                escaped += "\\%02X" % ord(char)
+            else:
+                escaped += char
+        parts.append("%s=%s" % (name, escaped))
+    return ",".join(parts)
+
+##
+# Fill one of the X509Data template nodes with the details of a certificate
+
+def fill_x509_node(node, certificate):
+    x509 = certificate.x509
+    if node.tag == ds('X509SubjectName'):
+        node.text = rfc2253_name(x509.get_subject())
+    elif node.tag == ds('X509IssuerSerial'):
+        node.text = "\n"
+        issuer = etree.SubElement(node, ds('X509IssuerName'))
+        issuer.text = rfc2253_name(x509.get_issuer())
+        issuer.tail = "\n"
+        serial = etree.SubElement(node, ds('X509SerialNumber'))
+        serial.text = str(x509.get_serial_number())
+        serial.tail = "\n"
+    elif node.tag == ds('X509Certificate'):
+        node.text = base64_lines(crypto.dump_certificate(crypto.FILETYPE_ASN1, x509), True)
+
+##
+# Fill the X509Data template, each node there is repeated once per certificate
+
+def fill_x509_data(x509data, certificates):
+    for node in list(x509data):
+        if not isinstance(node.tag, basestring):
+            continue
+        previous = node
+        for (index, certificate) in enumerate(certificates):
+            if index > 0:
+                # like xmlsec1, separate the repeated nodes with a newline
+                current = etree.SubElement(x509data, node.tag)
+                tail = previous.tail
+                previous.addnext(current)
+                previous.tail = "\n"
+                current.tail = tail
+                previous = current
+            fill_x509_node(previous, certificate)
+
+##
+# Sign the signature template whose xml:id is node_id (e.g. 'Sig_ref0')
+#
+# . every Reference in SignedInfo gets its DigestValue
+# . KeyInfo/X509Data gets the signer certificate and its parents
+# . SignatureValue gets the RSA signature of the canonical SignedInfo
+#
+# @param root lxml root element for the credential (see parse)
+# @param pkey the signer's private key, as a pyOpenSSL PKey
+# @param certificates the signer's Certificate (or GID) first, then its parents
+
+def sign_signature(root, node_id, pkey, certificates):
+    signature = find_by_id(root, node_id)
+    if signature is None or signature.tag != ds('Signature'):
+        raise CredentialNotVerifiable("Signature template %s not found" % node_id)
+    signed_info = signature.find(ds('SignedInfo'))
+
+    for reference in signed_info.findall(ds('Reference')):
+        reference.find(ds('DigestValue')).text = reference_digest(root, reference, signature)
+
+    for x509data in signature.iter(ds('X509Data')):
+        fill_x509_data(x509data, certificates)
+
+    c14n_method = signed_info.find(ds('CanonicalizationMethod')).get('Algorithm')
+    signature_method = signed_info.find(ds('SignatureMethod')).get('Algorithm')
+    if signature_method not in signature_methods:
+        raise CredentialNotVerifiable("Unsupported signature method %s" % signature_method)
+    canonical = canonicalize(signed_info, c14n_method)
+    value = crypto.sign(pkey, canonical, signature_methods[signature_method])
+    signature.find(ds('SignatureValue')).text = base64_lines(value)
+    return root
+
+##
+# Serialize a signed document the way xmlsec1 writes it out
+
+def serialize(root):
+    return '<?xml version="1.0"?>\n' + etree.tostring(root) + "\n"
@@ -1,14 +1,36 @@
 #
 # This module implements general purpose caching system
 #
+# the data lives in namespaces; Cache(namespace='xxx') gives access to the
+# process-wide namespace of that name, while a plain Cache() has a private one
+# each namespace is bounded in number of entries and in size, the least
+# recently used entries go first; expired entries are removed by a
+# background thread, and a namespace can optionally keep a copy of its
+# entries on disk
+#
 from __future__ import with_statement
+import os
+import os.path
+import sys
 import time
 import threading
 import pickle
+import marshal
+import zlib
+import hashlib
+import weakref
 from datetime import datetime
+from collections import OrderedDict
+
+from sfa.util.sfalogging import logger
 
-# maximum lifetime of cached data (in seconds) 
+# maximum lifetime of cached data (in seconds)
 DEFAULT_CACHE_TTL = 60 * 60
+# default bounds for one namespace
+DEFAULT_MAX_ENTRIES = 1000
+DEFAULT_MAX_BYTES = 64 * 1024 * 1024
+# how often (in seconds) the expired entries get removed
+SWEEP_PERIOD = 60
 
 class CacheData:
 
@@ -16,14 +38,30 @@ class CacheData:
     created = None
     expires = None
     lock = None
+    size = 0
+    # past this point the data is stale, but can still be served until expires
+    fresh_until = None
+    # name -> value computed from data, see CacheNamespace.derive
+    derived = None
 
-    def __init__(self, data, ttl = DEFAULT_CACHE_TTL):
+    def __init__(self, data, ttl = DEFAULT_CACHE_TTL, size = 0):
         self.lock = threading.RLock()
         self.data = data
+        self.size = size
+        self.derived = {}
         self.renew(ttl)
 
-    def is_expired(self):
-        return time.time() > self.expires
+    def is_expired(self, now=None):
+        if now is None:
+            now = time.time()
+        return now > self.expires
+
+    def is_fresh(self, now=None):
+        if self.fresh_until is None:
+            return not self.is_expired(now)
+        if now is None:
+            now = time.time()
+        return now <= self.fresh_until
 
     def get_created_date(self):
         return str(datetime.fromtimestamp(self.created))
@@ -33,14 +71,14 @@ class CacheData:
 
     def renew(self, ttl = DEFAULT_CACHE_TTL):
         self.created = time.time()
-        self.expires = self.created + ttl   
-       
+        self.expires = self.created + ttl
+
     def set_data(self, data, renew=True, ttl = DEFAULT_CACHE_TTL):
-        with self.lock: 
+        with self.lock:
             self.data = data
             if renew:
                 self.renew(ttl)
-    
+
     def get_data(self):
         return self.data
 
@@ -49,8 +87,8 @@ class CacheData:
         return self.__dict__
 
     def __str__(self):
-        return str(self.dump())  
-        
+        return str(self.dump())
+
     def tostring(self):
         return self.__str__()
 
@@ -62,55 +100,540 @@ class CacheData:
     def __setstate__(self, d):
         self.__dict__.update(d)
         self.lock = threading.RLock()
-        
+        if self.derived is None:
+            self.derived = {}
 
-class Cache:
+##
+# the compact format used on disk: a zlib-compressed marshal of
+# (format, records) where a record is (key, created, expires, data, fresh_until)
+# - older records have no fresh_until
+# only plain python data can be stored this way, which is what we cache
 
-    cache  = {}
-    lock = threading.RLock()
+CACHE_FORMAT = 1
 
-    def __init__(self, filename=None):
-        if filename:
-            self.load_from_file(filename)
-   
-    def add(self, key, value, ttl = DEFAULT_CACHE_TTL):
+def to_record(key, data):
+    return (key, data.created, data.expires, data.get_data(), data.fresh_until)
+
+def from_record(record):
+    (key, created, expires, value) = record[:4]
+    data = CacheData(value, size=data_size(value))
+    (data.created, data.expires) = (created, expires)
+    if len(record) > 4:
+        data.fresh_until = record[4]
+    return (key, data)
+
+def dump_records(records):
+    try:
+        blob = marshal.dumps( (CACHE_FORMAT, records) )
+    except ValueError:
+        # leave out what marshal cannot handle
+        kept = []
+        for record in records:
+            try:
+                marshal.dumps(record)
+                kept.append(record)
+            except ValueError:
+                logger.warning("Cache: cannot save entry %s" % record[0])
+        blob = marshal.dumps( (CACHE_FORMAT, kept) )
+    return zlib.compress(blob)
+
+def load_records(blob):
+    (format, records) = marshal.loads(zlib.decompress(blob))
+    if format != CACHE_FORMAT:
+        raise ValueError("unsupported cache format %r" % format)
+    return records
+
+# an estimate of the memory used by a value
+def data_size(data):
+    if isinstance(data, str):
+        return len(data)
+    if isinstance(data, unicode):
+        return 2 * len(data)
+    try:
+        return len(marshal.dumps(data))
+    except ValueError:
+        return len(pickle.dumps(data, pickle.HIGHEST_PROTOCOL))
+
+def write_atomically(filename, contents):
+    tmp = "%s.%d.%d.tmp" % (filename, os.getpid(), threading.currentThread().ident)
+    f = open(tmp, 'wb')
+    try:
+        f.write(contents)
+    finally:
+        f.close()
+    os.rename(tmp, filename)
+
+class CacheDisk:
+    """
+    The on-disk tier of a namespace: one file per entry, named after the
+    sha1 of the key, and with the expiration time of the entry as its mtime
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def filename(self, key):
+        if isinstance(key, unicode):
+            key = key.encode('utf-8')
+        return os.path.join(self.directory, hashlib.sha1(key).hexdigest())
+
+    def store(self, key, data):
+        filename = self.filename(key)
+        try:
+            record = to_record(key, data)
+            write_atomically(filename, zlib.compress(marshal.dumps( (CACHE_FORMAT, [record]) )))
+            os.utime(filename, (data.created, data.expires))
+        except (ValueError, IOError, OSError), e:
+            # e.g. data that marshal cannot handle
+            logger.warning("CacheDisk: could not store %s: %s" % (key, e))
+
+    def load(self, key):
+        filename = self.filename(key)
+        try:
+            if os.stat(filename).st_mtime < time.time():
+                self.remove(key)
+                return None
+            f = open(filename, 'rb')
+            try:
+                records = load_records(f.read())
+            finally:
+                f.close()
+        except (IOError, OSError):
+            return None
+        except Exception, e:
+            logger.warning("CacheDisk: discarding unreadable entry for %s: %s" % (key, e))
+            self.remove(key)
+            return None
+        for record in records:
+            if record[0] == key:
+                return from_record(record)[1]
+        return None
+
+    def remove(self, key):
+        try:
+            os.unlink(self.filename(key))
+        except OSError:
+            pass
+
+    # remove the expired entries
+    def sweep(self, now):
+        removed = 0
+        for name in os.listdir(self.directory):
+            filename = os.path.join(self.directory, name)
+            try:
+                if os.stat(filename).st_mtime < now:
+                    os.unlink(filename)
+                    removed += 1
+            except OSError:
+                pass
+        return removed
+
+class CacheBuild:
+    """
+    One computation of a cache entry underway, that other callers can wait for
+    """
+    def __init__(self):
+        self.event = threading.Event()
+        self.value = None
+        self.exc_info = None
+
+class CacheNamespace:
+    """
+    The actual storage behind Cache; thread-safe
+    a max_entries or max_bytes of 0 means no limit
+    """
+
+    def __init__(self, name, max_entries=DEFAULT_MAX_ENTRIES, max_bytes=DEFAULT_MAX_BYTES, directory=None):
+        self.name = name
+        self.lock = threading.RLock()
+        self.entries = OrderedDict()
+        # id(data) -> key, for derive
+        self.sources = {}
+        self.bytes = 0
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.disk = None
+        if directory:
+            self.disk = CacheDisk(directory)
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        # key -> CacheBuild
+        self.builds = {}
+        self.built = 0
+        self.coalesced = 0
+        self.stale_hits = 0
+        self.derived_hits = 0
+
+    def configure(self, max_entries=None, max_bytes=None, directory=None):
+        with self.lock:
+            if max_entries is not None:
+                self.max_entries = max_entries
+            if max_bytes is not None:
+                self.max_bytes = max_bytes
+            if directory and (self.disk is None or self.disk.directory != directory):
+                self.disk = CacheDisk(directory)
+            self._enforce_limits()
+
+    # the lock is held; data has been taken out of entries
+    def _forget(self, key, data):
+        self.bytes -= data.size
+        if self.sources.get(id(data.data)) == key:
+            del self.sources[id(data.data)]
+
+    # the lock is held
+    def _remove(self, key):
+        data = self.entries.pop(key, None)
+        if data is not None:
+            self._forget(key, data)
+        return data
+
+    # the lock is held
+    def _insert(self, key, data):
+        self._remove(key)
+        if self.max_bytes and data.size > self.max_bytes:
+            # would not fit anyway
+            self.evictions += 1
+            return
+        self.entries[key] = data
+        self.sources[id(data.data)] = key
+        self.bytes += data.size
+        self._enforce_limits()
+
+    # the lock is held
+    def _enforce_limits(self):
+        while self.entries and \
+                ( (self.max_entries and len(self.entries) > self.max_entries) or \
+                  (self.max_bytes and self.bytes > self.max_bytes) ):
+            (key, data) = self.entries.popitem(last=False)
+            self._forget(key, data)
+            self.evictions += 1
+
+    # grace: for how long after ttl the data can still be served while being rebuilt
+    def add(self, key, value, ttl = DEFAULT_CACHE_TTL, grace = 0):
+        data = CacheData(value, ttl + grace, data_size(value))
+        if grace:
+            data.fresh_until = data.created + ttl
+        with self.lock:
+            self._insert(key, data)
+        if self.disk:
+            self.disk.store(key, data)
+
+    # the CacheData for key if any, fresh or stale
+    def lookup(self, key):
+        with self.lock:
+            data = self.entries.pop(key, None)
+            if data is not None:
+                if not data.is_expired():
+                    # mark as most recently used
+                    self.entries[key] = data
+                    self.hits += 1
+                    return data
+                self._forget(key, data)
+                self.expirations += 1
+        if self.disk:
+            data = self.disk.load(key)
+            if data is not None and not data.is_expired():
+                with self.lock:
+                    self._insert(key, data)
+                    self.disk_hits += 1
+                return data
+        with self.lock:
+            self.misses += 1
+        return None
+
+    def get(self, key):
+        data = self.lookup(key)
+        if data is None:
+            return None
+        return data.get_data()
+
+    ##
+    # compute the data for key by calling build(), and store it
+    # only one build runs at a time for a given key, the other callers
+    # wait for that one and get the same result - or exception
+    # with wait=False the build runs in a thread of its own, and this returns None
+
+    def build(self, key, build, ttl = DEFAULT_CACHE_TTL, grace = 0, wait = True):
+        with self.lock:
+            flight = self.builds.get(key)
+            owner = flight is None
+            if owner:
+                flight = CacheBuild()
+                self.builds[key] = flight
+            else:
+                self.coalesced += 1
+        if owner:
+            if not wait:
+                thread = threading.Thread(target=self._run_build, name="CacheBuild",
+                                          args=(key, flight, build, ttl, grace))
+                thread.setDaemon(True)
+                thread.start()
+                return None
+            self._run_build(key, flight, build, ttl, grace)
+        elif not wait:
+            return None
+        flight.event.wait()
+        if flight.exc_info:
+            raise flight.exc_info[0], flight.exc_info[1], flight.exc_info[2]
+        return flight.value
+
+    def _run_build(self, key, flight, build, ttl, grace):
+        try:
+            flight.value = build()
+            self.add(key, flight.value, ttl, grace)
+        except:
+            flight.exc_info = sys.exc_info()
+            logger.log_exc("Cache: could not build %s in namespace %s" % (key, self.name))
+        with self.lock:
+            del self.builds[key]
+            self.built += 1
+        flight.event.set()
+
+    # the lock is held; the entry whose data is source, if any
+    def _holder(self, source):
+        data = self.entries.get(self.sources.get(id(source)))
+        if data is not None and data.data is source:
+            return data
+        return None
+
+    def holds(self, source):
+        with self.lock:
+            return self._holder(source) is not None
+
+    ##
+    # a value computed from the data of an entry - e.g. its compressed
+    # form - by calling compute(); it is kept along with that entry, counts
+    # in its size and goes away with it
+    # source is that data itself, found by identity so that the lookup
+    # cost does not depend on its size
+
+    def derive(self, source, name, compute):
+        with self.lock:
+            data = self._holder(source)
+            if data is not None and name in data.derived:
+                self.derived_hits += 1
+                return data.derived[name]
+        value = compute()
+        with self.lock:
+            data = self._holder(source)
+            if data is not None and name not in data.derived:
+                size = data_size(value)
+                data.derived[name] = value
+                data.size += size
+                self.bytes += size
+                self._enforce_limits()
+        return value
+
+    def pop(self, key):
         with self.lock:
-            if self.cache.has_key(key):
-                self.cache[key].set_data(value, ttl=ttl)
+            self._remove(key)
+        if self.disk:
+            self.disk.remove(key)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.sources.clear()
+            self.bytes = 0
+
+    def items(self):
+        with self.lock:
+            return self.entries.items()
+
+    def sweep(self):
+        now = time.time()
+        with self.lock:
+            expired = [ key for (key, data) in self.entries.iteritems() if data.is_expired(now) ]
+            for key in expired:
+                self._remove(key)
+            self.expirations += len(expired)
+        if self.disk:
+            self.disk.sweep(now)
+        return len(expired)
+
+    def stats(self):
+        with self.lock:
+            return {'name': self.name, 'entries': len(self.entries), 'bytes': self.bytes,
+                    'max_entries': self.max_entries, 'max_bytes': self.max_bytes,
+                    'hits': self.hits, 'disk_hits': self.disk_hits, 'misses': self.misses,
+                    'evictions': self.evictions, 'expirations': self.expirations,
+                    'stale_hits': self.stale_hits, 'derived_hits': self.derived_hits,
+                    'built': self.built,
+                    'coalesced': self.coalesced, 'building': len(self.builds),
+                    'disk': self.disk is not None and self.disk.directory or None}
+
+"""
+_cache_namespaces: keeps track of the namespaces, and runs the thread
+that removes expired entries from all of them
+named namespaces live as long as the process, private ones are only
+weakly referenced
+"""
+
+class _cache_namespaces:
+
+    named = {}
+    private = weakref.WeakValueDictionary()
+    lock = threading.Lock()
+    sweeper = None
+
+    @staticmethod
+    def get(name, max_entries=None, max_bytes=None, directory=None):
+        with _cache_namespaces.lock:
+            if name is None:
+                namespace = CacheNamespace(None)
+                _cache_namespaces.private[id(namespace)] = namespace
+            elif name in _cache_namespaces.named:
+                namespace = _cache_namespaces.named[name]
             else:
-                self.cache[key] = CacheData(value, ttl)
-           
+                namespace = CacheNamespace(name)
+                _cache_namespaces.named[name] = namespace
+            _cache_namespaces.start_sweeper()
+        namespace.configure(max_entries, max_bytes, directory)
+        return namespace
+
+    @staticmethod
+    def all():
+        with _cache_namespaces.lock:
+            return _cache_namespaces.named.values() + _cache_namespaces.private.values()
+
+    # the lock is held
+    @staticmethod
+    def start_sweeper():
+        if _cache_namespaces.sweeper is not None:
+            return
+        sweeper = threading.Thread(target=_cache_namespaces.sweep_forever, name="CacheSweeper")
+        sweeper.setDaemon(True)
+        sweeper.start()
+        _cache_namespaces.sweeper = sweeper
+
+    @staticmethod
+    def sweep_forever():
+        while True:
+            time.sleep(SWEEP_PERIOD)
+            for namespace in _cache_namespaces.all():
+                try:
+                    namespace.sweep()
+                except Exception:
+                    logger.log_exc("Cache: could not sweep namespace %s" % namespace.name)
+
+##
+# the counters for all the namespaces in this process
+
+def cache_stats():
+    return [ namespace.stats() for namespace in _cache_namespaces.all() ]
+
+##
+# a value computed from source by compute(), kept with the cache entry
+# that source comes from - see CacheNamespace.derive - if any
+
+def cache_derive(source, name, compute):
+    for namespace in _cache_namespaces.all():
+        if namespace.holds(source):
+            return namespace.derive(source, name, compute)
+    return compute()
+
+class Cache:
+    """
+    namespace: the name of a process-wide namespace, or None for a private one
+    the namespace bounds come from config (SFA_CACHE_MAX_ENTRIES,
+    SFA_CACHE_MAX_SIZE in Mbytes, and SFA_CACHE_DIR for the disk copy)
+    if provided, and can be overridden with max_entries, max_bytes and directory
+    """
+
+    def __init__(self, filename=None, namespace=None, config=None,
+                 max_entries=None, max_bytes=None, directory=None):
+        if config is not None:
+            if max_entries is None:
+                max_entries = getattr(config, 'SFA_CACHE_MAX_ENTRIES', None)
+            if max_bytes is None:
+                max_size = getattr(config, 'SFA_CACHE_MAX_SIZE', None)
+                if max_size is not None:
+                    max_bytes = max_size * 1024 * 1024
+            if directory is None:
+                cache_dir = getattr(config, 'SFA_CACHE_DIR', None)
+                if cache_dir and namespace:
+                    directory = os.path.join(cache_dir, namespace)
+        self.namespace = _cache_namespaces.get(namespace, max_entries, max_bytes, directory)
+        if filename:
+            self.load_from_file(filename)
+
+    def add(self, key, value, ttl = DEFAULT_CACHE_TTL, grace = 0):
+        self.namespace.add(key, value, ttl, grace)
+
     def get(self, key):
-        data = self.cache.get(key)
-        if not data:  
-            data = None
-        elif data.is_expired():
-            self.pop(key)
-            data = None 
-        else:
-            data = data.get_data()
-        return data
+        return self.namespace.get(key)
+
+    def get_or_build(self, key, build, ttl = DEFAULT_CACHE_TTL, grace = 0, refresh = None):
+        """
+        Return the data for key, calling build() to compute it when needed;
+        concurrent callers share the same call to build().
+        Data that is older than ttl but not than ttl+grace is stale: if a
+        refresh callable is provided, the stale data is returned right away
+        and refresh() is called in the background to replace it
+        """
+        data = self.namespace.lookup(key)
+        if data is not None:
+            if data.is_fresh():
+                return data.get_data()
+            if refresh is not None:
+                with self.namespace.lock:
+                    self.namespace.stale_hits += 1
+                self.namespace.build(key, refresh, ttl, grace, wait=False)
+                return data.get_data()
+        return self.namespace.build(key, build, ttl, grace)
+
+    # compute the data for key again, whether it is still fresh or not
+    def rebuild(self, key, build, ttl = DEFAULT_CACHE_TTL, grace = 0):
+        return self.namespace.build(key, build, ttl, grace)
 
     def pop(self, key):
-        if key in self.cache:
-            self.cache.pop(key) 
+        self.namespace.pop(key)
+
+    def clear(self):
+        self.namespace.clear()
+
+    def stats(self):
+        return self.namespace.stats()
 
     def dump(self):
         result = {}
-        for key in self.cache:
-            result[key] = self.cache[key].__getstate__()
+        for (key, data) in self.namespace.items():
+            result[key] = data.__getstate__()
         return result
 
     def __str__(self):
-        return str(self.dump())     
- 
+        return str(self.dump())
+
     def tostring(self):
-        return self.__str()    
+        return self.__str__()
 
     def save_to_file(self, filename):
-        f = open(filename, 'w')
-        pickle.dump(self.cache, f)
+        now = time.time()
+        records = [ to_record(key, data)
+                    for (key, data) in self.namespace.items() if not data.is_expired(now) ]
+        write_atomically(filename, dump_records(records))
 
     def load_from_file(self, filename):
-        f = open(filename, 'r')
-        self.cache = pickle.load(f)
+        f = open(filename, 'rb')
+        try:
+            contents = f.read()
+        finally:
+            f.close()
+        try:
+            records = load_records(contents)
+        except Exception:
+            # a file from an older version, that pickled the whole dict
+            records = [ to_record(key, data)
+                        for (key, data) in pickle.loads(contents).items() ]
+        now = time.time()
+        for record in records:
+            (key, data) = from_record(record)
+            if data.expires < now:
+                continue
+            with self.namespace.lock:
+                self.namespace._insert(key, data)
@@ -2,7 +2,7 @@
 # if the sfatables.runtime import fails, just define run_sfatables as identity
 
 try:
-    from sfatables.runtime import SFATablesRules
+    from sfatables.runtime import SFATablesRules, CompiledChain
 
     def fetch_context(slice_hrn, user_hrn, contexts):
         """
@@ -39,9 +39,27 @@ try:
             newrspec = rspec
         return newrspec
 
+    def sfatables_chain_empty(chain):
+        """
+        @return True if running an rspec through chain would leave it unchanged
+        """
+        return not SFATablesRules(chain.upper()).sorted_rule_list
+
+    def sfatables_chain_signature(chain):
+        """
+        @return a value that changes whenever the rules of chain change
+        """
+        return CompiledChain(chain.upper()).signature
+
 except:
     
     from sfa.util.sfalogging import logger
     def run_sfatables (_,__,___, rspec, ____=None):
         logger.warning("Cannot import sfatables.runtime, please install package sfa-sfatables")
         return rspec
+
+    def sfatables_chain_empty (_):
+        return True
+
+    def sfatables_chain_signature (_):
+        return None
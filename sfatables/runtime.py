@@ -1,85 +1,201 @@
 #!/usr/bin/python
 
+from __future__ import with_statement
 import sys
 import os
+import threading
+from copy import deepcopy
 
-import libxml2
-import libxslt
+from lxml import etree
 
 from sfatables.globals import sfatables_config
-from sfatables.commands.List import List
-from sfatables.xmlrule import XMLRule
+
+# the chains are compiled once, and then reused for as long as the
+# contents of their directory do not change
+# a rule runs its match and target processors on an lxml tree, so the
+# rspec is parsed once and serialized once whatever the number of rules
+
+def rule_numbers(chain_dir_path):
+    """
+    @return the sorted rule numbers found in a chain directory, and a
+    signature of its contents that changes whenever a rule gets added,
+    removed or modified
+    """
+    rule_numbers = {}
+    signature = []
+    for (root, dirs, files) in os.walk(chain_dir_path):
+        signature.append( (root, os.stat(root).st_mtime) )
+        for file in files:
+            if (file.startswith('sfatables')):
+                (magic,number,type) = file.split('-')
+                rule_numbers[int(number)]=1
+                signature.append( (file, os.stat(os.path.join(root, file)).st_mtime) )
+    rule_list = rule_numbers.keys()
+    rule_list.sort()
+    return (rule_list, tuple(signature))
+
+class Stylesheets:
+    """
+    The compiled XSLT processors, by filename; reloaded when the file changes.
+    An XSLT object is not meant to run in several threads at the same time,
+    so each thread has its own set
+    """
+
+    def __init__(self):
+        self._local = threading.local()
+
+    def get(self, filepath):
+        cache = getattr(self._local, 'cache', None)
+        if cache is None:
+            cache = self._local.cache = {}
+        mtime = os.stat(filepath).st_mtime
+        entry = cache.get(filepath)
+        if entry is None or entry[0] != mtime:
+            entry = (mtime, etree.XSLT(etree.parse(filepath)))
+            cache[filepath] = entry
+        return entry[1]
+
+stylesheets = Stylesheets()
+
+class CompiledRule:
+    """
+    The lxml counterpart of XMLRule, with its extension files loaded once
+    """
+
+    final_processor = '__sfatables_rule_wrap_up__.xsl'
+
+    def __init__(self, chain, rule_number, config_dir=sfatables_config):
+        self.chain = chain
+        self.rule_number = rule_number
+        self.config_dir = config_dir
+        self.terminal = 0
+        self.processors = {'match':None,'target':None}
+        self.arguments = {'match':None,'target':None}
+        for type in ['match', 'target']:
+            self.load_xml_extension(type)
+
+    def load_xml_extension(self, type):
+        filename = os.path.join(self.config_dir, self.chain, "sfatables-%d-%s"%(self.rule_number,type))
+        xmldoc = etree.parse(filename)
+        if xmldoc.xpath('//attributes/attribute[@terminal="yes"]'):
+            self.terminal = 1
+        self.processors[type] = xmldoc.xpath('//processor/@filename')[0]
+        self.arguments[type] = xmldoc.xpath('//rule//argument[value!=""]')
+
+    def processor(self, filename):
+        return stylesheets.get(os.path.join(self.config_dir, 'processors', filename))
+
+    def add_rule_context_to_rspec(self, doc):
+        root = doc.getroot()
+        for (type, tag) in [ ('match', 'match-context'), ('target', 'target-context') ]:
+            node = etree.SubElement(root, tag)
+            for argument in self.arguments[type]:
+                node.append(deepcopy(argument))
+        return doc
+
+    # output =
+    #    if (match(match_args, rspec)
+    #       then target(target_args, rspec)
+    #       else rspec
+    def apply(self, doc):
+        doc = self.add_rule_context_to_rspec(doc)
+        match_result = self.processor(self.processors['match'])(doc).xpath("//result/@verdict")
+        if not match_result:
+            raise Exception("Could not apply processor %s."%self.processors['match'])
+        wrap_up = self.processor(self.final_processor)
+        if (match_result[0]=='True'):
+            return (True, wrap_up(self.processor(self.processors['target'])(doc)))
+        else:
+            return (False, wrap_up(doc))
+
+class _compiled_chain:
+
+    _instances = {}
+    _instances_lock = threading.Lock()
+
+    def __init__(self, chain_name, config_dir):
+        (rule_list, self.signature) = rule_numbers(os.path.join(config_dir, chain_name))
+        self.rules = [ CompiledRule(chain_name, rule_number, config_dir) for rule_number in rule_list ]
+
+def CompiledChain(chain_name, config_dir=sfatables_config):
+    """
+    @return the rules of a chain, compiled once for as long as the
+    chain directory does not change
+    """
+    (_, signature) = rule_numbers(os.path.join(config_dir, chain_name))
+    key = (config_dir, chain_name)
+    with _compiled_chain._instances_lock:
+        chain = _compiled_chain._instances.get(key)
+    if chain is None or chain.signature != signature:
+        chain = _compiled_chain(chain_name, config_dir)
+        with _compiled_chain._instances_lock:
+            _compiled_chain._instances[key] = chain
+    return chain
 
 class SFATablesRules:
-    def __init__(self, chain_name):
+    def __init__(self, chain_name, config_dir=sfatables_config):
         self.active_context = {}
         self.contexts = None # placeholder for rspec_manger
-        self.sorted_rule_list = []
         self.final_processor = '__sfatables_wrap_up__.xsl'
-        chain_dir_path = os.path.join(sfatables_config,chain_name)
-        rule_list = List().get_rule_list(chain_dir_path)
-        for rule_number in rule_list:
-            self.sorted_rule_list = self.sorted_rule_list + [XMLRule(chain_name, rule_number)]
+        self.config_dir = config_dir
+        self.sorted_rule_list = CompiledChain(chain_name, config_dir).rules
         return
 
     def wrap_up(self, doc):
-        filepath = os.path.join(sfatables_config, 'processors', self.final_processor)
+        filepath = os.path.join(self.config_dir, 'processors', self.final_processor)
 
         if not os.path.exists(filepath):
             raise Exception('Could not find final rule filter')
 
-        styledoc = libxml2.parseFile(filepath)
-        style = libxslt.parseStylesheetDoc(styledoc)
-        result = style.applyStylesheet(doc, None)
-        stylesheet_result = style.saveResultToString(result)
-        style.freeStylesheet()
-        doc.freeDoc()
-        result.freeDoc()
-
-        return stylesheet_result
+        return stylesheets.get(filepath)(doc)
 
     def set_context(self, request_context):
         self.active_context = request_context
         return
 
-    def create_xml_node(self, name, context_dict):
-        node = libxml2.newNode(name)
+    def create_xml_node(self, parent, name, context_dict):
+        node = etree.SubElement(parent, name)
         for k in context_dict.keys():
             if (type(context_dict[k])==dict):
-                childNode = self.create_xml_node(k, context_dict[k])
-                node.addChild(childNode)
+                self.create_xml_node(node, k, context_dict[k])
             else:
-                childNode = libxml2.newNode(k)
-                childNode.addContent(context_dict[k])
-                node.addChild(childNode)
+                etree.SubElement(node, k).text = context_dict[k]
         return node
-                
+
     def add_request_context_to_rspec(self, doc):
-        p = doc.xpathNewContext()
-        context = p.xpathEval("//*")
-        if not context or context[0].name not in ['RSpec', 'rspec']:
+        root = doc.getroot()
+        if root is None or etree.QName(root).localname not in ['RSpec', 'rspec']:
             raise Exception('Request is not an rspec')
         else:
             # Add the request context
-            requestNode = self.create_xml_node('request-context',self.active_context)
-            context[0].addChild(requestNode)
-        p.xpathFreeContext()
+            self.create_xml_node(root, 'request-context', self.active_context)
         return doc
 
-    
-    def apply(self, rspec):
-        if (self.sorted_rule_list):
-            doc = libxml2.parseDoc(rspec)
-            doc = self.add_request_context_to_rspec(doc)
-
-            intermediate_rspec = doc
-
+    def apply_tree(self, doc):
+        """
+        Run an already parsed rspec through the chain
+        @param doc an lxml ElementTree, that is left unchanged
+        @return the resulting lxml tree
+        """
+        root = doc.getroot()
+        children = len(root)
+        try:
+            intermediate_rspec = self.add_request_context_to_rspec(doc)
             for rule in self.sorted_rule_list:
-                (matched,intermediate_rspec) = rule.apply_interpreted(intermediate_rspec)
+                (matched,intermediate_rspec) = rule.apply(intermediate_rspec)
                 if (rule.terminal and matched):
                     break
+            return self.wrap_up(intermediate_rspec)
+        finally:
+            # remove the contexts that we added
+            del root[children:]
 
-            final_rspec = self.wrap_up(intermediate_rspec) 
+    def apply(self, rspec):
+        if (self.sorted_rule_list):
+            if isinstance(rspec, unicode):
+                rspec = rspec.encode('utf-8')
+            doc = etree.ElementTree(etree.fromstring(rspec))
+            final_rspec = str(self.apply_tree(doc))
         else:
             final_rspec = rspec
 
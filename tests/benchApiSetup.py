@@ -0,0 +1,64 @@
+#!/usr/bin/python
+#
+# measure the per-request setup cost of the server, i.e. what do_POST
+# does before the request gets actually dispatched:
+# . legacy: a complete generic.make_api() for each request
+# . context: one make_api_context() per process, then context.make_api()
+#
+# this needs a configured sfa install (/etc/sfa/sfa_config, server key and cert)
+#
+# usage: benchApiSetup.py [-n rounds] [-i interface]
+#
+import sys
+sys.path.append('..')
+
+import time
+from optparse import OptionParser
+
+from sfa.trust.certificate import Certificate
+from sfa.trust.hierarchy import Hierarchy
+from sfa.generic import Generic
+
+def bench(make_api, rounds):
+   start = time.time()
+   for i in range(rounds):
+      api = make_api()
+      api.close_dbsession()
+   return (time.time() - start) / rounds
+
+def main():
+   # the server's key and cert, as in sfa-start.py
+   auth_info = Hierarchy().get_interface_auth_info()
+   parser = OptionParser(usage="%prog [options]")
+   parser.add_option("-n", "--rounds", dest="rounds", type="int", default=50,
+                     help="number of api setups per measure")
+   parser.add_option("-i", "--interface", dest="interface", default="registry",
+                     help="one of registry, aggregate, slicemgr")
+   parser.add_option("-k", "--key", dest="key_file",
+                     default=auth_info.get_privkey_filename())
+   parser.add_option("-c", "--cert", dest="cert_file",
+                     default=auth_info.get_gid_filename())
+   (options, args) = parser.parse_args()
+
+   generic = Generic.the_flavour()
+   # the caller's cert does not matter much here
+   peer_cert = Certificate(filename=options.cert_file)
+
+   def legacy():
+      return generic.make_api(peer_cert=peer_cert, interface=options.interface,
+                              key_file=options.key_file, cert_file=options.cert_file)
+
+   start = time.time()
+   context = generic.make_api_context(interface=options.interface,
+                                      key_file=options.key_file, cert_file=options.cert_file)
+   context_setup = time.time() - start
+   def with_context():
+      return context.make_api(peer_cert=peer_cert)
+
+   print "%-10s %12s" % ("setup", "ms/request")
+   for (name, make_api) in [ ('legacy', legacy), ('context', with_context) ]:
+      print "%-10s %12.2f" % (name, bench(make_api, options.rounds) * 1000)
+   print "(one-time context setup: %.2f ms)" % (context_setup * 1000)
+
+if __name__ == "__main__":
+   main()
@@ -0,0 +1,88 @@
+#!/usr/bin/python
+#
+# compare the 'native' and 'xmlsec1' backends of Credential.verify,
+# on a plain credential and on a credential delegated once
+#
+# usage: benchCredential.py [-n rounds]
+#
+import sys
+sys.path.append('..')
+
+import os
+import time
+import shutil
+import tempfile
+import datetime
+from optparse import OptionParser
+
+from sfa.trust.certificate import Keypair
+from sfa.trust.gid import GID
+from sfa.trust.credential import Credential
+
+def create_signed_gid(subject, urn, issuer_pkey=None, issuer_gid=None):
+   gid = GID(subject=subject, uuid=1, urn=urn)
+   keys = Keypair(create=True)
+   gid.set_pubkey(keys)
+   if issuer_pkey:
+      gid.set_issuer(issuer_pkey, str(issuer_gid.get_issuer()))
+   else:
+      gid.set_issuer(keys, subject)
+      gid.set_intermediate_ca(True)
+   gid.encode()
+   gid.sign()
+   return gid, keys
+
+def create_credentials(tmpdir):
+   auth_gid, auth_keys = create_signed_gid("plc", "urn:publicid:IDN+plc+authority+sa")
+   caller_gid, caller_keys = create_signed_gid("plc.foo", "urn:publicid:IDN+plc+user+foo",
+                                               auth_keys, auth_gid)
+   object_gid, _ = create_signed_gid("plc.slice", "urn:publicid:IDN+plc+slice+bar",
+                                     auth_keys, auth_gid)
+   delegee_gid, _ = create_signed_gid("plc.delegee", "urn:publicid:IDN+plc+user+delegee",
+                                      auth_keys, auth_gid)
+
+   files = {}
+   for (name, obj) in [ ('auth_gid', auth_gid), ('auth_key', auth_keys),
+                        ('caller_gid', caller_gid), ('caller_key', caller_keys),
+                        ('delegee_gid', delegee_gid) ]:
+      files[name] = os.path.join(tmpdir, name)
+      obj.save_to_file(files[name])
+
+   cred = Credential()
+   cred.set_gid_caller(caller_gid)
+   cred.set_gid_object(object_gid)
+   cred.set_expiration(datetime.datetime.utcnow() + datetime.timedelta(seconds=3600))
+   cred.set_privileges("embed:1, bind:1")
+   cred.encode()
+   cred.set_issuer_keys(files['auth_key'], files['auth_gid'])
+   cred.sign()
+
+   delegated = cred.delegate(files['delegee_gid'], files['caller_key'], files['caller_gid'])
+   return (cred.save_to_string(), delegated.save_to_string(), [files['auth_gid']])
+
+def bench(cred_string, trusted_certs, backend, rounds):
+   start = time.time()
+   for i in range(rounds):
+      # from the string each time, as Auth.check does
+      Credential(string=cred_string).verify(trusted_certs, backend=backend)
+   return (time.time() - start) / rounds
+
+def main():
+   parser = OptionParser(usage="%prog [options]")
+   parser.add_option("-n", "--rounds", dest="rounds", type="int", default=50,
+                     help="number of verifications per measure")
+   (options, args) = parser.parse_args()
+
+   tmpdir = tempfile.mkdtemp()
+   try:
+      (single, delegated, trusted_certs) = create_credentials(tmpdir)
+      print "%-12s %-10s %12s" % ("credential", "backend", "ms/verify")
+      for (name, cred_string) in [ ('single', single), ('delegated', delegated) ]:
+         for backend in [ 'xmlsec1', 'native' ]:
+            elapsed = bench(cred_string, trusted_certs, backend, options.rounds)
+            print "%-12s %-10s %12.2f" % (name, backend, elapsed * 1000)
+   finally:
+      shutil.rmtree(tmpdir)
+
+if __name__ == "__main__":
+   main()
@@ -0,0 +1,71 @@
+#!/usr/bin/python
+#
+# measure how long the slice manager takes to merge the advertisements
+# of several aggregates into one
+# . elements: the node/link/lease objects are extracted from each rspec
+#   and then added again into the result - as needed across flavours
+# . subtrees: the xml elements are moved over as-is - same flavour only
+#
+# usage: benchRSpecMerge.py [-a aggregates] [-n nodes] [-v version]
+#
+import sys
+sys.path.append('..')
+
+import time
+from optparse import OptionParser
+
+from sfa.rspecs.rspec import RSpec
+from sfa.rspecs.version_manager import VersionManager
+
+# a synthetic advertisement
+def advertisement(version, aggregate, nodes):
+    rspec = RSpec(version=version)
+    authority = "urn:publicid:IDN+%s" % aggregate
+    nodes = [ {'component_manager_id': "%s+authority+cm" % authority,
+               'component_id': "%s+node+node%d" % (authority, i),
+               'exclusive': 'false',
+               'hardware_types': [{'name': 'plab-pc'}, {'name': 'pc'}],
+               'location': {'country': 'unknown', 'longitude': str(i % 180), 'latitude': str(i % 90)},
+               'interfaces': [{'component_id': "%s+interface+node%d:eth0" % (authority, i),
+                               'ipv4': "10.0.%d.%d" % (i / 256 % 256, i % 256)}],
+               'available': 'true',
+               'pl_initscripts': [{'name': 'gpu'}],
+               'tags': [{'tagname': 'arch', 'value': 'x86_64'}],
+               } for i in range(nodes) ]
+    rspec.version.add_nodes(nodes)
+    return rspec.toxml()
+
+def bench(version, ads, merge):
+    start = time.time()
+    # RSpec points version.xml at its own document, so each RSpec
+    # needs a version object of its own
+    rspec = RSpec(version=version.__class__())
+    for ad in ads:
+        in_rspec = RSpec(ad, version=version.__class__())
+        merge(rspec.version, in_rspec)
+    xml = rspec.toxml()
+    return (time.time() - start, len(xml))
+
+def main():
+    parser = OptionParser(usage="%prog [options]")
+    parser.add_option("-a", "--aggregates", dest="aggregates", type="int", default=10,
+                      help="number of aggregates")
+    parser.add_option("-n", "--nodes", dest="nodes", type="int", default=1000,
+                      help="number of nodes per aggregate")
+    parser.add_option("-v", "--version", dest="version", default="GENI 3",
+                      help="rspec type and version")
+    (options, args) = parser.parse_args()
+
+    (type, version) = options.version.split()
+    version = VersionManager()._get_version(type, version, 'ad')
+    ads = [advertisement(version, "agg%d" % i, options.nodes) for i in range(options.aggregates)]
+
+    print "%d aggregates x %d nodes, %s" % (options.aggregates, options.nodes, version)
+    print "%-10s %10s %12s" % ("merge", "seconds", "bytes")
+    for (name, merge) in [ ('elements', lambda v, r: v.merge_elements(r)),
+                           ('subtrees', lambda v, r: v.merge_subtrees(r)) ]:
+        (elapsed, size) = bench(version, ads, merge)
+        print "%-10s %10.2f %12d" % (name, elapsed, size)
+
+if __name__ == "__main__":
+    main()
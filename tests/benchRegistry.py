@@ -0,0 +1,96 @@
+#!/usr/bin/python
+#
+# measure the registry lookups on a synthetic registry, with or without
+# the indexes on the records table (see migration 004)
+# the queries are the ones issued by the registry manager:
+# . get: GetCredential/Register/Update - filter_by(type,hrn)
+# . resolve: Resolve - hrn in (...)
+# . list: List - filter_by(authority)
+# . list-recursive: List - hrn.startswith()
+# . pointers: fill_record_sfa_info - type and pointer in (...)
+#
+# usage: benchRegistry.py [-u url] [-a authorities] [-r records] [-i]
+# the default is an in-memory sqlite db; note that sqlite uses no index
+# for LIKE on a case-sensitive column, so list-recursive needs postgresql
+#
+import sys
+sys.path.append('..')
+
+import time
+import random
+from optparse import OptionParser
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+from sfa.storage.model import Base, RegRecord
+
+def load(engine, authorities, records):
+    table = RegRecord.__table__
+    rows = [ {'classtype': 'authority', 'type': 'authority', 'hrn': 'plc.site%d' % a,
+              'authority': 'plc', 'pointer': a} for a in range(authorities) ]
+    per_authority = records / authorities
+    for a in range(authorities):
+        for r in range(per_authority):
+            type = ['user', 'slice', 'node'][r % 3]
+            rows.append({'classtype': type, 'type': type, 'hrn': 'plc.site%d.%s%d' % (a, type, r),
+                         'authority': 'plc.site%d' % a, 'pointer': a * per_authority + r})
+    for i in range(0, len(rows), 10000):
+        engine.execute(table.insert(), rows[i:i+10000])
+    return rows
+
+def timed(name, count, run):
+    start = time.time()
+    for i in range(count):
+        run(i)
+    elapsed = time.time() - start
+    print "%-15s %8d %12.3f %12.3f" % (name, count, elapsed, elapsed * 1000 / count)
+
+def main():
+    parser = OptionParser(usage="%prog [options]")
+    parser.add_option("-u", "--url", dest="url", default="sqlite://",
+                      help="sqlalchemy url of a scratch db")
+    parser.add_option("-a", "--authorities", dest="authorities", type="int", default=1000,
+                      help="number of authorities")
+    parser.add_option("-r", "--records", dest="records", type="int", default=200000,
+                      help="number of user/slice/node records")
+    parser.add_option("-n", "--calls", dest="calls", type="int", default=200,
+                      help="number of calls of each kind")
+    parser.add_option("-i", "--no-indexes", dest="indexes", action="store_false", default=True,
+                      help="drop the indexes on the records table")
+    (options, args) = parser.parse_args()
+
+    engine = create_engine(options.url)
+    Base.metadata.drop_all(engine)
+    Base.metadata.create_all(engine)
+    if not options.indexes:
+        for index in RegRecord.__table__.indexes:
+            index.drop(engine)
+        if engine.dialect.name == 'postgresql':
+            engine.execute("alter table records drop constraint records_type_hrn_key")
+    start = time.time()
+    rows = load(engine, options.authorities, options.records)
+    print "%d records loaded in %.1fs, indexes %s" % (len(rows), time.time() - start,
+                                                      'on' if options.indexes else 'off')
+    dbsession = sessionmaker(bind=engine)()
+
+    random.seed(0)
+    picks = [ random.choice(rows) for i in range(options.calls) ]
+    authorities = [ 'plc.site%d' % random.randrange(options.authorities) for i in range(options.calls) ]
+
+    print "%-15s %8s %12s %12s" % ("query", "calls", "seconds", "ms/call")
+    timed('get', options.calls, lambda i: 
+          dbsession.query(RegRecord).filter_by(type=picks[i]['type'], hrn=picks[i]['hrn']).first())
+    timed('resolve', options.calls, lambda i:
+          dbsession.query(RegRecord).filter(RegRecord.hrn.in_([ pick['hrn'] for pick in picks[i:i+10] ])).all())
+    timed('list', options.calls, lambda i:
+          dbsession.query(RegRecord).filter_by(authority=authorities[i]).all())
+    timed('list-recursive', options.calls, lambda i:
+          dbsession.query(RegRecord).filter(RegRecord.hrn.startswith(authorities[i] + '.')).all())
+    timed('pointers', options.calls, lambda i:
+          dbsession.query(RegRecord).filter_by(type='user').\
+              filter(RegRecord.pointer.in_([ pick['pointer'] for pick in picks[i:i+10] ])).all())
+    dbsession.close()
+
+if __name__ == "__main__":
+    main()
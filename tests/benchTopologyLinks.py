@@ -0,0 +1,110 @@
+#!/usr/bin/python
+#
+# measure how long PlAggregate takes to compute the topology links
+# on a synthetic topology
+# . legacy: the former code, with 2 PlXrn and 2 Interface per node pair
+# . first: precomputed interfaces, one PlXrn per node and per site pair
+# . cached: same topology and nodes again
+#
+# usage: benchTopologyLinks.py [-s sites] [-n nodes] [-l links]
+#
+import sys
+sys.path.append('..')
+
+import os
+import time
+import random
+import tempfile
+from optparse import OptionParser
+
+from sfa.util.xrn import hrn_to_urn
+from sfa.rspecs.elements.link import Link
+from sfa.rspecs.elements.interface import Interface
+from sfa.planetlab.plxrn import PlXrn
+from sfa.planetlab.topology import Topology
+from sfa.planetlab.plaggregate import PlAggregate
+
+class Driver:
+    hrn = 'plc'
+
+def synthetic(nb_sites, nb_nodes, nb_links):
+    sites, nodes, interfaces = {}, {}, {}
+    node_id = 0
+    for site_id in range(1, nb_sites + 1):
+        node_ids = range(node_id + 1, node_id + nb_nodes + 1)
+        node_id += nb_nodes
+        sites[site_id] = {'site_id': site_id, 'login_base': 'site%d' % site_id, 'node_ids': node_ids}
+        for id in node_ids:
+            nodes[id] = {'node_id': id, 'interface_ids': [id]}
+            interfaces[id] = {'interface_id': id, 'ip': '10.%d.%d.%d' % (id / 65536, id / 256 % 256, id % 256)}
+    random.seed(0)
+    pairs = set()
+    while len(pairs) < nb_links:
+        (site_id1, site_id2) = random.sample(sites.keys(), 2)
+        pairs.add( (str(site_id1), str(site_id2)) )
+    return (sites, nodes, interfaces, pairs)
+
+# the code that PlAggregate.get_links used to run
+def legacy_links(hrn, sites, nodes, interfaces, topology):
+    links = []
+    for (site_id1, site_id2) in topology:
+        site_id1 = int(site_id1)
+        site_id2 = int(site_id2)
+        if not site_id1 in sites or site_id2 not in sites:
+            continue
+        site1 = sites[site_id1]
+        site2 = sites[site_id2]
+        for s1_node_id in site1['node_ids']:
+            for s2_node_id in site2['node_ids']:
+                if s1_node_id not in nodes or s2_node_id not in nodes:
+                    continue
+                node1 = nodes[s1_node_id]
+                node2 = nodes[s2_node_id]
+                if1_xrn = PlXrn(auth=hrn, interface='node%s:eth0' % (node1['node_id']))
+                if1_ipv4 = interfaces[node1['interface_ids'][0]]['ip']
+                if2_xrn = PlXrn(auth=hrn, interface='node%s:eth0' % (node2['node_id']))
+                if2_ipv4 = interfaces[node2['interface_ids'][0]]['ip']
+                if1 = Interface({'component_id': if1_xrn.urn, 'ipv4': if1_ipv4} )
+                if2 = Interface({'component_id': if2_xrn.urn, 'ipv4': if2_ipv4} )
+                link = Link({'capacity': '1000000', 'latency': '0', 'packet_loss': '0', 'type': 'ipv4'})
+                link['interface1'] = if1
+                link['interface2'] = if2
+                link['component_name'] = "%s:%s" % (site1['login_base'], site2['login_base'])
+                link['component_id'] = PlXrn(auth=hrn, interface=link['component_name']).get_urn()
+                link['component_manager_id'] =  hrn_to_urn(hrn, 'authority+am')
+                links.append(link)
+    return links
+
+def main():
+    parser = OptionParser(usage="%prog [options]")
+    parser.add_option("-s", "--sites", dest="sites", type="int", default=1000,
+                      help="number of sites")
+    parser.add_option("-n", "--nodes", dest="nodes", type="int", default=3,
+                      help="number of nodes per site")
+    parser.add_option("-l", "--links", dest="links", type="int", default=2000,
+                      help="number of site pairs in the topology")
+    (options, args) = parser.parse_args()
+
+    (sites, nodes, interfaces, pairs) = synthetic(options.sites, options.nodes, options.links)
+    (fd, filename) = tempfile.mkstemp()
+    try:
+        f = os.fdopen(fd, 'w')
+        for pair in pairs:
+            f.write("%s %s\n" % pair)
+        f.close()
+
+        print "%d sites x %d nodes, %d site pairs" % (options.sites, options.nodes, options.links)
+        print "%-10s %10s %10s" % ("run", "seconds", "links")
+        aggregate = PlAggregate(Driver())
+        runs = [ ('legacy', lambda: legacy_links(Driver.hrn, sites, nodes, interfaces, Topology(filename))),
+                 ('first', lambda: aggregate.get_links(sites, nodes, interfaces, Topology(filename))),
+                 ('cached', lambda: aggregate.get_links(sites, nodes, interfaces, Topology(filename))) ]
+        for (name, run) in runs:
+            start = time.time()
+            links = run()
+            print "%-10s %10.3f %10d" % (name, time.time() - start, len(links))
+    finally:
+        os.unlink(filename)
+
+if __name__ == "__main__":
+    main()
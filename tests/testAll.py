@@ -10,9 +10,23 @@ from testXrn import *
 # xxx broken-test
 #from testCred import *
 from testKeypair import *
+from testSignatures import *
 # xxx broken-test
 #from testHierarchy import *
+from testGidFactory import *
 from testStorage import *
+from testCredentialCache import *
+from testConnectionPool import *
+from testMultiClient import *
+from testCache import *
+from testSfatables import *
+from testLeaseIndex import *
+from testPlShell import *
+from testPlMirror import *
+from testPlImporter import *
+from testRegistryAugment import *
+from testEventServer import *
+from testRSpecMerge import *
 
 if __name__ == "__main__":
     unittest.main()
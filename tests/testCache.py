@@ -0,0 +1,168 @@
+import os
+import time
+import shutil
+import pickle
+import tempfile
+import threading
+import unittest
+from sfa.util.cache import Cache, CacheData, cache_stats, cache_derive
+
+class TestCache(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def testNamespaces(self):
+        Cache(namespace='test-shared').add('key', 'value')
+        self.assertEqual(Cache(namespace='test-shared').get('key'), 'value')
+        # private caches do not see each other
+        Cache().add('key', 'value')
+        self.assertEqual(Cache().get('key'), None)
+        self.assertTrue('test-shared' in [ stats['name'] for stats in cache_stats() ])
+
+    def testMaxEntries(self):
+        cache = Cache(max_entries=2)
+        cache.add('a', 1)
+        cache.add('b', 2)
+        # 'a' is now the most recently used
+        self.assertEqual(cache.get('a'), 1)
+        cache.add('c', 3)
+        self.assertEqual(cache.get('b'), None)
+        self.assertEqual(cache.get('a'), 1)
+        self.assertEqual(cache.get('c'), 3)
+        stats = cache.stats()
+        self.assertEqual(stats['evictions'], 1)
+        self.assertEqual(stats['hits'], 3)
+        self.assertEqual(stats['misses'], 1)
+
+    def testMaxBytes(self):
+        cache = Cache(max_bytes=1000)
+        cache.add('a', 'x' * 600)
+        cache.add('b', 'y' * 600)
+        self.assertEqual(cache.get('a'), None)
+        self.assertEqual(cache.stats()['bytes'], 600)
+        # too big to be kept at all
+        cache.add('c', 'z' * 2000)
+        self.assertEqual(cache.get('c'), None)
+
+    def testExpiration(self):
+        cache = Cache()
+        cache.add('short', 'value', ttl=-1)
+        cache.add('long', 'value')
+        self.assertEqual(cache.namespace.sweep(), 1)
+        self.assertEqual(cache.get('short'), None)
+        self.assertEqual(cache.get('long'), 'value')
+        self.assertEqual(cache.stats()['expirations'], 1)
+
+    def testDisk(self):
+        cache = Cache(max_entries=1, directory=self.dir)
+        cache.add('a', {'geni_api': 3, 'peers': ['x', 'y']})
+        cache.add('b', 'rspec')
+        # 'a' was evicted from memory, but is still on disk
+        self.assertEqual(cache.get('a'), {'geni_api': 3, 'peers': ['x', 'y']})
+        self.assertEqual(cache.stats()['disk_hits'], 1)
+        # and another process would find it too
+        self.assertEqual(Cache(directory=self.dir).get('b'), 'rspec')
+        cache.pop('b')
+        self.assertEqual(Cache(directory=self.dir).get('b'), None)
+
+    def testDiskFreshness(self):
+        Cache(directory=self.dir).add('ad', 'old', ttl=-1, grace=60)
+        # restored as stale but still servable, not as fresh
+        cache = Cache(directory=self.dir)
+        def build():
+            return 'new'
+        def refresh():
+            return 'new'
+        self.assertEqual(cache.get_or_build('ad', build, grace=60, refresh=refresh), 'old')
+        self.assertEqual(cache.stats()['stale_hits'], 1)
+
+    def testSaveLoadFile(self):
+        filename = os.path.join(self.dir, 'cache.dat')
+        cache = Cache()
+        cache.add('version', {'geni_api': 3}, ttl=60)
+        cache.add('gone', 'value', ttl=-1)
+        cache.save_to_file(filename)
+        loaded = Cache(filename)
+        self.assertEqual(loaded.get('version'), {'geni_api': 3})
+        self.assertEqual(loaded.get('gone'), None)
+
+    def testLoadLegacyFile(self):
+        filename = os.path.join(self.dir, 'cache.dat')
+        f = open(filename, 'w')
+        pickle.dump({'version': CacheData({'geni_api': 2})}, f)
+        f.close()
+        self.assertEqual(Cache(filename).get('version'), {'geni_api': 2})
+
+    def testSingleFlight(self):
+        cache = Cache()
+        calls = []
+        def build():
+            calls.append(1)
+            time.sleep(0.2)
+            return 'rspec'
+        results = []
+        def caller():
+            results.append(cache.get_or_build('ad', build))
+        threads = [ threading.Thread(target=caller) for i in range(5) ]
+        for thread in threads: thread.start()
+        for thread in threads: thread.join()
+        self.assertEqual(results, ['rspec'] * 5)
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(cache.stats()['coalesced'], 4)
+
+    def testBuildError(self):
+        cache = Cache()
+        def build():
+            raise ValueError("no plc")
+        self.assertRaises(ValueError, cache.get_or_build, 'ad', build)
+        self.assertEqual(cache.get('ad'), None)
+
+    def testStaleWhileRevalidate(self):
+        cache = Cache()
+        cache.add('ad', 'old', ttl=-1, grace=60)
+        refreshed = threading.Event()
+        def refresh():
+            refreshed.wait()
+            return 'new'
+        def build():
+            self.fail("build should not be called")
+        # the stale value comes back right away
+        self.assertEqual(cache.get_or_build('ad', build, grace=60, refresh=refresh), 'old')
+        self.assertEqual(cache.get_or_build('ad', build, grace=60, refresh=refresh), 'old')
+        refreshed.set()
+        for i in range(50):
+            if cache.get('ad') == 'new': break
+            time.sleep(0.02)
+        self.assertEqual(cache.get_or_build('ad', build, grace=60, refresh=refresh), 'new')
+        stats = cache.stats()
+        self.assertEqual(stats['stale_hits'], 2)
+        self.assertEqual(stats['built'], 1)
+
+    def testDerived(self):
+        cache = Cache(max_entries=2)
+        calls = []
+        def compute():
+            calls.append(1)
+            return 'X' * 1000
+        rspec = 'x' * 1000
+        cache.add('ad', rspec)
+        self.assertEqual(cache_derive(rspec, 'upper', compute), 'X' * 1000)
+        self.assertEqual(cache_derive(rspec, 'upper', compute), 'X' * 1000)
+        self.assertEqual(len(calls), 1)
+        # counted in the size of the entry
+        self.assertEqual(cache.stats()['bytes'], 2000)
+        self.assertEqual(cache.stats()['derived_hits'], 1)
+        # an equal but distinct string is another advertisement
+        self.assertEqual(cache_derive(''.join(['x'] * 1000), 'upper', compute), 'X' * 1000)
+        self.assertEqual(len(calls), 2)
+        # and the derived values go away with the entry
+        cache.pop('ad')
+        self.assertEqual(cache.stats()['bytes'], 0)
+        cache_derive(rspec, 'upper', compute)
+        self.assertEqual(len(calls), 3)
+
+if __name__ == "__main__":
+    unittest.main()
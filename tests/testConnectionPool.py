@@ -0,0 +1,91 @@
+import socket
+import unittest
+from sfa.client.sfaserverproxy import HTTPSConnectionPool, XMLRPCTransport
+
+# stands for an HTTPSConnection
+class Connection:
+    def __init__(self):
+        self.sock = None
+        self.closed = False
+    def close(self):
+        self.closed = True
+
+class Socket:
+    def __init__(self, timeout):
+        self.timeout = timeout
+    def settimeout(self, timeout):
+        self.timeout = timeout
+
+# a connection that fails as soon as a request is sent
+class BrokenConnection(Connection):
+    def putrequest(self, *args, **kwds):
+        raise socket.error("broken")
+
+class TestConnectionPool(unittest.TestCase):
+    def setUp(self):
+        self.pool = HTTPSConnectionPool(max_idle=1, max_active=2, idle_timeout=60)
+        # no real socket here
+        self.pool.is_healthy = lambda conn: not conn.closed
+        self.key = ('peer:12346', 'key', 'cert')
+
+    def testReuse(self):
+        (conn, reused) = self.pool.acquire(self.key, Connection)
+        self.assertFalse(reused)
+        self.pool.release(self.key, conn, True)
+        (again, reused) = self.pool.acquire(self.key, Connection)
+        self.assertTrue(reused)
+        self.assertTrue(again is conn)
+
+    def testNotReusable(self):
+        (conn, _) = self.pool.acquire(self.key, Connection)
+        self.pool.release(self.key, conn, False)
+        self.assertTrue(conn.closed)
+        (other, reused) = self.pool.acquire(self.key, Connection)
+        self.assertFalse(reused)
+
+    def testMaxIdle(self):
+        (conn1, _) = self.pool.acquire(self.key, Connection)
+        (conn2, _) = self.pool.acquire(self.key, Connection)
+        self.pool.release(self.key, conn1, True)
+        self.pool.release(self.key, conn2, True)
+        self.assertTrue(conn2.closed)
+        self.assertEqual(self.pool.stats()['idle'], 1)
+
+    def testUnhealthy(self):
+        (conn, _) = self.pool.acquire(self.key, Connection)
+        self.pool.release(self.key, conn, True)
+        conn.closed = True
+        (other, reused) = self.pool.acquire(self.key, Connection)
+        self.assertFalse(reused)
+
+    def testIdleTimeout(self):
+        self.pool.idle_timeout = -1
+        (conn, _) = self.pool.acquire(self.key, Connection)
+        self.pool.release(self.key, conn, True)
+        (other, reused) = self.pool.acquire(self.key, Connection)
+        self.assertFalse(reused)
+        self.assertTrue(conn.closed)
+
+    def testMaxActive(self):
+        self.pool.acquire(self.key, Connection)
+        self.pool.acquire(self.key, Connection)
+        self.assertRaises(socket.timeout, self.pool.acquire, self.key, Connection, 0.1)
+        # other peers are not affected
+        self.pool.acquire(('other:12346', 'key', 'cert'), Connection, 0.1)
+        # without a timeout, the wait is bounded anyway
+        self.pool.max_wait = 0.1
+        self.assertRaises(socket.timeout, self.pool.acquire, self.key, Connection)
+
+    def testReusedTimeout(self):
+        # left in the pool by a proxy with a timeout
+        key = ('peer:12346', None, None)
+        (conn, _) = self.pool.acquire(key, BrokenConnection)
+        conn.sock = Socket(5.0)
+        self.pool.release(key, conn, True)
+        # and reused by one without
+        transport = XMLRPCTransport(timeout=None, pool=self.pool)
+        self.assertRaises(socket.error, transport.single_request, 'peer:12346', '/', '')
+        self.assertEqual(conn.sock.timeout, None)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,36 @@
+import unittest
+import datetime
+from sfa.trust.credential_cache import _verified_credentials_impl
+
+class TestCredentialCache(unittest.TestCase):
+    def setUp(self):
+        self.cache = _verified_credentials_impl(max_entries=2)
+        self.later = datetime.datetime.utcnow() + datetime.timedelta(hours=1)
+
+    def testMissThenHit(self):
+        self.assertFalse(self.cache.is_verified("<cred1/>", "roots"))
+        self.cache.add("<cred1/>", "roots", self.later)
+        self.assertTrue(self.cache.is_verified("<cred1/>", "roots"))
+        self.assertEqual(self.cache.stats()['hits'], 1)
+
+    def testExpired(self):
+        earlier = datetime.datetime.utcnow() - datetime.timedelta(seconds=1)
+        self.cache.add("<cred1/>", "roots", earlier)
+        self.assertFalse(self.cache.is_verified("<cred1/>", "roots"))
+
+    def testRootsChange(self):
+        self.cache.add("<cred1/>", "roots", self.later)
+        self.assertFalse(self.cache.is_verified("<cred1/>", "other-roots"))
+        self.assertEqual(len(self.cache), 0)
+
+    def testLeastRecentlyUsedGoesFirst(self):
+        self.cache.add("<cred1/>", "roots", self.later)
+        self.cache.add("<cred2/>", "roots", self.later)
+        self.assertTrue(self.cache.is_verified("<cred1/>", "roots"))
+        self.cache.add("<cred3/>", "roots", self.later)
+        self.assertTrue(self.cache.is_verified("<cred1/>", "roots"))
+        self.assertFalse(self.cache.is_verified("<cred2/>", "roots"))
+        self.assertTrue(self.cache.is_verified("<cred3/>", "roots"))
+
+if __name__ == "__main__":
+    unittest.main()
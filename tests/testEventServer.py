@@ -0,0 +1,222 @@
+from __future__ import with_statement
+import os
+import ssl
+import time
+import shutil
+import socket
+import tempfile
+import threading
+import unittest
+import xmlrpclib
+
+from OpenSSL import crypto
+
+from sfa.server.eventserver import EventServer
+
+# stands for the api context and the apis it makes, echoes the calls
+class Api:
+    def __init__(self, peer_cert):
+        self.peer_cert = peer_cert
+        self.remote_addr = None
+    def handle(self, source, data, method_map):
+        (args, method) = xmlrpclib.loads(data)
+        return xmlrpclib.dumps(((method,) + args,), methodresponse=True)
+    def prepare_response(self, result, method=""):
+        return xmlrpclib.dumps(xmlrpclib.Fault(1, str(result)), methodresponse=True)
+    def close_dbsession(self):
+        pass
+
+class ApiContext:
+    def make_api(self, peer_cert=None):
+        return Api(peer_cert)
+
+def request(method, *args):
+    body = xmlrpclib.dumps(args, method)
+    return "POST /RPC2 HTTP/1.1\r\nHost: localhost\r\nContent-Length: %d\r\n\r\n%s" % (len(body), body)
+
+class TestEventServer(unittest.TestCase):
+    # the poll timeout of the event loop; None means that only the
+    # socket events and the wakeup pipe can get handle_events to return
+    poll_timeout = None
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        key = crypto.PKey()
+        key.generate_key(crypto.TYPE_RSA, 2048)
+        cert = crypto.X509()
+        cert.get_subject().CN = "test"
+        cert.set_serial_number(1)
+        cert.gmtime_adj_notBefore(0)
+        cert.gmtime_adj_notAfter(3600)
+        cert.set_issuer(cert.get_subject())
+        cert.set_pubkey(key)
+        cert.sign(key, "sha256")
+        self.key_file = os.path.join(self.dir, "test.pkey")
+        self.cert_file = os.path.join(self.dir, "test.cert")
+        open(self.key_file, 'w').write(crypto.dump_privatekey(crypto.FILETYPE_PEM, key))
+        open(self.cert_file, 'w').write(crypto.dump_certificate(crypto.FILETYPE_PEM, cert))
+
+        self.server = EventServer(('127.0.0.1', 0), self.key_file, self.cert_file, workers=1)
+        self.server.get_api_context = lambda: ApiContext()
+        self.server.stats_period = 0
+        self.port = self.server.socket.getsockname()[1]
+        worker = threading.Thread(target=self.server.worker_thread)
+        worker.setDaemon(True)
+        worker.start()
+        self.stopped = False
+        self.loop = threading.Thread(target=self.run_loop)
+        self.loop.setDaemon(True)
+        self.loop.start()
+
+    def run_loop(self):
+        while not self.stopped:
+            self.server.handle_events(timeout=self.poll_timeout)
+
+    def tearDown(self):
+        self.stopped = True
+        os.write(self.server.wakeup_write, 'x')
+        self.loop.join(5)
+        self.server.server_close()
+        shutil.rmtree(self.dir)
+
+    def connect(self):
+        sock = socket.create_connection(('127.0.0.1', self.port), 5)
+        return ssl.wrap_socket(sock, keyfile=self.key_file, certfile=self.cert_file)
+
+    # (status, headers, body); status is None if the server closed the connection
+    def response(self, conn):
+        data = ""
+        while "\r\n\r\n" not in data:
+            chunk = conn.recv(4096)
+            if not chunk:
+                return (None, {}, data)
+            data += chunk
+        (head, body) = data.split("\r\n\r\n", 1)
+        lines = head.split("\r\n")
+        headers = dict([ (name.strip().lower(), value.strip())
+                         for (name, value) in [ line.split(':', 1) for line in lines[1:] ] ])
+        while len(body) < int(headers['content-length']):
+            body += conn.recv(4096)
+        return (int(lines[0].split()[1]), headers, body)
+
+    def result(self, body):
+        return xmlrpclib.loads(body)[0][0]
+
+    def wait_for(self, condition, timeout=5):
+        deadline = time.time() + timeout
+        while not condition() and time.time() < deadline:
+            time.sleep(0.01)
+        return condition()
+
+    def testRequest(self):
+        conn = self.connect()
+        try:
+            conn.sendall(request('GetVersion', 1))
+            (status, headers, body) = self.response(conn)
+            self.assertEqual(status, 200)
+            self.assertEqual(headers['connection'], 'keep-alive')
+            self.assertEqual(self.result(body), ['GetVersion', 1])
+        finally:
+            conn.close()
+
+    def testHandshakeDoesNotBlock(self):
+        # a client that connects and never does its part of the handshake
+        stalled = socket.create_connection(('127.0.0.1', self.port), 5)
+        try:
+            self.assertTrue(self.wait_for(lambda: self.server.stats()['accepted'] == 1))
+            conn = self.connect()
+            try:
+                conn.sendall(request('ListResources'))
+                (status, _, body) = self.response(conn)
+                self.assertEqual(status, 200)
+                self.assertEqual(self.result(body), ['ListResources'])
+            finally:
+                conn.close()
+        finally:
+            stalled.close()
+
+    def testPartialReads(self):
+        conn = self.connect()
+        try:
+            data = request('Describe', 'urn:publicid:IDN+plc+slice+test', 'x' * 10000)
+            # cut within the request line, the headers and the body
+            for (start, end) in [ (0, 7), (7, 40), (40, len(data) - 5000), (len(data) - 5000, len(data)) ]:
+                conn.sendall(data[start:end])
+                time.sleep(0.05)
+            (status, _, body) = self.response(conn)
+            self.assertEqual(status, 200)
+            self.assertEqual(self.result(body), ['Describe', 'urn:publicid:IDN+plc+slice+test', 'x' * 10000])
+        finally:
+            conn.close()
+
+    def testKeepAlive(self):
+        conn = self.connect()
+        try:
+            for i in range(3):
+                conn.sendall(request('Status', i))
+                (status, _, body) = self.response(conn)
+                self.assertEqual(self.result(body), ['Status', i])
+            # two requests pipelined in one write
+            conn.sendall(request('Status', 3) + request('Status', 4))
+            self.assertEqual(self.result(self.response(conn)[2]), ['Status', 3])
+            self.assertEqual(self.result(self.response(conn)[2]), ['Status', 4])
+            stats = self.server.stats()
+            self.assertEqual(stats['accepted'], 1)
+            self.assertEqual(stats['kept_alive'], 4)
+            self.assertEqual(stats['handled'], 5)
+        finally:
+            conn.close()
+
+    def testConnectionClose(self):
+        conn = self.connect()
+        try:
+            conn.sendall(request('Status').replace("Host:", "Connection: close\r\nHost:"))
+            (status, headers, _) = self.response(conn)
+            self.assertEqual(status, 200)
+            self.assertEqual(headers['connection'], 'close')
+            self.assertEqual(conn.recv(4096), "")
+        finally:
+            conn.close()
+
+    def testBadRequest(self):
+        conn = self.connect()
+        try:
+            conn.sendall("GET / HTTP/1.1\r\nHost: localhost\r\n\r\n")
+            (status, _, _) = self.response(conn)
+            self.assertEqual(status, 501)
+        finally:
+            conn.close()
+
+class TestEventServerTimeouts(TestEventServer):
+    # check_timeouts runs once per handle_events
+    poll_timeout = 0.05
+
+    def testIdleTimeout(self):
+        self.server.keep_alive_timeout = 0.3
+        conn = self.connect()
+        try:
+            conn.sendall(request('Status'))
+            self.assertEqual(self.response(conn)[0], 200)
+            # idle between two requests
+            self.assertEqual(self.response(conn)[0], None)
+            self.assertTrue(self.wait_for(lambda: self.server.stats()['connections'] == 0))
+        finally:
+            conn.close()
+
+    def testRequestTimeout(self):
+        self.server.request_timeout = 0.3
+        # an incomplete handshake
+        stalled = socket.create_connection(('127.0.0.1', self.port), 5)
+        conn = self.connect()
+        try:
+            # and an incomplete request
+            conn.sendall(request('Status')[:20])
+            self.assertEqual(self.response(conn)[0], None)
+            self.assertEqual(stalled.recv(4096), "")
+            self.assertTrue(self.wait_for(lambda: self.server.stats()['connections'] == 0))
+        finally:
+            conn.close()
+            stalled.close()
+
+if __name__ == "__main__":
+    unittest.main()
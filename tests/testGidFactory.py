@@ -0,0 +1,77 @@
+from __future__ import with_statement
+import unittest
+import os
+import time
+import shutil
+import tempfile
+from sfa.util.config import Config
+from sfa.trust.hierarchy import *
+from sfa.trust.gidfactory import GidFactory, _gid_factory
+from sfa.trust.gid import create_uuid
+
+class TestGidFactory(unittest.TestCase):
+    def setUp(self):
+        # Hierarchy.create_gid needs to know the interface hrn; set before the
+        # factory forks its workers so that they see it too
+        Config.SFA_INTERFACE_HRN = "planetlab"
+        # a fresh directory, and so a fresh factory with its own workers, per test
+        self.basedir = tempfile.mkdtemp()
+        self.hierarchy = Hierarchy(self.basedir)
+        self.hierarchy.create_auth("planetlab.us.arizona", create_parents=True)
+        self.factory = GidFactory(self.hierarchy)
+
+    def tearDown(self):
+        with _gid_factory._instances_lock:
+            factory = _gid_factory._instances.pop(self.basedir, None)
+        if factory is not None and factory.pool is not None:
+            factory.pool.terminate()
+        shutil.rmtree(self.basedir)
+        del Config.SFA_INTERFACE_HRN
+
+    def testSingleton(self):
+        self.assert_(GidFactory(Hierarchy(self.basedir)) is self.factory)
+
+    def testKeypair(self):
+        pems = set()
+        for i in range(_gid_factory.stock_size + 4):
+            pems.add(self.factory.keypair().as_pem())
+        # all different
+        self.assertEqual(len(pems), _gid_factory.stock_size + 4)
+
+    def testCreateGids(self):
+        pkey = self.factory.keypair()
+        names = [ "planetlab.us.arizona.node%d" % i for i in range(10) ]
+        pending = [ self.factory.create_gid_async(hrn_to_urn(name, 'node'), create_uuid()) for name in names ]
+        pending.append(self.factory.create_gid_async(hrn_to_urn("planetlab.us.arizona.bob", 'user'),
+                                                     create_uuid(), pkey, email="bob@arizona.edu"))
+        gids = [ p.get() for p in pending ]
+        self.assertEqual([ gid.get_hrn() for gid in gids[:-1] ], names)
+        parent = self.hierarchy.get_auth_info("planetlab.us.arizona").get_gid_object()
+        for gid in gids:
+            self.assert_(gid.is_signed_by_cert(parent))
+        self.assert_(gids[-1].get_pubkey().is_same(pkey))
+        self.assertEqual(gids[-1].get_email(), "bob@arizona.edu")
+
+    def testFailure(self):
+        # no such authority
+        pending = self.factory.create_gid_async(hrn_to_urn("nowhere.node", 'node'), create_uuid())
+        self.assertRaises(Exception, pending.get)
+
+    def testDeadWorkers(self):
+        class LostPool:
+            def apply_async(self, *args, **kwds):
+                pass
+        factory = _gid_factory(self.hierarchy)
+        factory.pool.terminate()
+        factory.pool = LostPool()
+        factory.keypair_timeout = 0.2
+        begin = time.time()
+        factory.keypair()
+        self.assert_(factory.starved)
+        # the next ones do not wait for the workers anymore
+        for i in range(5):
+            factory.keypair()
+        self.assert_(time.time() - begin < 1)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,84 @@
+import time
+import unittest
+from sfa.planetlab.plleases import _lease_index
+
+class FakeShell:
+    """
+    records the PLCAPI calls made through it
+    """
+    def __init__(self, leases):
+        self.leases = leases
+        self.calls = []
+
+    def GetLeaseGranularity(self):
+        self.calls.append('GetLeaseGranularity')
+        return 1800
+
+    def GetLeases(self, filter, fields):
+        self.calls.append('GetLeases')
+        return [ dict(lease) for lease in self.leases
+                 if 'name' not in filter or lease['name'] == filter['name'] ]
+
+    def GetNodes(self, filter, fields):
+        self.calls.append('GetNodes')
+        return [ {'hostname': hostname, 'hrn': 'plc.site.' + hostname.split('.')[0]}
+                 for hostname in filter['hostname'] ]
+
+    def GetSlices(self, filter, fields):
+        self.calls.append('GetSlices')
+        return [ {'slice_id': slice_id, 'hrn': 'plc.site.slice%d' % slice_id}
+                 for slice_id in filter['slice_id'] ]
+
+def make_lease(lease_id, hostname, slice_id, t_from, t_until):
+    return {'lease_id': lease_id, 'hostname': hostname, 'node_id': 0, 'site_id': 0,
+            'slice_id': slice_id, 'name': 'site_slice%d' % slice_id,
+            't_from': t_from, 't_until': t_until}
+
+class TestLeaseIndex(unittest.TestCase):
+    def setUp(self):
+        now = int(time.time())
+        self.now = now
+        self.shell = FakeShell([make_lease(id, 'node%d.org' % (id % 3), id % 2, now + id * 1800, now + (id + 1) * 1800)
+                                for id in range(10)])
+        self.index = _lease_index('http://plc/')
+
+    def testBulkHrns(self):
+        leases = self.index.get_leases(self.shell)
+        self.assertEqual(len(leases), 10)
+        # one call of each kind, whatever the number of leases
+        self.assertEqual(sorted(self.shell.calls),
+                         ['GetLeaseGranularity', 'GetLeases', 'GetNodes', 'GetSlices'])
+        hrns = set([ (lease['hostname'], node_hrn, slice_hrn)
+                     for (lease, node_hrn, slice_hrn) in self.index.get_leases_with_hrns(self.shell) ])
+        self.assertTrue(('node1.org', 'plc.site.node1', 'plc.site.slice1') in hrns)
+        self.assertTrue(('node1.org', 'plc.site.node1', 'plc.site.slice0') in hrns)
+        # served from memory until the next refresh
+        self.index.get_leases(self.shell, slice_name='site_slice0')
+        self.assertEqual(len(self.shell.calls), 4)
+
+    def testLookup(self):
+        leases = self.index.get_leases(self.shell, hostname='node0.org')
+        self.assertEqual([ lease['lease_id'] for lease in leases ], [0, 3, 6, 9])
+        leases = self.index.get_leases(self.shell, slice_name='site_slice1',
+                                       t_from=self.now + 3 * 1800, t_until=self.now + 6 * 1800)
+        self.assertEqual([ lease['lease_id'] for lease in leases ], [3, 5])
+
+    def testRefreshSlice(self):
+        self.index.get_leases(self.shell)
+        self.shell.leases = [ lease for lease in self.shell.leases if lease['lease_id'] != 4 ]
+        self.shell.leases.append(make_lease(10, 'node3.org', 0, self.now, self.now + 1800))
+        leases = self.index.refresh_slice(self.shell, 'site_slice0')
+        self.assertEqual(sorted([ lease['lease_id'] for lease in leases ]), [0, 2, 6, 8, 10])
+        self.assertEqual(len(self.index.get_leases(self.shell)), 10)
+        # only the new node had to be resolved
+        self.assertEqual(self.shell.calls.count('GetNodes'), 2)
+        self.assertEqual([ node_hrn for (_, node_hrn, _) in self.index.get_leases_with_hrns(self.shell, hostname='node3.org') ],
+                         ['plc.site.node3'])
+
+    def testExpire(self):
+        self.index.get_leases(self.shell)
+        self.index._expire(self.now + 2 * 1800)
+        self.assertEqual(len(self.index.get_leases(self.shell)), 8)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,85 @@
+from __future__ import with_statement
+import time
+import threading
+import unittest
+from sfa.client.multiclient import MultiClient, _executor_impl
+
+def echo(value, sleep=0):
+    time.sleep(sleep)
+    return value
+
+def fail():
+    raise Exception("failed")
+
+class TestMultiClient(unittest.TestCase):
+    def setUp(self):
+        # a private executor, so as not to depend on the other tests
+        self.executor = _executor_impl(max_workers=4, max_per_key=2)
+
+    def testResults(self):
+        multiclient = MultiClient(executor=self.executor)
+        for i in range(10):
+            multiclient.run(echo, i)
+        self.assertEqual(sorted(multiclient.get_results()), range(10))
+        self.assertEqual(multiclient.get_timeouts(), [])
+        # no more threads than we asked for
+        self.assertTrue(self.executor.stats()['workers'] <= 4)
+
+    def testErrors(self):
+        multiclient = MultiClient(executor=self.executor)
+        multiclient.run(echo, 1)
+        multiclient.run(fail)
+        self.assertEqual(multiclient.get_results(), [1])
+        self.assertEqual(len(multiclient.get_errors()), 1)
+        multiclient = MultiClient(executor=self.executor)
+        multiclient.run(fail)
+        self.assertRaises(Exception, multiclient.get_results, lenient=False)
+
+    def testDeadline(self):
+        multiclient = MultiClient(timeout=0.5, executor=self.executor)
+        multiclient.run_for('fast', echo, 'fast')
+        multiclient.run_for('slow', echo, 'slow', 3)
+        start = time.time()
+        self.assertEqual(multiclient.get_results(), ['fast'])
+        self.assertTrue(time.time() - start < 2)
+        self.assertEqual([key for (key, elapsed) in multiclient.get_timeouts()], ['slow'])
+
+    def testIterResults(self):
+        multiclient = MultiClient(timeout=1, executor=self.executor)
+        multiclient.run(echo, 'slow', 0.3)
+        multiclient.run(echo, 'fast')
+        multiclient.run(echo, 'hung', 3)
+        # in the order they complete
+        self.assertEqual(list(multiclient.iter_results()), ['fast', 'slow'])
+        self.assertEqual(len(multiclient.get_timeouts()), 1)
+
+    def testPerKeyLimit(self):
+        running = {'now': 0, 'max': 0}
+        lock = threading.Lock()
+        def count():
+            with lock:
+                running['now'] += 1
+                running['max'] = max(running['max'], running['now'])
+            time.sleep(0.1)
+            with lock:
+                running['now'] -= 1
+            return True
+        multiclient = MultiClient(executor=self.executor)
+        for i in range(6):
+            multiclient.run_for('agg', count)
+        multiclient.run_for('other', echo, 'other')
+        self.assertEqual(len(multiclient.get_results()), 7)
+        self.assertEqual(running['max'], 2)
+
+    def testWaitingCancelled(self):
+        # the second call never gets a slot on 'hung' before the deadline
+        executor = _executor_impl(max_workers=4, max_per_key=1)
+        multiclient = MultiClient(timeout=0.3, executor=executor)
+        multiclient.run_for('hung', echo, 1, 1)
+        multiclient.run_for('hung', echo, 2)
+        self.assertEqual(multiclient.get_results(), [])
+        self.assertEqual(len(multiclient.get_timeouts()), 2)
+        self.assertEqual(executor.stats()['waiting'], 0)
+
+if __name__ == "__main__":
+    unittest.main()
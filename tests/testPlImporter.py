@@ -0,0 +1,140 @@
+from __future__ import with_statement
+import os
+import shutil
+import tempfile
+import unittest
+
+from sqlalchemy import create_engine, event
+from sqlalchemy.orm import sessionmaker
+
+from sfa.util.config import Config
+from sfa.util.sfalogging import logger
+from sfa.trust.hierarchy import Hierarchy
+from sfa.trust.gidfactory import _gid_factory
+from sfa.storage.model import Base, RegAuthority, RegNode, RegUser, RegSlice
+
+# stands for PLCAPI, with what the importer asks for
+class FakeShell:
+    def __init__(self):
+        self.sites = [ {'site_id': 1, 'login_base': 'site', 'name': 'Site', 'hrn': 'plc.site',
+                        'node_ids': [1, 2], 'slice_ids': [1], 'person_ids': [1]} ]
+        self.persons = [ {'person_id': 1, 'email': 'alice@site.org', 'key_ids': [], 'site_ids': [1],
+                          'role_ids': [20], 'hrn': 'plc.site.alice'} ]
+        self.nodes = [ {'node_id': 1, 'hostname': 'node1.site.org', 'site_id': 1},
+                       {'node_id': 2, 'hostname': 'node2.site.org', 'site_id': 1} ]
+        self.slices = [ {'slice_id': 1, 'name': 'site_slice', 'person_ids': [1], 'hrn': 'plc.site.slice'} ]
+    def GetSites(self, filter, fields):
+        return self.sites
+    def GetPersons(self, filter, fields):
+        if filter['enabled']: return self.persons
+        return []
+    def GetKeys(self, filter):
+        return []
+    def GetNodes(self, filter, fields):
+        return self.nodes
+    def GetSlices(self, filter, fields):
+        return self.slices
+    def GetSiteSfaCreated(self, site_id):
+        return None
+
+class TestPlImporter(unittest.TestCase):
+    def setUp(self):
+        # loaded here so that the other tests can run without a db server
+        from sfa.importer import plimporter
+        self.plimporter = plimporter
+
+        # the phases and the records savepoints, in sqlite
+        self.engine = create_engine('sqlite://')
+        @event.listens_for(self.engine, 'connect')
+        def connect(dbapi_connection, connection_record):
+            dbapi_connection.isolation_level = None
+        @event.listens_for(self.engine, 'begin')
+        def begin(connection):
+            connection.execute("BEGIN")
+        Base.metadata.create_all(self.engine)
+        self.dbsession = sessionmaker(bind=self.engine)()
+        self.global_dbsession = plimporter.global_dbsession
+        plimporter.global_dbsession = self.dbsession
+
+        self.shell = FakeShell()
+        self.PlShell = plimporter.PlShell
+        plimporter.PlShell = lambda config: self.shell
+
+        self.dir = tempfile.mkdtemp()
+        Config.SFA_INTERFACE_HRN = 'plc'
+        Config.SFA_REGISTRY_ROOT_AUTH = 'plc'
+        Config.SFA_DATA_DIR = self.dir
+        self.hierarchy = Hierarchy(os.path.join(self.dir, 'authorities'))
+        self.hierarchy.create_auth('plc')
+        self.checkpoint = os.path.join(self.dir, 'plimporter.phases')
+
+    def tearDown(self):
+        self.plimporter.global_dbsession = self.global_dbsession
+        self.plimporter.PlShell = self.PlShell
+        self.dbsession.close()
+        with _gid_factory._instances_lock:
+            factory = _gid_factory._instances.pop(self.hierarchy.basedir, None)
+        if factory is not None and factory.pool is not None:
+            factory.pool.terminate()
+        shutil.rmtree(self.dir)
+        del Config.SFA_INTERFACE_HRN
+        del Config.SFA_REGISTRY_ROOT_AUTH
+        del Config.SFA_DATA_DIR
+
+    # an importer that records the phases it runs, and fails the one named fail
+    def importer(self, called, fail=None):
+        importer = self.plimporter.PlImporter(self.hierarchy, logger)
+        def wrap(phase, method):
+            def wrapper(*args):
+                called.append(phase)
+                method(*args)
+                if phase == fail:
+                    raise Exception("PLC went away")
+            return wrapper
+        for phase in [ 'sites', 'nodes', 'persons', 'slices' ]:
+            setattr(importer, 'import_' + phase, wrap(phase, getattr(importer, 'import_' + phase)))
+        return importer
+
+    def hrns(self, cls):
+        return sorted([ record.hrn for record in self.dbsession.query(cls).all() ])
+
+    def testResume(self):
+        # the slices phase fails
+        called = []
+        self.assertRaises(Exception, self.importer(called, fail='slices').run, {})
+        self.assertEqual(called, [ 'sites', 'nodes', 'persons', 'slices' ])
+        self.dbsession.expire_all()
+        # the slice is rolled back, the records from the phases before are there
+        self.assertEqual(self.hrns(RegSlice), [])
+        self.assertEqual(self.hrns(RegAuthority), [ 'plc.site' ])
+        self.assertEqual(len(self.hrns(RegNode)), 2)
+        self.assertEqual(self.hrns(RegUser), [ 'plc.site.alice' ])
+        self.assertEqual(open(self.checkpoint).read().split(), [ 'sites', 'nodes', 'persons' ])
+
+        # meanwhile a node is gone from PLC
+        self.shell.sites[0]['node_ids'] = [1]
+        self.shell.nodes = self.shell.nodes[:1]
+        called = []
+        self.importer(called).run({'resume': True})
+        # only the slices phase is run again
+        self.assertEqual(called, [ 'slices' ])
+        self.dbsession.expire_all()
+        self.assertEqual(self.hrns(RegSlice), [ 'plc.site.slice' ])
+        slice = self.dbsession.query(RegSlice).one()
+        self.assertEqual([ user.hrn for user in slice.reg_researchers ], [ 'plc.site.alice' ])
+        # the records of the skipped phases are not stale, so the node is still there
+        self.assertEqual(self.hrns(RegAuthority), [ 'plc.site' ])
+        self.assertEqual(len(self.hrns(RegNode)), 2)
+        self.assertEqual(self.hrns(RegUser), [ 'plc.site.alice' ])
+        self.assertFalse(os.path.exists(self.checkpoint))
+
+        # the next full run cleans it up
+        called = []
+        self.importer(called).run({})
+        self.assertEqual(called, [ 'sites', 'nodes', 'persons', 'slices' ])
+        self.dbsession.expire_all()
+        self.assertEqual(len(self.hrns(RegNode)), 1)
+        self.assertEqual(self.hrns(RegSlice), [ 'plc.site.slice' ])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,137 @@
+import unittest
+import threading
+from sfa.planetlab.plmirror import _pl_mirror, PlMirrorShell
+
+class FakeShell:
+    """
+    just enough of GetNodes and GetPersons for the mirror, that records
+    the calls made through it
+    """
+    def __init__(self):
+        self.calls = []
+        self.nodes = {}
+        self.persons = {}
+        for id in range(1, 6):
+            self.nodes[id] = {'node_id': id, 'hostname': 'node%d.org' % id, 'peer_id': None,
+                              'site_id': 1, 'boot_state': 'boot', 'last_updated': 100}
+        self.persons[1] = {'person_id': 1, 'email': 'pi@org', 'peer_id': None, 'roles': ['pi', 'user'],
+                           'site_ids': [1], 'key_ids': [], 'last_updated': 100}
+
+    def get(self, objects, id_field, name_field, filter, fields):
+        if isinstance(filter, dict):
+            records = objects.values()
+            if filter:
+                (field, value) = filter.items()[0]
+                records = [ record for record in records if record[field[1:]] >= value ]
+        else:
+            records = [ record for record in objects.values()
+                        if record[id_field] in filter or record[name_field] in filter ]
+        if fields is None:
+            return [ dict(record) for record in records ]
+        return [ dict([ (field, record.get(field, 'plc.site.%s' % record[name_field])) for field in fields ])
+                 for record in records ]
+
+    def GetNodes(self, filter=None, fields=None):
+        self.calls.append('GetNodes')
+        return self.get(self.nodes, 'node_id', 'hostname', filter, fields)
+
+    def GetPersons(self, filter=None, fields=None):
+        self.calls.append('GetPersons')
+        return self.get(self.persons, 'person_id', 'email', filter, fields)
+
+    def GetSites(self, filter=None, fields=None):
+        return []
+
+    def GetSlices(self, filter=None, fields=None):
+        return []
+
+    def GetKeys(self, filter=None, fields=None):
+        return []
+
+class TestPlMirror(unittest.TestCase):
+    def setUp(self):
+        self.shell = FakeShell()
+        self.mirror = _pl_mirror('http://plc/')
+        self.reader = PlMirrorShell(self.mirror, self.shell)
+
+    def testReads(self):
+        nodes = self.reader.GetNodes({'peer_id': None, 'node_id': [1, 2]}, ['node_id', 'hostname'])
+        self.assertEqual(sorted([ node['hostname'] for node in nodes ]), ['node1.org', 'node2.org'])
+        # the full load: the records, and then their hrns
+        self.assertEqual(self.shell.calls, ['GetNodes', 'GetNodes'])
+        self.assertEqual(len(self.reader.GetNodes(['node3.org', 4])), 2)
+        self.assertEqual(self.reader.GetNodes({'hrn': 'plc.site.node5.org'}, ['node_id'])[0]['node_id'], 5)
+        self.assertEqual(self.reader.GetNodeHrn(5), 'plc.site.node5.org')
+        pis = self.reader.GetPersons({'peer_id': None, '|roles': ['pi'], '|site_ids': [1]}, ['person_id'])
+        self.assertEqual(pis, [{'person_id': 1}])
+        self.assertEqual(self.shell.calls.count('GetNodes'), 2)
+        # records are copies
+        nodes[0]['hostname'] = 'changed'
+        self.assertEqual(self.reader.GetNodes(1)[0]['hostname'], 'node1.org')
+        self.assertEqual(self.mirror.stats()['misses'], 0)
+
+    def testPassThrough(self):
+        self.reader.GetNodes(1)
+        calls = len(self.shell.calls)
+        self.reader.GetNodes({'~hostname': 'node1.org'})
+        self.reader.GetNodes([1], ['node_id', 'sfa_created'])
+        self.assertEqual(len(self.shell.calls), calls + 2)
+        self.assertEqual(self.mirror.stats()['misses'], 2)
+
+    def testWrites(self):
+        self.reader.GetNodes(1)
+        self.shell.nodes[1]['boot_state'] = 'failboot'
+        self.mirror.written('UpdateNode', (1, {'boot_state': 'failboot'}))
+        self.assertEqual(self.reader.GetNodes(1)[0]['boot_state'], 'failboot')
+        # only that node is fetched again
+        self.assertEqual(self.shell.calls, ['GetNodes'] * 4)
+
+    def testReadThrough(self):
+        self.reader.GetNodes(1)
+        self.shell.nodes[6] = dict(self.shell.nodes[1], node_id=6, hostname='node6.org')
+        self.assertEqual(self.reader.GetNodes([6])[0]['hostname'], 'node6.org')
+
+    def testIncremental(self):
+        self.reader.GetNodes(1)
+        self.shell.calls = []
+        self.shell.nodes[2]['boot_state'] = 'failboot'
+        self.shell.nodes[2]['last_updated'] = 200
+        del self.shell.nodes[3]
+        self.mirror.tables['nodes'].refreshed = 0
+        nodes = self.reader.GetNodes({'peer_id': None})
+        self.assertEqual(sorted([ node['node_id'] for node in nodes ]), [1, 2, 4, 5])
+        self.assertEqual(self.reader.GetNodes(2)[0]['boot_state'], 'failboot')
+        # the ids, the changed ones, and the records and hrns for these
+        self.assertEqual(len(self.shell.calls), 4)
+
+    def testWriteTargets(self):
+        self.reader.GetNodes(1)
+        self.mirror.written('AddLeases', ([1], 'plc_slice', 0, 3600))
+        self.assertFalse(self.mirror.tables['nodes'].stale)
+        self.mirror.written('BindObjectToPeer', ('node', 2, 'peer', 12))
+        self.mirror.written('AddSliceToNodes', ('plc_slice', ['node3.org']))
+        self.assertFalse(self.mirror.tables['nodes'].stale)
+        self.assertEqual(self.mirror.tables['nodes'].dirty, set([2, 3]))
+
+    def testReadDuringRefresh(self):
+        self.reader.GetNodes(1)
+        self.mirror.tables['nodes'].refreshed = 0
+        started = threading.Event()
+        release = threading.Event()
+        get_nodes = self.shell.GetNodes
+        def slow_get_nodes(filter=None, fields=None):
+            started.set()
+            release.wait(5)
+            return get_nodes(filter, fields)
+        self.shell.GetNodes = slow_get_nodes
+        refresher = threading.Thread(target=self.reader.GetNodes, args=(1,))
+        refresher.start()
+        started.wait(5)
+        # served from the current objects while PLC is being queried
+        self.assertEqual(self.reader.GetNodes(2)[0]['hostname'], 'node2.org')
+        self.assertTrue(refresher.isAlive())
+        release.set()
+        refresher.join()
+
+if __name__ == "__main__":
+    unittest.main()
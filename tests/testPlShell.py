@@ -0,0 +1,140 @@
+import threading
+import unittest
+import xmlrpclib
+from SocketServer import ThreadingMixIn
+from SimpleXMLRPCServer import SimpleXMLRPCServer, SimpleXMLRPCRequestHandler
+
+from sfa.planetlab.plshell import PlShell, PlcEndpoint
+
+class CountingHandler(SimpleXMLRPCRequestHandler):
+    # keep connections alive
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        self.server.requests += 1
+        SimpleXMLRPCRequestHandler.do_POST(self)
+
+    def log_message(self, *args):
+        pass
+
+class Server(ThreadingMixIn, SimpleXMLRPCServer):
+    daemon_threads = True
+
+class Config:
+    SFA_PLC_USER = 'root@test.org'
+    SFA_PLC_PASSWORD = 'test'
+
+class FakePLC:
+    """
+    a minimal PLCAPI, that counts the http requests it receives
+    """
+    def __init__(self, multicall):
+        self.server = Server(('127.0.0.1', 0), requestHandler=CountingHandler,
+                              allow_none=True, logRequests=False)
+        self.server.requests = 0
+        self.server.register_function(self.GetNodeHrn, 'GetNodeHrn')
+        self.server.register_function(self.AddSliceTag, 'AddSliceTag')
+        if multicall:
+            self.server.register_multicall_functions()
+        self.url = 'http://127.0.0.1:%d/' % self.server.server_address[1]
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def GetNodeHrn(self, auth, hostname):
+        return 'plc.site.' + hostname.split('.')[0]
+
+    def AddSliceTag(self, auth, slice_name, tagname, value, node_id):
+        if not value:
+            raise xmlrpclib.Fault(102, 'Invalid value')
+        return 1
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+class TestPlShell(unittest.TestCase):
+    def shell(self, plc):
+        config = Config()
+        config.SFA_PLC_URL = plc.url
+        return PlShell(config)
+
+    def testMulticall(self):
+        plc = FakePLC(multicall=True)
+        try:
+            shell = self.shell(plc)
+            with shell.batch() as batch:
+                calls = [ batch.GetNodeHrn('node%d.org' % i) for i in range(5) ]
+                failed = batch.AddSliceTag('site_slice', 'vref', '', None)
+            self.assertEqual(plc.server.requests, 1)
+            self.assertEqual([ call.result() for call in calls ],
+                             [ 'plc.site.node%d' % i for i in range(5) ])
+            self.assertRaises(xmlrpclib.Fault, failed.result)
+            self.assertRaises(xmlrpclib.Fault, batch.results)
+        finally:
+            plc.stop()
+
+    def testSequentialFallback(self):
+        # a stock SimpleXMLRPCServer, that answers system.multicall with a fault code 1
+        plc = FakePLC(multicall=False)
+        try:
+            shell = self.shell(plc)
+            with shell.batch() as batch:
+                batch.GetNodeHrn('node1.org')
+                batch.AddSliceTag('site_slice', 'vref', 'f14', None)
+            self.assertEqual(batch.results(), ['plc.site.node1', 1])
+            # the failed system.multicall, and then one request per call
+            self.assertEqual(plc.server.requests, 3)
+            # multicall is not attempted again
+            with shell.batch() as batch:
+                batch.GetNodeHrn('node1.org')
+            self.assertEqual(plc.server.requests, 4)
+        finally:
+            plc.stop()
+
+    def testMulticallFault(self):
+        plc = FakePLC(multicall=False)
+        def refused(calls):
+            raise xmlrpclib.Fault(103, 'Failed to authenticate call')
+        plc.server.register_function(refused, 'system.multicall')
+        try:
+            shell = self.shell(plc)
+            def run():
+                with shell.batch() as batch:
+                    batch.GetNodeHrn('node1.org')
+            self.assertRaises(xmlrpclib.Fault, run)
+            # this does not mean there is no system.multicall
+            self.assertFalse(plc.url in PlShell.no_multicall)
+        finally:
+            plc.stop()
+
+    def testEndpoint(self):
+        plc = FakePLC(multicall=True)
+        try:
+            shells = [ self.shell(plc) for i in range(3) ]
+            self.assertTrue(shells[0].endpoint is shells[2].endpoint)
+            for shell in shells:
+                shell.GetNodeHrn('node1.org')
+            self.assertRaises(xmlrpclib.Fault, shells[0].AddSliceTag, 'site_slice', 'vref', '', None)
+            stats = PlcEndpoint(plc.url).stats()
+            # one connection for all the calls
+            self.assertEqual(stats['connections']['created'], 1)
+            self.assertEqual(stats['connections']['reused'], 3)
+            self.assertEqual(stats['methods']['GetNodeHrn']['calls'], 3)
+            self.assertEqual(stats['methods']['AddSliceTag']['errors'], 1)
+        finally:
+            plc.stop()
+
+    def testNotSent(self):
+        plc = FakePLC(multicall=True)
+        try:
+            batch = self.shell(plc).batch()
+            call = batch.GetNodeHrn('node1.org')
+            self.assertRaises(Exception, call.result)
+            self.assertRaises(Exception, batch.AddSomething, 'node1.org')
+            self.assertEqual(plc.server.requests, 0)
+        finally:
+            plc.stop()
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,61 @@
+import unittest
+
+from sfa.rspecs.rspec import RSpec
+from sfa.rspecs.version_manager import VersionManager
+
+NS = "http://www.geni.net/resources/rspec/3"
+
+# an advertisement from one aggregate, with the GENI v3 namespace
+AD = """<rspec type="advertisement" xmlns="%s">
+  <!-- a comment -->
+  <node component_id="urn:publicid:IDN+agg+node+node1" component_name="node1.agg.org">
+    <hardware_type name="plab-pc"/>
+  </node>
+  <node component_id="urn:publicid:IDN+agg+node+node2" component_name="node2.agg.org">
+    <sliver_type name="plos-pc"/>
+  </node>
+  <node component_id="urn:publicid:IDN+agg+node+node3"/>
+  <link component_id="urn:publicid:IDN+agg+link+link1" component_name="link1"/>
+  <lease slice_id="urn:publicid:IDN+agg+slice+slice1" start_time="1400000000" duration="2">
+    <node component_id="urn:publicid:IDN+agg+node+node1"/>
+  </lease>
+</rspec>""" % NS
+
+class TestRSpecMerge(unittest.TestCase):
+    def setUp(self):
+        version = VersionManager()._get_version('GENI', '3', 'ad')
+        # each RSpec needs a version object of its own
+        self.rspec = RSpec(version=version.__class__())
+        self.in_rspec = RSpec(AD, version=version.__class__())
+
+    def children(self, tag):
+        return self.rspec.xml.root.element.findall('{%s}%s' % (NS, tag))
+
+    def testMergeSubtrees(self):
+        self.rspec.version.merge_subtrees(self.in_rspec)
+        nodes = self.children('node')
+        # the node that only stands for a lease is not carried over
+        self.assertEqual([ node.get('component_name') for node in nodes ],
+                         [ 'node1.agg.org', 'node2.agg.org' ])
+        # sliver_type is added where missing, and left alone otherwise
+        self.assertEqual([ [ sliver_type.get('name') for sliver_type in node.findall('{%s}sliver_type' % NS) ]
+                           for node in nodes ],
+                         [ ['plab-vserver'], ['plos-pc'] ])
+        self.assertEqual([ link.get('component_name') for link in self.children('link') ], [ 'link1' ])
+        leases = self.children('lease')
+        self.assertEqual([ lease.get('slice_id') for lease in leases ], [ 'urn:publicid:IDN+agg+slice+slice1' ])
+        self.assertEqual(len(leases[0].findall('{%s}node' % NS)), 1)
+        # the elements were moved, not copied
+        self.assertEqual(len(self.in_rspec.xml.root.element.findall('{%s}node' % NS)), 1)
+
+    def testSameAsMergeElements(self):
+        self.rspec.version.merge(self.in_rspec)
+        subtrees = self.rspec.version
+        other = RSpec(version=subtrees.__class__())
+        other.version.merge_elements(RSpec(AD, version=subtrees.__class__()))
+        ids = lambda version: sorted([ node['component_id'] for node in version.get_nodes() ])
+        self.assertEqual(ids(subtrees), ids(other.version))
+        self.assertEqual(len(subtrees.get_leases()), len(other.version.get_leases()))
+
+if __name__ == "__main__":
+    unittest.main()
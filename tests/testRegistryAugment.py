@@ -0,0 +1,101 @@
+import unittest
+
+from sqlalchemy import create_engine, event, and_, or_
+from sqlalchemy.orm import sessionmaker
+
+from sfa.storage.model import Base, RegRecord, RegAuthority, RegUser, RegSlice, RegKey, \
+    augment_records_with_sfa_builtins, augment_one_with_sfa_builtins, iter_records_with_sfa_builtins
+
+class TestRegistryAugment(unittest.TestCase):
+    def setUp(self):
+        self.engine = create_engine('sqlite://')
+        Base.metadata.create_all(self.engine)
+        self.dbsession = sessionmaker(bind=self.engine)()
+        for a in range(3):
+            authority = RegAuthority(hrn='plc.site%d' % a)
+            users = []
+            for u in range(4):
+                user = RegUser(hrn='plc.site%d.user%d' % (a, u), email='user%d@site%d.org' % (u, a))
+                user.reg_keys = [ RegKey('ssh-rsa key%d%d' % (a, u)) ]
+                users.append(user)
+            authority.reg_pis = users[:2]
+            slice = RegSlice(hrn='plc.site%d.slice' % a)
+            slice.reg_researchers = users[1:]
+            self.dbsession.add_all([authority, slice] + users)
+        self.dbsession.commit()
+        self.queries = 0
+        def count(*args):
+            self.queries += 1
+        event.listen(self.engine, 'before_cursor_execute', count)
+
+    def tearDown(self):
+        self.dbsession.close()
+
+    def fields(self, records):
+        result = {}
+        for record in records:
+            result[record.hrn] = dict([ (k, sorted(v) if isinstance(v, list) else v)
+                                        for (k, v) in record.__dict__.items() if k.startswith('reg-') ])
+        return result
+
+    def testSetBased(self):
+        records = self.dbsession.query(RegRecord).filter(RegRecord.hrn.startswith('plc.')).all()
+        self.queries = 0
+        augment_records_with_sfa_builtins(records)
+        # keys, pi authorities, slices, pis, researchers
+        self.assertEqual(self.queries, 5)
+        fields = self.fields(records)
+        self.assertEqual(fields['plc.site1.user1']['reg-keys'], ['ssh-rsa key11'])
+        self.assertEqual(fields['plc.site1.user1']['reg-pi-authorities'], ['plc.site1'])
+        self.assertEqual(fields['plc.site1.user0']['reg-slices'], [])
+        self.assertEqual(fields['plc.site2']['reg-pis'], ['plc.site2.user0', 'plc.site2.user1'])
+        self.assertEqual(len(fields['plc.site0.slice']['reg-researchers']), 3)
+
+        # same as going through the relationships one record at a time
+        self.dbsession.expire_all()
+        records = self.dbsession.query(RegRecord).filter(RegRecord.hrn.startswith('plc.')).all()
+        for record in records:
+            augment_one_with_sfa_builtins(record)
+        self.assertEqual(self.fields(records), fields)
+
+    def testChunks(self):
+        query = self.dbsession.query(RegRecord).filter(RegRecord.hrn.startswith('plc.'))
+        records = self.dbsession.query(RegRecord).filter(RegRecord.hrn.startswith('plc.')).all()
+        augment_records_with_sfa_builtins(records)
+        fields = self.fields(records)
+        self.dbsession.expire_all()
+        chunks = list(iter_records_with_sfa_builtins(query, chunk=4))
+        self.assertEqual([ len(chunk) for chunk in chunks ], [4, 4, 4, 4, 2])
+        self.assertEqual(self.fields(sum(chunks, [])), fields)
+
+    def testPages(self):
+        # the aggregate and slice manager records of a site share its hrn
+        for a in range(3):
+            self.dbsession.add_all([ RegRecord(type=type, hrn='plc.site%d' % a)
+                                     for type in ['authority+am', 'authority+sm'] ])
+        self.dbsession.commit()
+        # what List does with options['limit'] and options['marker']
+        def page(limit, marker=None):
+            query = self.dbsession.query(RegRecord).filter(RegRecord.hrn.startswith('plc.'))\
+                .order_by(RegRecord.hrn, RegRecord.type)
+            if marker:
+                (hrn, type) = marker
+                query = query.filter(or_(RegRecord.hrn > hrn,
+                                         and_(RegRecord.hrn == hrn, RegRecord.type > type)))
+            return [ (record.hrn, record.type)
+                     for records in iter_records_with_sfa_builtins(query.limit(limit), chunk=3)
+                     for record in records ]
+        records = []
+        marker = None
+        while True:
+            records_page = page(2, marker)
+            records += records_page
+            if len(records_page) < 2:
+                break
+            marker = records_page[-1]
+        # the first page ends in the middle of the plc.site0 records
+        self.assertEqual(len(records), 24)
+        self.assertEqual(records, sorted(set(records)))
+
+if __name__ == "__main__":
+    unittest.main()
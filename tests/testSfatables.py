@@ -0,0 +1,61 @@
+import os
+import time
+import shutil
+import tempfile
+import unittest
+from sfatables.runtime import SFATablesRules, CompiledChain
+
+sfatables_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'sfatables')
+
+rspec = """<?xml version="1.0"?>
+<RSpec type="SFA"><network name="plc"><node component_id="node1"/></network></RSpec>"""
+
+class TestSfatables(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        shutil.copytree(os.path.join(sfatables_dir, 'processors'), os.path.join(self.dir, 'processors'))
+        os.mkdir(os.path.join(self.dir, 'OUTGOING'))
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    # like sfatables -A OUTGOING -m hrn --user-hrn <hrn> -t REJECT
+    def add_reject_rule(self, number, hrn):
+        match = open(os.path.join(sfatables_dir, 'matches', 'hrn.xml')).read()
+        match = match.replace('<operand>HRN</operand>', '<operand>HRN</operand><value>%s</value>' % hrn)
+        target = open(os.path.join(sfatables_dir, 'targets', 'REJECT.xml')).read()
+        for (type, contents) in [ ('match', match), ('target', target) ]:
+            f = open(os.path.join(self.dir, 'OUTGOING', 'sfatables-%d-%s' % (number, type)), 'w')
+            f.write(contents)
+            f.close()
+
+    def apply(self, user_hrn):
+        rules = SFATablesRules('OUTGOING', self.dir)
+        rules.set_context({'sfa': {'user': {'hrn': user_hrn}, 'slice': {'hrn': ''}}})
+        return rules.apply(rspec)
+
+    def testEmptyChain(self):
+        self.assertTrue(self.apply('plc.user') is rspec)
+
+    def testRules(self):
+        self.add_reject_rule(1, 'plc.bad')
+        rejected = self.apply('plc.bad.user')
+        self.assertTrue('sfa-verdict' in rejected)
+        accepted = self.apply('plc.good.user')
+        self.assertTrue('node1' in accepted)
+        # none of the sfatables contexts make it to the result
+        self.assertFalse('context' in accepted)
+
+    def testCompiledOnce(self):
+        self.add_reject_rule(1, 'plc.bad')
+        chain = CompiledChain('OUTGOING', self.dir)
+        self.assertTrue(CompiledChain('OUTGOING', self.dir) is chain)
+        # adding a rule changes the directory
+        time.sleep(0.01)
+        self.add_reject_rule(2, 'plc.worse')
+        other = CompiledChain('OUTGOING', self.dir)
+        self.assertFalse(other is chain)
+        self.assertEqual(len(other.rules), 2)
+
+if __name__ == "__main__":
+    unittest.main()
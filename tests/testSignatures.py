@@ -0,0 +1,139 @@
+import unittest
+import datetime
+from sfa.trust.credential import Credential, verify_backends
+from sfa.trust.gid import GID
+from sfa.trust.certificate import Certificate, Keypair, VerifiedSigners
+from sfa.util.faults import CredentialNotVerifiable, CertMissingParent
+
+# the in-process signature code, against xmlsec1 and across backends
+
+class TestSignatures(unittest.TestCase):
+   def createSignedGID(self, subject, urn, issuer_pkey = None, issuer_gid = None, lifeDays = 1825):
+      gid = GID(subject=subject, uuid=1, urn=urn, lifeDays=lifeDays)
+      keys = Keypair(create=True)
+      gid.set_pubkey(keys)
+      if issuer_pkey:
+         gid.set_issuer(issuer_pkey, str(issuer_gid.get_issuer()))
+      else:
+         gid.set_issuer(keys, subject)
+
+      gid.encode()
+      gid.sign()
+      return gid, keys
+
+   def createCred(self, gidCaller, gidObject):
+      cred = Credential()
+      cred.set_gid_caller(gidCaller)
+      cred.set_gid_object(gidObject)
+      cred.set_expiration(datetime.datetime.utcnow() + datetime.timedelta(seconds=3600))
+      cred.set_privileges("embed:1, bind:1")
+      cred.encode()
+      return cred
+
+   def testVerifyBackends(self):
+      gidAuthority, keys = self.createSignedGID("site", "urn:publicid:IDN+plc+authority+site")
+      gidCaller, ckeys = self.createSignedGID("site.foo", "urn:publicid:IDN+plc:site+user+foo",
+                                          keys, gidAuthority)
+      gidObject, _ = self.createSignedGID("site.slice", "urn:publicid:IDN+plc:site+slice+bar_slice",
+                                          keys, gidAuthority)
+
+      cred = self.createCred(gidCaller, gidObject)
+      gidAuthority.save_to_file("/tmp/auth_gid")
+      keys.save_to_file("/tmp/auth_key")
+      cred.set_issuer_keys("/tmp/auth_key", "/tmp/auth_gid")
+      cred.sign()
+
+      # both backends must agree, on the genuine credential and on a tampered one
+      for backend in verify_backends:
+         Credential(string=cred.save_to_string()).verify(['/tmp/auth_gid'], backend=backend)
+         tampered = cred.save_to_string().replace("<name>embed</name>", "<name>control</name>")
+         self.assertRaises(CredentialNotVerifiable,
+                           Credential(string=tampered).verify, ['/tmp/auth_gid'], backend=backend)
+
+      # a typo must not silently pick a backend
+      self.assertRaises(ValueError, Credential(string=cred.save_to_string()).verify,
+                        ['/tmp/auth_gid'], backend='natve')
+
+   def testSignBackends(self):
+      gidAuthority, keys = self.createSignedGID("site", "urn:publicid:IDN+plc+authority+site")
+      gidCaller, _ = self.createSignedGID("site.foo", "urn:publicid:IDN+plc:site+user+foo",
+                                          keys, gidAuthority)
+      gidObject, _ = self.createSignedGID("site.slice", "urn:publicid:IDN+plc:site+slice+bar_slice",
+                                          keys, gidAuthority)
+      gidAuthority.save_to_file("/tmp/auth_gid")
+      keys.save_to_file("/tmp/auth_key")
+
+      signed = {}
+      for backend in ['native', 'xmlsec1']:
+         cred = self.createCred(gidCaller, gidObject)
+         cred.set_expiration(datetime.datetime(2030, 1, 1))
+         # loaded objects and filenames are both fine
+         if backend == 'native':
+            cred.set_issuer_keys(keys, gidAuthority)
+         else:
+            cred.set_issuer_keys("/tmp/auth_key", "/tmp/auth_gid")
+         cred.sign(backend=backend)
+         signed[backend] = cred.save_to_string()
+         # each one must pass the other backend
+         for verify_backend in verify_backends:
+            Credential(string=signed[backend]).verify(['/tmp/auth_gid'], backend=verify_backend)
+
+      self.assertEqual(signed['native'], signed['xmlsec1'])
+
+   def testChainExpiration(self):
+      gidAuthority, keys = self.createSignedGID("site", "urn:publicid:IDN+plc+authority+site")
+      # the caller's gid expires before the credential
+      gidCaller, _ = self.createSignedGID("site.foo", "urn:publicid:IDN+plc:site+user+foo",
+                                          keys, gidAuthority, lifeDays=1)
+      gidCaller.set_parent(gidAuthority)
+      gidObject, _ = self.createSignedGID("site.slice", "urn:publicid:IDN+plc:site+slice+bar_slice",
+                                          keys, gidAuthority)
+      cred = self.createCred(gidCaller, gidObject)
+      cred.set_expiration(datetime.datetime.utcnow() + datetime.timedelta(days=30))
+      cred.encode()
+      gidAuthority.save_to_file("/tmp/auth_gid")
+      keys.save_to_file("/tmp/auth_key")
+      cred.set_issuer_keys("/tmp/auth_key", "/tmp/auth_gid")
+      cred.sign()
+
+      cred = Credential(string=cred.save_to_string())
+      self.assertTrue(cred.get_chain_expiration() < cred.get_expiration())
+      self.assertEqual(cred.get_chain_expiration(), gidCaller.get_expiration())
+      self.assertTrue(gidCaller.get_expiration() <= datetime.datetime.utcnow() + datetime.timedelta(days=1))
+
+   def testVerifyChainCache(self):
+      cert_root = Certificate(subject="root")
+      key_root = Keypair(create=True)
+      cert_root.set_pubkey(key_root)
+      cert_root.set_issuer(key_root, "root")
+      cert_root.sign()
+
+      # same subject as nothing we sign
+      cert_other = Certificate(subject="other")
+      key_other = Keypair(create=True)
+      cert_other.set_pubkey(key_other)
+      cert_other.set_issuer(key_other, "other")
+      cert_other.sign()
+
+      cert1 = Certificate(subject="one")
+      key1 = Keypair(create=True)
+      cert1.set_pubkey(key1)
+      cert1.set_issuer(key_root, "root")
+      cert1.sign()
+
+      signers = VerifiedSigners()
+      signers.clear()
+      cert1.verify_chain([cert_other, cert_root])
+      # only the root named as issuer was tried
+      self.assertEqual(len(signers), 1)
+      hits = signers.hits
+      Certificate(string=cert1.save_to_string()).verify_chain([cert_other, cert_root])
+      self.assertEqual(signers.hits, hits + 1)
+
+      # a cert re-signed by another key is not mistaken for the cached one
+      cert1.set_issuer(key_other, "root")
+      cert1.sign()
+      self.assertRaises(CertMissingParent, cert1.verify_chain, [cert_other, cert_root])
+
+if __name__ == "__main__":
+   unittest.main()